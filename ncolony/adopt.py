@@ -0,0 +1,273 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+"""ncolony.adopt
+================
+
+Keep processes running across restarts of ncolony.
+
+With :code:`--adopt`, ncolony keeps a record of every process it
+starts in the :code:`.table` directory inside the :code:`--pid`
+directory, next to the pid files: the pid, a hash of how the process
+was started (arguments, user, group, environment and working
+directory), when it was started, and when the kernel says the pid
+started (so a reused pid is not mistaken for the process).
+
+When ncolony stops, the processes are left running. When it starts
+again, a process which is still running, and whose record matches
+its configuration, is adopted instead of being started again.
+Adopted processes are not children of the new ncolony, so they are
+watched, and signalled, through a pidfd (Linux 5.3, Python 3.9).
+A process whose configuration changed is adopted only to be stopped,
+and started again once it has exited. Without pidfds, a process left
+running is stopped and started again at once, and a process which
+is no longer configured is stopped.
+
+Since processes outlive ncolony, they write to ncolony's own standard
+output and error, instead of to pipes ncolony logs: run ncolony with
+:code:`--nodaemon`, under something which keeps its output.
+"""
+
+import errno
+import hashlib
+import json
+import os
+import signal
+
+from zope import interface
+
+from twisted.internet import error, interfaces
+from twisted.python import failure, log
+
+TABLE = '.table'
+
+CHILD_FDS = {0: 'w', 1: 1, 2: 2}
+
+def _decode(value):
+    if isinstance(value, bytes):
+        return value.decode('utf-8', 'surrogateescape')
+    raise TypeError('cannot hash', value)
+
+def specHash(process):
+    """Hash how a process is started
+
+    Bytes (like the configuration in :code:`NCOLONY_CONFIG`) are
+    hashed as the text they decode to.
+
+    :params process: the process's parameters: arguments, uid, gid,
+                     environment and working directory
+    :returns: string
+    """
+    content = json.dumps([process.args, process.uid, process.gid, process.env, process.cwd],
+                         sort_keys=True, default=_decode)
+    return hashlib.sha256(content.encode('utf-8')).hexdigest()
+
+def canRecord(old, new):
+    """Whether a process started with some parameters can be recorded with others
+
+    Only the configuration in :code:`NCOLONY_CONFIG` may differ
+    (see semantic mode in :py:class:`ncolony.process_events.Receiver`).
+
+    :params old: the parameters the process was started with
+    :params new: the new parameters
+    :returns: boolean
+    """
+    def _fixed(process):
+        env = dict(process.env)
+        env.pop('NCOLONY_CONFIG', None)
+        return process.args, process.uid, process.gid, env, process.cwd
+    return _fixed(old) == _fixed(new)
+
+def processStart(pid, proc='/proc'):
+    """When a process started, according to the kernel
+
+    :params pid: integer, the process id
+    :params proc: string, where procfs is mounted
+    :returns: integer, clock ticks since boot, or None if the process is gone
+    """
+    try:
+        with open(os.path.join(proc, str(pid), 'stat')) as fp:
+            stat = fp.read()
+    except (IOError, OSError):
+        return None
+    return int(stat[stat.rindex(')') + 2:].split()[19])
+
+@interface.implementer(interfaces.IReadDescriptor)
+class AdoptedProcess(object):
+
+    """A process transport for a process which is not a child
+
+    The process is watched through a pidfd, which becomes readable
+    when the process exits. The exit status of a process which is
+    not a child cannot be known, so the protocol is told the process
+    was terminated.
+
+    :params reactor: something implementing
+                     {twisted.internet.interfaces.IReactorFDSet}
+    :params protocol: the IProcessProtocol
+    :params pid: integer, the process id
+    :params fd: integer, a pidfd for the process
+    :params started: number, when the process was started
+    :params stale: boolean, whether the process was started with
+                   other parameters, and should be replaced
+    """
+
+    ## pylint: disable=too-many-arguments
+    def __init__(self, reactor, protocol, pid, fd, started, stale=False):
+        self.reactor = reactor
+        self.protocol = protocol
+        self.pid = pid
+        self.fd = fd
+        self.started = started
+        self.stale = stale
+        protocol.makeConnection(self)
+        reactor.addReader(self)
+    ## pylint: enable=too-many-arguments
+
+    def fileno(self):
+        """The pidfd
+
+        :returns: integer
+        """
+        return self.fd
+
+    def logPrefix(self):
+        """How to log
+
+        :returns: string
+        """
+        return 'AdoptedProcess'
+
+    def signalProcess(self, signalID):
+        """Send a signal
+
+        :params signalID: string, the signal's name
+        :raises: twisted.internet.error.ProcessExitedAlready
+        """
+        if self.pid is None:
+            raise error.ProcessExitedAlready()
+        try:
+            signal.pidfd_send_signal(self.fd, getattr(signal, 'SIG' + signalID))
+        except OSError as exc:
+            if exc.errno != errno.ESRCH:
+                raise
+            raise error.ProcessExitedAlready()
+
+    def doRead(self):
+        """The process exited"""
+        self.reactor.removeReader(self)
+        os.close(self.fd)
+        self.pid = None
+        self.protocol.processEnded(failure.Failure(error.ProcessTerminated()))
+
+    def connectionLost(self, reason):
+        """Nothing to do: the process is still watched until it exits"""
+
+class ProcessTable(object):
+
+    """The pid files and records of running processes
+
+    :params directory: string, the pid directory
+    :params proc: string, where procfs is mounted
+    :params pidfdOpen: a function of a pid returning a pidfd, or None
+                       if there are no pidfds
+    """
+
+    def __init__(self, directory, proc='/proc', pidfdOpen=getattr(os, 'pidfd_open', None)):
+        self.directory = directory
+        self.records = os.path.join(directory, TABLE)
+        self.proc = proc
+        self.pidfdOpen = pidfdOpen
+        if not os.path.isdir(self.records):
+            os.makedirs(self.records)
+
+    def _write(self, path, content):
+        temp = os.path.join(self.records, '.' + os.path.basename(path) + '.new')
+        with open(temp, 'w') as fp:
+            fp.write(content)
+        os.rename(temp, path)
+
+    def record(self, name, pid, spec, started):
+        """Record a running process
+
+        :params name: string, the name of the process
+        :params pid: integer, the process id
+        :params spec: string, see :py:func:`specHash`
+        :params started: number, when the process was started
+        """
+        content = json.dumps(dict(pid=pid, spec=spec, started=started,
+                                  processStart=processStart(pid, self.proc)))
+        self._write(os.path.join(self.records, name), content)
+        self._write(os.path.join(self.directory, name), str(pid))
+
+    def forget(self, name):
+        """Forget a process which is not running any more
+
+        :params name: string, the name of the process
+        """
+        for path in (os.path.join(self.records, name), os.path.join(self.directory, name)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+    def _running(self, name):
+        try:
+            with open(os.path.join(self.records, name)) as fp:
+                details = json.loads(fp.read())
+        except (IOError, OSError, ValueError):
+            return None
+        start = details['processStart']
+        if start is None or processStart(details['pid'], self.proc) != start:
+            return None
+        return details
+
+    def _stop(self, name, pid):
+        log.msg("Stopping process left running: ", name)
+        try:
+            os.kill(pid, signal.SIGTERM)
+        except OSError:
+            pass
+
+    def adopt(self, name, spec, reactor, protocol):
+        """Adopt a process left running, if it can be
+
+        A process which is still running with another spec is adopted
+        as stale: it should be stopped, and started again once it exits.
+        Without pidfds, a process which is still running is stopped.
+
+        :params name: string, the name of the process
+        :params spec: string, see :py:func:`specHash`
+        :params reactor: something implementing
+                         {twisted.internet.interfaces.IReactorFDSet}
+        :params protocol: the IProcessProtocol
+        :returns: AdoptedProcess, or None if the process must be started
+        """
+        details = self._running(name)
+        if details is None:
+            self.forget(name)
+            return None
+        pid = details['pid']
+        if self.pidfdOpen is None:
+            self._stop(name, pid)
+            self.forget(name)
+            return None
+        try:
+            fd = self.pidfdOpen(pid)
+        except OSError:
+            self.forget(name)
+            return None
+        return AdoptedProcess(reactor, protocol, pid, fd, details['started'],
+                              stale=details['spec'] != spec)
+
+    def clean(self, names):
+        """Stop processes left running which are not configured any more
+
+        :params names: collection of the names of configured processes
+        """
+        for name in os.listdir(self.records):
+            if name.startswith('.') or name in names:
+                continue
+            details = self._running(name)
+            if details is not None:
+                self._stop(name, details['pid'])
+            self.forget(name)
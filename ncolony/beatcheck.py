@@ -16,17 +16,44 @@ Processes are encouraged to try and beat about 3-4 times
 faster than the minimum, so that they can miss one beat, and
 account for slight timer inaccuracies, and still not be considered
 unhealthy.
+
+The configurations are scanned every :code:`--config-freq` seconds
+(or watched with inotify, given :code:`--inotify`), and only the
+processes with a :code:`ncolony.beatcheck` section are remembered.
+Every :code:`--freq` seconds, only the status files of processes
+whose deadline has passed are looked at.
+
+Processes whose :code:`ncolony.beatcheck` section has
+:code:`"transport": "datagram"` do not touch a status file.
+Instead, they send their name to the Unix datagram socket given in
+the section's :code:`socket`, which should be the beatcheck's
+:code:`--socket`, and the time of their last beat is kept in memory.
+
+Processes whose section has :code:`"transport": "mmap"` write
+their beats into their slot in the memory-mapped file given in the
+section's :code:`table`, which should be the beatcheck's
+:code:`--table`. The monitor hands out the slots, and the table has
+to have at least as many (:code:`--slots`) as there are such processes.
+On every check, the whole table is read in one pass.
 """
 
+import collections
 import functools
+import heapq
+import itertools
 import json
+import mmap
+import os
+import stat
+import struct
 import time
 
-from twisted.python import filepath, usage
+from twisted.python import filepath, log, usage
 
-from twisted.application import internet as tainternet
+from twisted.application import internet as tainternet, service as taservice
+from twisted.internet import protocol
 
-from ncolony import ctllib
+from ncolony import ctllib, directory_monitor, instrument
 from ncolony.client import heart
 
 def check(path, start, now):
@@ -60,6 +87,248 @@ def _isbad(child, start, now):
     statusMtime = statusPath.getModificationTime()
     return (statusMtime + period) < now
 
+def _statusMtime(status, name):
+    if status.isdir():
+        status = status.child(name)
+    try:
+        return status.getModificationTime()
+    except OSError:
+        return None
+
+_Entry = collections.namedtuple('_Entry', 'period grace status generation')
+
+FILE = 'file'
+DATAGRAM = 'datagram'
+
+class Index(object):
+
+    """Processes that should beat, by deadline
+
+    An index is kept up to date by a configuration checker
+    (see :py:func:`ncolony.directory_monitor.checker`),
+    and only parses configurations when they change.
+    Deadlines are kept in a heap, so checking only looks
+    at processes whose deadline has passed.
+
+    A process is due one grace period (period times grace) after
+    its configuration changed, or after the index was started,
+    whichever is later. When due, if its status file was touched
+    (or, for the datagram transport, it beat) less than a period ago,
+    it is next due a period after that; otherwise, it is reported,
+    and gets another grace period to come back.
+
+    A configuration with :code:`replicas` has an entry for each of
+    its processes, named as in :py:class:`ncolony.process_events.Receiver`
+    (:code:`<name>.0`, :code:`<name>.1` and so on), which beat on their own.
+
+    :params path: a twisted.python.filepath.FilePath with configurations
+    :params start: when the checker started running
+    """
+
+    KEY = 'ncolony.beatcheck'
+
+    def __init__(self, path, start):
+        self.path = path
+        self.start = start
+        self.entries = {}
+        self.heap = []
+        self.generations = itertools.count()
+        self.beats = {}
+        self.replicas = {}
+
+    def begin(self):
+        """Start a batch of configuration changes"""
+
+    def commit(self):
+        """Finish a batch of configuration changes"""
+
+    def add(self, name, contents):
+        """Note a new or changed configuration
+
+        A configuration which cannot be parsed (for example, because
+        its section has no period) is logged and skipped.
+
+        :params name: string, name of process
+        :params contents: bytes, JSON-encoded configuration
+        """
+        self.remove(name)
+        ## pylint: disable=broad-except
+        try:
+            self._add(name, contents)
+        except Exception as e:
+            log.msg("Could not apply configuration: ", name, repr(e))
+            self.remove(name)
+        ## pylint: enable=broad-except
+
+    def _add(self, name, contents):
+        config = json.loads(contents.decode('utf-8'))
+        params = config.get(self.KEY)
+        if params is None:
+            return
+        status = None
+        if params.get('transport', FILE) == FILE:
+            status = filepath.FilePath(params['status'])
+        try:
+            mtime = self.path.child(name).getModificationTime()
+        except OSError:
+            mtime = self.start
+        names = [name]
+        if config.get('replicas') is not None:
+            names = self.replicas[name] = ['%s.%d' % (name, index)
+                                           for index in range(config['replicas'])]
+        for instance in names:
+            entry = self.entries[instance] = _Entry(period=params['period'],
+                                                    grace=params['grace'], status=status,
+                                                    generation=next(self.generations))
+            self._schedule(max(mtime, self.start) + entry.period * entry.grace, instance, entry)
+
+    def remove(self, name):
+        """Note a removed configuration
+
+        :params name: string, name of process
+        """
+        for instance in self.replicas.pop(name, [name]):
+            self.entries.pop(instance, None)
+            self.beats.pop(instance, None)
+
+    def beat(self, name, when):
+        """Note a beat which was not written to a status file
+
+        A beat older than one already noted (for example, from a
+        heartbeat table slot the process used before) is ignored.
+
+        :params name: string, name of process
+        :params when: time of the beat
+        """
+        if name in self.entries:
+            self.beats[name] = max(when, self.beats.get(name, when))
+
+    def _lastBeat(self, name, entry):
+        if entry.status is None:
+            return self.beats.get(name)
+        return _statusMtime(entry.status, name)
+
+    def _schedule(self, deadline, name, entry):
+        heapq.heappush(self.heap, (deadline, name, entry.generation))
+
+    def check(self, now):
+        """Check which processes need to be restarted
+
+        :params now: current time
+        :returns: list of strings
+        """
+        ret = []
+        while self.heap and self.heap[0][0] < now:
+            dummyDeadline, name, generation = heapq.heappop(self.heap)
+            entry = self.entries.get(name)
+            if entry is None or entry.generation != generation:
+                continue
+            lastBeat = self._lastBeat(name, entry)
+            if lastBeat is not None and lastBeat + entry.period >= now:
+                self._schedule(lastBeat + entry.period, name, entry)
+                continue
+            ret.append(name)
+            self._schedule(now + entry.period * entry.grace, name, entry)
+        return ret
+
+class BeatProtocol(protocol.DatagramProtocol):
+
+    """Pass datagram beats on to an index
+
+    Each datagram is the name of a process.
+
+    :params index: an Index
+    :params timer: a function of zero arguments, intended to return current time
+    """
+
+    def __init__(self, index, timer):
+        self.index = index
+        self.timer = timer
+
+    def datagramReceived(self, datagram, dummyAddress):
+        """Note a beat
+
+        :params datagram: bytes, name of process
+        """
+        try:
+            name = datagram.decode('utf-8')
+        except UnicodeDecodeError:
+            return
+        self.index.beat(name, self.timer())
+
+
+class BeatServer(tainternet.UNIXDatagramServer):
+
+    """Listen for datagram beats, replacing a stale socket"""
+
+    def privilegedStartService(self):
+        """Remove a socket left over from a previous run, and listen"""
+        address = self.args[0]
+        try:
+            mode = os.lstat(address).st_mode
+        except OSError:
+            pass
+        else:
+            if stat.S_ISSOCK(mode):
+                os.remove(address)
+        tainternet.UNIXDatagramServer.privilegedStartService(self)
+
+class HeartTable(taservice.Service):
+
+    """A memory-mapped table of beats
+
+    The file is created, or extended, when the service starts. An
+    existing file is not replaced, so processes which already have it
+    mapped keep beating into it across restarts of the beatcheck.
+
+    :params path: string, location of the file
+    :params slots: integer, number of slots
+    :params timer: a function of zero arguments, returning the
+                   monotonic time the processes write
+    """
+
+    def __init__(self, path, slots, timer=time.monotonic):
+        self.path = path
+        self.slots = slots
+        self.timer = timer
+        self.table = None
+
+    def startService(self):
+        """Map the table"""
+        taservice.Service.startService(self)
+        size = self.slots * heart.SLOT_SIZE
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o666)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.table = mmap.mmap(fd, size)
+        finally:
+            os.close(fd)
+
+    def stopService(self):
+        """Unmap the table"""
+        taservice.Service.stopService(self)
+        self.table.close()
+        self.table = None
+
+    def scan(self, index, now):
+        """Pass the beats in the table to an index
+
+        :params index: an Index
+        :params now: current time
+        """
+        if self.table is None:
+            return
+        monotonic = self.timer()
+        for timestamp, name in struct.iter_unpack(heart.SLOT_FORMAT, self.table):
+            if timestamp:
+                index.beat(name.rstrip(b'\0').decode('utf-8', 'replace'),
+                           now - (monotonic - timestamp))
+
+def _checkTable(table, index, now):
+    table.scan(index, now)
+    return index.check(now)
+
 def run(restarter, checker, timer):
     """Run restarter on the checker's output
 
@@ -83,31 +352,105 @@ def parseConfig(opt):
     path = filepath.FilePath(opt['config'])
     return restarter, path
 
-def makeService(opt):
+def watchConfig(master, opt, path, receiver, name, instrumentation=None, reactor=None):
+    """Keep a receiver up to date with the configuration
+
+    Adds a service which scans the configuration in stat mode
+    every opt['config-freq'] seconds, and, if opt['inotify'] is
+    set, a service which watches it with inotify.
+
+    :params master: a service.IServiceCollection
+    :params opt: dictionary-like object with 'config-freq' and (optionally) 'inotify'
+    :params path: a twisted.python.filepath.FilePath with configurations
+    :params receiver: an IMonitorEventReceiver
+    :params name: string, prefix for the services' names
+    :params instrumentation: an IInstrumentation to time the scans with, or None
+    :params reactor: the reactor to run on, or None for the global reactor
+    :returns: None
+    """
+    configCheck = directory_monitor.checker(path.path, receiver, stat=True)
+    configCheck = instrument.wrap(instrumentation, name + '-config', configCheck)
+    configService = tainternet.TimerService(opt['config-freq'], configCheck)
+    configService.clock = reactor
+    configService.setName(name + '-config')
+    configService.setServiceParent(master)
+    if opt.get('inotify'):
+        watcher = directory_monitor.Watcher(path.path, configCheck, reactor=reactor)
+        watcher.setName(name + '-watch')
+        watcher.setServiceParent(master)
+
+def _timer(reactor):
+    if reactor is None:
+        return time.time
+    return reactor.seconds
+
+def makeCheck(opt, path, reactor=None):
+    """Make the parts of a heart beat check
+
+    :params opt: dictionary-like object with (optionally) 'table', 'slots' and 'socket'
+    :params path: a twisted.python.filepath.FilePath with configurations
+    :params reactor: the reactor to run on, or None for the global reactor
+    :returns: the Index (to be kept up to date with the configuration),
+              a function of the current time returning stale names,
+              and a list of services receiving beats
+    """
+    timer = _timer(reactor)
+    index = Index(path, timer())
+    checker = index.check
+    services = []
+    if opt.get('table') is not None:
+        table = HeartTable(opt['table'], opt['slots'])
+        table.setName('beatcheck-table')
+        checker = functools.partial(_checkTable, table, index)
+        services.append(table)
+    if opt.get('socket') is not None:
+        server = BeatServer(opt['socket'], BeatProtocol(index, timer), reactor=reactor)
+        server.setName('beatcheck-socket')
+        services.append(server)
+    return index, checker, services
+
+def makeService(opt, reactor=None):
     """Make a service
 
     :params opt: dictionary-like object with 'freq', 'config' and 'messages'
+    :params reactor: the reactor to run on, or None for the global reactor
     :returns: twisted.application.internet.TimerService that at opt['freq']
               checks for stale processes in opt['config'], and sends
               restart messages through opt['messages']
     """
     restarter, path = parseConfig(opt)
-    now = time.time()
-    checker = functools.partial(check, path, now)
-    beatcheck = tainternet.TimerService(opt['freq'], run, restarter, checker, time.time)
+    index, checker, services = makeCheck(opt, path, reactor)
+    restarter, runner, metricServices, instrumentation = instrument.instrumentCheck(
+        opt, 'beatcheck', restarter, run, reactor=reactor)
+    services.extend(metricServices)
+    beatcheck = tainternet.TimerService(opt['freq'], runner, restarter, checker,
+                                        _timer(reactor))
+    beatcheck.clock = reactor
     beatcheck.setName('beatcheck')
-    return heart.wrapHeart(beatcheck)
+    master = heart.wrapHeart(beatcheck)
+    watchConfig(master, opt, path, index, 'beatcheck', instrumentation, reactor)
+    for service in services:
+        service.setServiceParent(master)
+    return master
 
 ## pylint: disable=too-few-public-methods
 
-class Options(usage.Options):
+class CheckOptions(usage.Options):
 
-    """Options for ncolony beatcheck service"""
+    """Options shared by the ncolony checking services"""
 
     optParameters = [
         ["messages", None, None, "Directory for messages"],
         ["config", None, None, "Directory for configuration"],
         ["freq", None, 10, "Frequency of checking for updates", float],
+        ["config-freq", None, 10, "Frequency of scanning the configuration", float],
+        ["metrics", None, None, "Endpoint to serve metrics on"],
+        ["slow-threshold", None, None, "Seconds from which callbacks are slow, "
+         "and the reactor stalled", float],
+    ]
+
+    optFlags = [
+        ["inotify", None, "Watch the configuration with inotify"],
     ]
 
     def postOptions(self):
@@ -115,5 +458,17 @@ class Options(usage.Options):
         for param in ('messages', 'config'):
             if self[param] is None:
                 raise usage.UsageError("Missing required", param)
+        if self['inotify'] and directory_monitor.inotify is None:
+            raise usage.UsageError("inotify is not available on this platform")
+
+class Options(CheckOptions):
+
+    """Options for ncolony beatcheck service"""
+
+    optParameters = [
+        ["socket", None, None, "Unix datagram socket to listen on for beats"],
+        ["table", None, None, "Memory-mapped file for beats"],
+        ["slots", None, 1024, "Number of slots in the memory-mapped file", int],
+    ]
 
 ## pylint: enable=too-few-public-methods
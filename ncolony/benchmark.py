@@ -0,0 +1,319 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""ncolony.benchmark
+====================
+
+Measure how ncolony's periodic work scales with the number of processes.
+
+.. code-block:: bash
+
+   $ python -m ncolony benchmark --processes 100 --processes 1000 --ticks 20
+
+For each number of processes, a synthetic colony (configuration,
+messages and heart beat status directories) is generated, and each
+kind of periodic work is run for a number of ticks against a fake
+reactor (a :py:class:`twisted.internet.task.Clock`) and a
+:py:class:`FakeMonitor` which only counts what it is asked to do:
+
+config-initial
+    the first scan of the configuration, adding every process.
+
+config-steady, config-steady-stat
+    scans of a configuration which did not change,
+    with and without :code:`--stat`.
+
+config-change
+    scans after rewriting 1% of the configuration files.
+
+messages
+    scans of the messages directory after writing restart
+    messages for 1% of the processes.
+
+beatcheck
+    :py:meth:`ncolony.beatcheck.Index.check` on an index of the
+    configuration, a period apart, as the beatcheck service runs it.
+
+httpcheck
+    :py:meth:`ncolony.httpcheck.Index.check` on an index of the
+    configuration, a period apart, with a fake agent answering
+    immediately, as the httpcheck service runs it.
+
+The results are written as JSON: for each number of processes and
+each kind of work, the latency of the ticks (in seconds), the number
+of read and write system calls (from :code:`/proc/self/io`, or
+:code:`null` where it is not available) and the resident memory (in
+bytes) afterwards. The ncolony and Python versions are included,
+so results can be compared between versions.
+"""
+
+import argparse
+import collections
+import json
+import math
+import os
+import platform
+import shutil
+import sys
+import tempfile
+import time
+import timeit
+
+from twisted.internet import defer, task
+from twisted.python import filepath
+
+import ncolony
+from ncolony import beatcheck, directory_monitor, httpcheck, process_events, sampler
+from ncolony import main as mainlib
+
+PERIOD = 10
+
+class FakeMonitor(object):
+
+    """Something that looks like a process monitor, and counts calls"""
+
+    threshold = 1
+    minRestartDelay = 1
+    maxRestartDelay = 3600
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        self.protocols = {}
+        self.timeStarted = {}
+
+    ## pylint: disable=too-many-arguments,unused-argument
+    def addProcess(self, name, args, uid=None, gid=None, env=None, cwd=None):
+        """Count a process added"""
+        self.calls['addProcess'] += 1
+
+    def updateProcess(self, name, args, uid=None, gid=None, env=None, cwd=None):
+        """Count a process updated"""
+        self.calls['updateProcess'] += 1
+    ## pylint: enable=too-many-arguments
+
+    def removeProcess(self, name):
+        """Count a process removed"""
+        self.calls['removeProcess'] += 1
+
+    def stopProcess(self, name):
+        """Count a process restarted"""
+        self.calls['stopProcess'] += 1
+
+    def restartAll(self):
+        """Count a restart of all processes"""
+        self.calls['restartAll'] += 1
+
+    def setPolicy(self, name, policy):
+        """Count a restart policy set"""
+        self.calls['setPolicy'] += 1
+    ## pylint: enable=unused-argument
+
+    def settled(self):
+        """Nothing is left running, so there is nothing to stop"""
+
+## pylint: disable=too-few-public-methods
+class FakeAgent(object):
+
+    """Something that looks like an HTTP agent, and answers immediately"""
+
+    def __init__(self):
+        self.requests = 0
+
+    def request(self, *dummyArgs):
+        """Answer a request"""
+        self.requests += 1
+        return defer.succeed(None)
+## pylint: enable=too-few-public-methods
+
+def _write(path, content):
+    with open(path, 'w') as fp:
+        fp.write(content)
+
+def processConfig(index, status):
+    """The configuration of a synthetic process
+
+    :params index: integer, the process's number
+    :params status: string, the heart beat status directory
+    :returns: dict
+    """
+    return {
+        'args': ['/bin/true', str(index)],
+        'ncolony.beatcheck': dict(period=PERIOD, grace=3, status=status),
+        'ncolony.httpcheck': dict(url='http://localhost:%d/' % (8000 + index),
+                                  period=PERIOD, grace=1, maxBad=3, timeout=5),
+    }
+
+def generate(location, count):
+    """Generate a synthetic colony
+
+    Half of the processes have a heart beat status file.
+
+    :params location: string, an empty directory
+    :params count: integer, number of processes
+    :returns: dict mapping 'config', 'messages' and 'status'
+              to the directories
+    """
+    places = {name: os.path.join(location, name) for name in ('config', 'messages', 'status')}
+    for place in places.values():
+        os.makedirs(place)
+    for index in range(count):
+        name = 'process-%d' % index
+        config = processConfig(index, places['status'])
+        _write(os.path.join(places['config'], name), json.dumps(config))
+        if index % 2 == 0:
+            _write(os.path.join(places['status'], name), '')
+    return places
+
+def syscalls(proc='/proc'):
+    """Count the read and write system calls of this process so far
+
+    :params proc: string, where the proc filesystem is mounted
+    :returns: integer, or None if it cannot be read
+    """
+    try:
+        with open(os.path.join(proc, 'self', 'io')) as fp:
+            content = fp.read()
+    except (IOError, OSError):
+        return None
+    fields = dict(line.split(':') for line in content.splitlines() if ':' in line)
+    return int(fields['syscr']) + int(fields['syscw'])
+
+def rss(proc='/proc'):
+    """The resident memory of this process
+
+    :params proc: string, where the proc filesystem is mounted
+    :returns: integer, in bytes, or None if it cannot be read
+    """
+    sample = sampler.readSample(os.getpid(), 0, proc)
+    if sample is None:
+        return None
+    return sample.rss
+
+def summarize(latencies):
+    """Summarize tick latencies
+
+    :params latencies: non-empty list of numbers
+    :returns: dict with min, mean, p50, p95, max
+    """
+    ordered = sorted(latencies)
+    def _percentile(percent):
+        return ordered[max(int(math.ceil(len(ordered) * percent / 100)) - 1, 0)]
+    return dict(min=ordered[0], mean=sum(ordered) / len(ordered),
+                p50=_percentile(50), p95=_percentile(95), max=ordered[-1])
+
+def measure(name, tick, ticks, prepare=None, timer=timeit.default_timer):
+    """Measure ticks of periodic work
+
+    :params name: string, the kind of work
+    :params tick: function of no arguments, one tick of work
+    :params ticks: integer, number of ticks
+    :params prepare: function of no arguments, run (untimed) before each tick,
+                     or None
+    :params timer: a function of zero arguments, intended to return current time
+    :returns: dict with the name, ticks, latency, syscalls and rss
+    """
+    latencies = []
+    before = syscalls()
+    for _ in range(ticks):
+        if prepare is not None:
+            prepare()
+        start = timer()
+        tick()
+        latencies.append(timer() - start)
+    after = syscalls()
+    used = None
+    if before is not None and after is not None:
+        used = after - before
+    return dict(name=name, ticks=ticks, latency=summarize(latencies), syscalls=used, rss=rss())
+
+## pylint: disable=too-many-locals
+def run(location, count, ticks):
+    """Benchmark a synthetic colony
+
+    :params location: string, an empty directory
+    :params count: integer, number of processes
+    :params ticks: integer, number of ticks for each kind of work
+    :returns: list of results (see :py:func:`measure`)
+    """
+    places = generate(location, count)
+    clock = task.Clock()
+    clock.advance(time.time())
+    monitor = FakeMonitor()
+    receiver = process_events.Receiver(monitor, environ={}, reactor=clock)
+    confcheck = directory_monitor.checker(places['config'], receiver)
+    statcheck = directory_monitor.checker(places['config'], process_events.Receiver(
+        FakeMonitor(), environ={}, reactor=clock), stat=True)
+    messagecheck = directory_monitor.messages(places['messages'], receiver)
+    configPath = filepath.FilePath(places['config'])
+    changed = max(count // 100, 1)
+    counter = iter(range(sys.maxsize))
+    def _change():
+        for index in range(changed):
+            config = processConfig(index, places['status'])
+            config['args'].append(str(next(counter)))
+            _write(os.path.join(places['config'], 'process-%d' % index), json.dumps(config))
+    def _message():
+        for index in range(changed):
+            _write(os.path.join(places['messages'], 'restart-%d' % index),
+                   json.dumps(dict(type='RESTART', name='process-%d' % index)))
+    beatIndex = beatcheck.Index(configPath, clock.seconds())
+    directory_monitor.checker(places['config'], beatIndex)()
+    settings = httpcheck.Settings(reactor=clock, agent=FakeAgent())
+    httpIndex = httpcheck.Index(configPath, settings)
+    directory_monitor.checker(places['config'], httpIndex)()
+    def _period():
+        clock.advance(PERIOD)
+    ret = [measure('config-initial', confcheck, 1)]
+    statcheck()
+    ret.extend([
+        measure('config-steady', confcheck, ticks),
+        measure('config-steady-stat', statcheck, ticks),
+        measure('config-change', confcheck, ticks, prepare=_change),
+        measure('messages', messagecheck, ticks, prepare=_message),
+        measure('beatcheck', lambda: beatIndex.check(clock.seconds()), ticks, prepare=_period),
+        measure('httpcheck', httpIndex.check, ticks, prepare=_period),
+    ])
+    return ret
+## pylint: enable=too-many-locals
+
+PARSER = argparse.ArgumentParser(prog='python -m ncolony benchmark')
+PARSER.add_argument('--processes', type=int, action='append',
+                    help='number of processes (can be given several times)')
+PARSER.add_argument('--ticks', type=int, default=10, help='ticks of each kind of work')
+PARSER.add_argument('--directory', help='where to generate the colonies '
+                    '(default: a temporary directory)')
+PARSER.add_argument('--output', help='file to write the results to (default: standard output)')
+
+@mainlib.COMMANDS.register(name='benchmark')
+def main(argv):
+    """command-line entry point
+
+        --processes: number of processes (can be given several times,
+                     default: 100, 1000 and 10000)
+
+        --ticks: ticks of each kind of work (default: 10)
+
+        --directory: where to generate the colonies (default: a temporary directory)
+
+        --output: file to write the results to (default: standard output)
+    """
+    args = PARSER.parse_args(argv[1:])
+    counts = args.processes or [100, 1000, 10000]
+    directory = args.directory
+    if directory is None:
+        directory = tempfile.mkdtemp(prefix='ncolony-benchmark-')
+    results = []
+    try:
+        for count in counts:
+            location = os.path.join(directory, str(count))
+            results.append(dict(processes=count, results=run(location, count, args.ticks)))
+    finally:
+        if args.directory is None:
+            shutil.rmtree(directory)
+    report = dict(ncolony=ncolony.__version__, python=platform.python_version(),
+                  ticks=args.ticks, colonies=results)
+    content = json.dumps(report, indent=4, sort_keys=True)
+    if args.output is None:
+        print(content)
+    else:
+        _write(args.output, content + '\n')
@@ -5,11 +5,26 @@
 =====================
 
 A heart beater.
+
+By default, a heart touches its status file. If the
+:code:`ncolony.beatcheck` section has :code:`"transport": "datagram"`,
+it sends its name to the beatcheck's Unix datagram :code:`socket` instead.
+
+With :code:`"transport": "mmap"`, it writes the monotonic time into
+its slot (given by the monitor in :code:`NCOLONY_HEART_SLOT`) of the
+beatcheck's memory-mapped :code:`table`. Each slot is
+:code:`SLOT_SIZE` bytes: the time, as a little-endian double, followed
+by the UTF-8 encoded name, padded with zeros. Names longer than
+248 bytes do not fit, so processes with such names should use
+another transport.
 """
-from __future__ import division
 
 import json
+import mmap
 import os
+import socket
+import struct
+import time
 
 from twisted.python import filepath
 from twisted.application import internet as tainternet, service as taservice
@@ -31,6 +46,75 @@ class Heart(object):
         """Touch the file"""
         self.path.touch()
 
+class DatagramHeart(object):
+
+    """A Heart that beats over a Unix datagram socket.
+
+    Each beat sends the name to the socket. Beats which
+    cannot be sent (for example, because the beatcheck is not
+    running) are lost.
+    """
+    def __init__(self, address, name):
+        self.address = address
+        self.name = name.encode('utf-8')
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.socket.setblocking(False)
+
+    def getAddress(self):
+        """Get the socket being sent to"""
+        return self.address
+
+    def beat(self):
+        """Send the name"""
+        try:
+            self.socket.sendto(self.name, self.address)
+        except (IOError, OSError):
+            pass
+
+SLOT_FORMAT = '<d248s'
+SLOT_SIZE = struct.calcsize(SLOT_FORMAT)
+_TIME_FORMAT = '<d'
+
+class TableHeart(object):
+
+    """A Heart that beats into a shared memory table.
+
+    The table is opened on the first beat which finds it,
+    at which point the name is written to the slot.
+    After that, each beat only writes to memory.
+    """
+    def __init__(self, path, slot, name, timer=time.monotonic):
+        self.path = path
+        self.slot = slot
+        self.name = name.encode('utf-8')
+        self.timer = timer
+        self.table = None
+
+    def getAddress(self):
+        """Get the table and slot being written to"""
+        return self.path, self.slot
+
+    def _open(self):
+        try:
+            fd = os.open(self.path, os.O_RDWR)
+        except OSError:
+            return
+        try:
+            if os.fstat(fd).st_size < (self.slot + 1) * SLOT_SIZE:
+                return
+            self.table = mmap.mmap(fd, 0)
+        finally:
+            os.close(fd)
+        struct.pack_into(SLOT_FORMAT, self.table, self.slot * SLOT_SIZE, 0, self.name)
+
+    def beat(self):
+        """Write the time"""
+        if self.table is None:
+            self._open()
+            if self.table is None:
+                return
+        struct.pack_into(_TIME_FORMAT, self.table, self.slot * SLOT_SIZE, self.timer())
+
 def makeService():
     """Make a service
 
@@ -43,6 +127,14 @@ def makeService():
     params = config.get('ncolony.beatcheck')
     if params is None:
         return
+    transport = params.get('transport', 'file')
+    if transport == 'datagram':
+        heart = DatagramHeart(params['socket'], os.environ['NCOLONY_NAME'])
+        return tainternet.TimerService(params['period']/3, heart.beat)
+    if transport == 'mmap':
+        heart = TableHeart(params['table'], int(os.environ['NCOLONY_HEART_SLOT']),
+                           os.environ['NCOLONY_NAME'])
+        return tainternet.TimerService(params['period']/3, heart.beat)
     myFilePath = filepath.FilePath(params['status'])
     if myFilePath.isdir():
         name = os.environ['NCOLONY_NAME']
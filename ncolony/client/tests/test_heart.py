@@ -2,10 +2,10 @@
 # See LICENSE for details.
 """ncolony.tests.test_heart -- test heart service"""
 
-from __future__ import division
-
 import json
 import os
+import socket
+import struct
 import unittest
 
 from twisted.python import filepath
@@ -107,6 +107,81 @@ class TestHeart(unittest.TestCase):
         myHeart.beat()
         self.assertEquals(fake.touched, 2)
 
+    def test_datagram_heart(self):
+        """Test the DatagramHeart class"""
+        address = os.path.abspath('dummy-heart.sock')
+        if os.path.exists(address):
+            os.remove(address)
+        myHeart = heart.DatagramHeart(address, u'hello')
+        self.addCleanup(myHeart.socket.close)
+        self.assertEquals(myHeart.getAddress(), address)
+        myHeart.beat()
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        self.addCleanup(server.close)
+        server.bind(address)
+        self.addCleanup(os.remove, address)
+        myHeart.beat()
+        myHeart.beat()
+        self.assertEquals(server.recv(100), b'hello')
+        self.assertEquals(server.recv(100), b'hello')
+
+    def test_make_service_datagram(self):
+        """Test make service builds a datagram heart based on os.environ"""
+        params = dict(transport='datagram', socket='beats.sock', period=10, grace=3)
+        myEnv = buildEnv(params=params)
+        myEnv['NCOLONY_NAME'] = 'hello'
+        replaceEnvironment(self, myEnv)
+        service = heart.makeService()
+        self.assertIsInstance(service, tainternet.TimerService)
+        self.assertEquals(service.step, 10/3)
+        func, dummyArgs, dummyKwargs = service.call
+        myHeart = _getSelf(func)
+        self.addCleanup(myHeart.socket.close)
+        self.assertIsInstance(myHeart, heart.DatagramHeart)
+        self.assertEquals(myHeart.getAddress(), 'beats.sock')
+        self.assertEquals(myHeart.name, b'hello')
+
+    def test_table_heart(self):
+        """Test the TableHeart class"""
+        path = os.path.abspath('dummy-heart.table')
+        if os.path.exists(path):
+            os.remove(path)
+        self.addCleanup(lambda: os.path.exists(path) and os.remove(path))
+        times = iter([5.0, 6.0])
+        myHeart = heart.TableHeart(path, 1, u'hello', timer=lambda: next(times))
+        self.assertEquals(myHeart.getAddress(), (path, 1))
+        myHeart.beat()
+        with open(path, 'wb') as fp:
+            fp.write(b'\xff' * heart.SLOT_SIZE)
+        myHeart.beat()
+        self.assertIsNone(myHeart.table)
+        with open(path, 'ab') as fp:
+            fp.write(b'\xff' * heart.SLOT_SIZE)
+        myHeart.beat()
+        self.addCleanup(myHeart.table.close)
+        myHeart.beat()
+        with open(path, 'rb') as fp:
+            content = fp.read()
+        first, second = struct.iter_unpack(heart.SLOT_FORMAT, content)
+        self.assertEquals(first[1], b'\xff' * 248)
+        self.assertEquals(second, (6.0, b'hello' + b'\0' * 243))
+
+    def test_make_service_table(self):
+        """Test make service builds a table heart based on os.environ"""
+        params = dict(transport='mmap', table='beats', period=10, grace=3)
+        myEnv = buildEnv(params=params)
+        myEnv['NCOLONY_NAME'] = 'hello'
+        myEnv['NCOLONY_HEART_SLOT'] = '5'
+        replaceEnvironment(self, myEnv)
+        service = heart.makeService()
+        self.assertIsInstance(service, tainternet.TimerService)
+        self.assertEquals(service.step, 10/3)
+        func, dummyArgs, dummyKwargs = service.call
+        myHeart = _getSelf(func)
+        self.assertIsInstance(myHeart, heart.TableHeart)
+        self.assertEquals(myHeart.getAddress(), ('beats', 5))
+        self.assertEquals(myHeart.name, b'hello')
+
     def test_make_service(self):
         """Test make service builds the service based on os.environ"""
         myEnv = buildEnv()
@@ -0,0 +1,163 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Check TCP and Unix socket servers for responsiveness
+
+This is a lighter sibling of :py:mod:`ncolony.httpcheck`, for
+processes which do not speak HTTP. The configuration section
+is :code:`ncolony.connectcheck`, with the same :code:`period`,
+:code:`grace`, :code:`maxBad` and :code:`timeout` keys, but instead
+of :code:`url` it has an :code:`endpoint` -- a Twisted client endpoint
+description, like :code:`tcp:host=localhost:port=6379` or
+:code:`unix:path=/run/service.sock`.
+
+A check connects to the endpoint. If the section has a :code:`send`
+string, it is written once connected. If it has an :code:`expect`
+string, the check succeeds once it was received; otherwise, the check
+succeeds as soon as the connection is made. Either way, the connection
+is closed right after.
+"""
+
+from twisted.application import internet as tainternet
+from twisted.internet import defer, endpoints, protocol, reactor
+from twisted.python import failure
+
+from ncolony import beatcheck
+from ncolony import httpcheck
+from ncolony import instrument
+from ncolony.client import heart
+
+class _Probe(protocol.Protocol):
+
+    """Send some bytes, and wait for some bytes"""
+
+    def __init__(self, send, expect):
+        self.send = send
+        self.expect = expect
+        self.received = b''
+        self.done = defer.Deferred()
+
+    def connectionMade(self):
+        """Send the bytes, if any, and finish if there is nothing to expect"""
+        if self.send:
+            self.transport.write(self.send)
+        if not self.expect:
+            self._finish()
+
+    def dataReceived(self, data):
+        """Finish once the expected bytes arrived"""
+        if self.done.called:
+            return
+        self.received += data
+        if self.expect in self.received:
+            self._finish()
+            return
+        self.received = self.received[-len(self.expect):]
+
+    def connectionLost(self, reason=protocol.connectionDone):
+        """Fail, unless already done"""
+        self.failed(reason)
+
+    def failed(self, reason):
+        """Fail, unless already done
+
+        :params reason: a Failure
+        """
+        if not self.done.called:
+            self.done.errback(reason)
+
+    def _finish(self):
+        self.done.callback(None)
+        self.transport.loseConnection()
+
+def _encode(value):
+    if value is None:
+        return None
+    return value.encode('utf-8')
+
+class State(httpcheck.State):
+
+    """State of a connect check
+
+    The endpoint description is kept in :code:`url`, so that everything
+    which only cares whether there is a check at all does not need to
+    know which kind it is.
+    """
+
+    __slots__ = ('send', 'expect')
+
+    KEY = 'ncolony.connectcheck'
+
+    def __init__(self, location, settings):
+        super(State, self).__init__(location, settings)
+        self.send = None
+        self.expect = None
+
+    def _configure(self, config):
+        self.url = config['endpoint']
+        self.send = _encode(config.get('send'))
+        self.expect = _encode(config.get('expect'))
+
+    def _host(self):
+        return self.url
+
+    def _probe(self):
+        endpoint = endpoints.clientFromString(self.settings.reactor, self.url)
+        probe = _Probe(self.send, self.expect)
+        connecting = endpoints.connectProtocol(endpoint, probe)
+        connecting.addErrback(probe.failed)
+        def _cancel(dummyDeferred):
+            connecting.cancel()
+            if probe.transport is not None:
+                probe.transport.abortConnection()
+            probe.failed(failure.Failure(defer.CancelledError()))
+        ret = defer.Deferred(_cancel)
+        probe.done.chainDeferred(ret)
+        return ret
+
+def makeIndex(opt, path, limiter=None):
+    """Make an index of connect checks
+
+    :params opt: dictionary-like object with the limit options
+    :params path: a twisted.python.filepath.FilePath with configurations
+    :params limiter: httpcheck.Limiter shared with other checks, or None to
+                     make one from opt
+    :returns: httpcheck.Index
+    """
+    if limiter is None:
+        limiter = httpcheck.makeLimiter(opt)
+    settings = httpcheck.Settings(reactor=reactor, agent=None, limiter=limiter)
+    return httpcheck.Index(path, settings, stateFactory=State)
+
+def makeService(opt):
+    """Make a service
+
+    :params opt: dictionary-like object with 'freq', 'config' and 'messages'
+    :returns: twisted.application.internet.TimerService that at opt['freq']
+              checks for stale processes in opt['config'], and sends
+              restart messages through opt['messages']
+    """
+    restarter, path = beatcheck.parseConfig(opt)
+    index = makeIndex(opt, path)
+    restarter, runner, services, instrumentation = instrument.instrumentCheck(
+        opt, 'connectcheck', restarter, httpcheck.run)
+    connectcheck = tainternet.TimerService(opt['freq'], runner, restarter, index.check)
+    connectcheck.setName('connectcheck')
+    master = heart.wrapHeart(connectcheck)
+    beatcheck.watchConfig(master, opt, path, index, 'connectcheck', instrumentation)
+    for service in services:
+        service.setServiceParent(master)
+    return master
+
+## pylint: disable=too-few-public-methods
+
+class Options(beatcheck.CheckOptions):
+
+    """Options for ncolony connectcheck service"""
+
+    optParameters = [
+        ["max-in-flight", None, None, "Maximum number of checks in flight", int],
+        ["max-per-host", None, None, "Maximum number of checks in flight to an endpoint", int],
+    ]
+
+## pylint: enable=too-few-public-methods
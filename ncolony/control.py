@@ -0,0 +1,201 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+"""ncolony.control
+==================
+
+A control channel for the ncolony service.
+
+.. code-block:: bash
+
+  $ twistd ncolony --config <dir> --messages <dir> --control <socket>
+
+Will listen on a Unix socket for commands, in addition to watching
+the directories. Each command is one line of JSON, and is answered
+by one line of JSON, in order, so several commands can be sent
+without waiting for the answers.
+
+Commands have a :code:`type`:
+
+ * :code:`ADD` -- :code:`name` and :code:`config`, the process's configuration
+ * :code:`REMOVE` -- :code:`name`
+ * :code:`RESTART` -- :code:`name`
+ * :code:`RESTART-ALL`
+ * :code:`RESTART-ROLLING` -- optionally :code:`batch`, :code:`percent`,
+   :code:`max_in_flight`, :code:`gate`, :code:`interval` and :code:`timeout`
+ * :code:`STATUS`
+ * :code:`SAMPLES` -- :code:`name`
+
+The answer has :code:`ok` set to true if the command took effect,
+and false (with the reason in :code:`error`) otherwise: for example,
+if a configuration could not be applied, or a restart was suppressed
+by coalescing or the cooldown. Answers to :code:`ADD` and
+:code:`REMOVE` have :code:`queued` set to true if the configuration
+was written but the change waits for a later batch
+(see :code:`--batch-size`), and false if it was applied. Answers to
+:code:`STATUS` carry the :code:`processes`. When the service samples
+resource use (:code:`--sample-frequency`), each process also has its
+latest :code:`resources`, and answers to :code:`SAMPLES` carry all
+the kept :code:`samples` of the process
+(see :py:mod:`ncolony.sampler`). An :code:`id` in the command is
+copied to the answer.
+
+Added and removed processes are still written to the configuration
+directory, so they survive a restart of the service. Restarts are
+written to the messages directory, and go through the same coalescing
+and cooldown (see :code:`--restart-cooldown`) as other messages.
+"""
+
+import functools
+import itertools
+import json
+import os
+
+from twisted.internet import protocol
+from twisted.protocols import basic
+from twisted.python import filepath, log
+
+NEXT = functools.partial(next, itertools.count(0))
+
+def _dumps(stuff):
+    return json.dumps(stuff).encode('utf-8')
+
+class Controller(object):
+
+    """Carry out control commands
+
+    :param config: string, location of configuration directory
+    :param check: the configuration checker, accepting a list of names
+    :param messages: string, location of messages directory
+    :param messageCheck: the messages checker, accepting a list of names
+    :param receiver: the process_events.Receiver
+    :param monitor: the ProcessMonitor
+    :param sampler: the sampler.Sampler, or None
+    """
+
+    ## pylint: disable=too-many-arguments
+    def __init__(self, config, check, messages, messageCheck, receiver, monitor, sampler=None):
+        self.config = filepath.FilePath(config)
+        self.check = check
+        self.messages = filepath.FilePath(messages)
+        self.messageCheck = messageCheck
+        self.receiver = receiver
+        self.monitor = monitor
+        self.sampler = sampler
+    ## pylint: enable=too-many-arguments
+
+    def _child(self, name):
+        if name.startswith('.') or name.endswith('.new'):
+            raise ValueError('invalid name', name)
+        return self.config.child(name)
+
+    def handle(self, command):
+        """Carry out a command
+
+        :param command: dict, parsed command
+        :returns: dict, details to add to the answer
+        :raises: ValueError, KeyError or EnvironmentError if the
+                 command could not be carried out
+        """
+        tp = command['type']
+        if tp == 'ADD':
+            self._child(command['name']).setContent(_dumps(command['config']))
+            return self._applied(command['name'])
+        elif tp == 'REMOVE':
+            self._child(command['name']).remove()
+            return self._applied(command['name'])
+        elif tp in ('RESTART', 'RESTART-ALL', 'RESTART-ROLLING'):
+            name = '%03dControl.%s' % (NEXT(), os.getpid())
+            self.messages.child(name).setContent(_dumps(command))
+            if name not in self.messageCheck([name]):
+                raise ValueError('restart suppressed by coalescing or cooldown', command)
+        elif tp == 'STATUS':
+            return dict(processes=self.status())
+        elif tp == 'SAMPLES':
+            if self.sampler is None:
+                raise ValueError('not sampling', command)
+            return dict(samples=self.sampler.recent(command['name']))
+        else:
+            raise ValueError('unknown type', command)
+        return {}
+
+    def _applied(self, name):
+        self.check([name])
+        error = self.receiver.errors.get(name)
+        if error is not None:
+            raise ValueError('could not apply configuration', name, error)
+        return dict(queued=name in self.receiver.queue)
+
+    def status(self):
+        """Describe monitored processes
+
+        :returns: dict mapping names to dicts with args and pid
+                  (None if the process is not running), and resources
+                  if sampling
+        """
+        ret = {}
+        for name, params in self.receiver.processes.items():
+            proto = self.monitor.protocols.get(name)
+            pid = None
+            if proto is not None and proto.transport is not None:
+                pid = proto.transport.pid
+            ret[name] = dict(args=params['args'], pid=pid)
+            if self.sampler is not None:
+                ret[name]['resources'] = self.sampler.summary(name)
+        return ret
+
+
+class ControlProtocol(basic.LineOnlyReceiver):
+
+    """Answer each line of JSON with a line of JSON
+
+    A line longer than MAX_LENGTH is answered with an error, and the
+    connection is closed.
+    """
+
+    delimiter = b'\n'
+    MAX_LENGTH = 2 ** 20
+
+    def lineReceived(self, line):
+        """Carry out a command, and answer
+
+        :param line: bytes, JSON-encoded command
+        """
+        answer = {}
+        commandID = None
+        try:
+            command = json.loads(line.decode('utf-8'))
+            commandID = command.get('id')
+            answer.update(self.factory.controller.handle(command))
+        ## pylint: disable=broad-except
+        except Exception as e:
+            log.msg("Control command failed: ", repr(line), repr(e))
+            answer.update(ok=False, error=repr(e))
+        ## pylint: enable=broad-except
+        else:
+            answer['ok'] = True
+        if commandID is not None:
+            answer['id'] = commandID
+        self.sendLine(_dumps(answer))
+
+    def lineLengthExceeded(self, line):
+        """Answer with an error, and close the connection
+
+        :param line: bytes, the start of the line
+        """
+        log.msg("Control command too long: ", len(line))
+        self.sendLine(_dumps(dict(ok=False, error='command longer than %d bytes' %
+                                  self.MAX_LENGTH)))
+        self.transport.loseConnection()
+
+
+class ControlFactory(protocol.Factory):
+
+    """Build control protocols
+
+    :param controller: a Controller
+    """
+
+    protocol = ControlProtocol
+
+    def __init__(self, controller):
+        self.controller = controller
@@ -30,6 +30,15 @@ Restart also needs just the name.
 
 Restart-all does not need even the name, since it restarts
 all processes.
+
+Restart-rolling also restarts all processes, but only a few at a
+time, waiting for each batch to come back before restarting the next.
+
+When the service listens on a control socket, passing a ControlPlaces
+(with the socket's location) instead of Places sends the commands
+through the socket. Each function then returns only once the service
+has carried out the command, and raises ControlError if it could not.
+Status is only available through the control socket.
 """
 
 import argparse
@@ -38,6 +47,7 @@ import functools
 import itertools
 import json
 import os
+import socket
 
 from twisted.python import filepath
 
@@ -47,9 +57,40 @@ NEXT = functools.partial(next, itertools.count(0))
 
 Places = collections.namedtuple('Places', 'config messages')
 
+ControlPlaces = collections.namedtuple('ControlPlaces', 'config messages control')
+
+TIMEOUT = 30
+
+class ControlError(Exception):
+
+    """The service could not carry out a command"""
+
 def _dumps(stuff):
     return json.dumps(stuff).encode('utf-8')
 
+def _control(places):
+    return getattr(places, 'control', None)
+
+def _command(places, command):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(TIMEOUT)
+        sock.connect(places.control)
+        sock.sendall(_dumps(command) + b'\n')
+        fp = sock.makefile('rb')
+        try:
+            line = fp.readline()
+        finally:
+            fp.close()
+    finally:
+        sock.close()
+    if not line:
+        raise ControlError('no answer', command)
+    answer = json.loads(line.decode('utf-8'))
+    if not answer.pop('ok'):
+        raise ControlError(answer['error'], command)
+    return answer
+
 ## pylint: disable=too-many-arguments
 def add(places, name, cmd, args, env=None, uid=None, gid=None, extras=None):
     """Add a process.
@@ -80,6 +121,9 @@ def add(places, name, cmd, args, env=None, uid=None, gid=None, extras=None):
         details['gid'] = gid
     if extras is not None:
         details.update(extras)
+    if _control(places) is not None:
+        _command(places, dict(type='ADD', name=fle.basename(), config=details))
+        return
     content = _dumps(details)
     fle.setContent(content)
 ## pylint: enable=too-many-arguments
@@ -91,11 +135,17 @@ def remove(places, name):
     :params name: string, the logical name of the process
     :returns: None
     """
+    if _control(places) is not None:
+        _command(places, dict(type='REMOVE', name=name))
+        return
     config = filepath.FilePath(places.config)
     fle = config.child(name)
     fle.remove()
 
 def _addMessage(places, content):
+    if _control(places) is not None:
+        _command(places, json.loads(content.decode('utf-8')))
+        return
     messages = filepath.FilePath(places.messages)
     name = '%03dMessage.%s' % (NEXT(), os.getpid())
     message = messages.child(name)
@@ -120,6 +170,40 @@ def restartAll(places):
     content = _dumps(dict(type='RESTART-ALL'))
     _addMessage(places, content)
 
+## pylint: disable=too-many-arguments
+def restartRolling(places, batch=None, percent=None, maxInFlight=None, gate=False,
+                   interval=None, timeout=None):
+    """Restart all processes, a few at a time
+
+    :params places: a Places instance
+    :params batch: integer, number of processes to restart at once
+    :params percent: number, batch size as a percentage of the processes
+    :params maxInFlight: integer, maximum number of processes restarting
+                         at the same time
+    :params gate: boolean, whether to wait for processes to be healthy
+    :params interval: number, seconds between checks on restarting processes
+    :params timeout: number, seconds to wait for a process to come back
+    :returns: None
+    """
+    details = dict(type='RESTART-ROLLING', batch=batch, percent=percent,
+                   max_in_flight=maxInFlight, gate=gate, interval=interval,
+                   timeout=timeout)
+    details = {key: value for key, value in details.items() if value is not None}
+    content = _dumps(details)
+    _addMessage(places, content)
+## pylint: enable=too-many-arguments
+
+def status(places):
+    """Get the status of all processes
+
+    :params places: a ControlPlaces instance
+    :returns: dict mapping names to dicts with args and
+              pid (None if the process is not running)
+    """
+    if _control(places) is None:
+        raise ValueError("status needs a control socket", places)
+    return _command(places, dict(type='STATUS'))['processes']
+
 def _parseJSON(fname):
     with open(fname) as fp:
         data = fp.read()
@@ -128,15 +212,26 @@ def _parseJSON(fname):
 PARSER = argparse.ArgumentParser()
 PARSER.add_argument('--messages', required=True)
 PARSER.add_argument('--config', required=True)
+PARSER.add_argument('--control')
 _subparsers = PARSER.add_subparsers()
 _restart_all_parser = _subparsers.add_parser('restart-all')
 _restart_all_parser.set_defaults(func=restartAll)
+_restart_rolling_parser = _subparsers.add_parser('restart-rolling')
+_restart_rolling_parser.add_argument('--batch', type=int)
+_restart_rolling_parser.add_argument('--percent', type=float)
+_restart_rolling_parser.add_argument('--max-in-flight', dest='maxInFlight', type=int)
+_restart_rolling_parser.add_argument('--gate', action='store_true')
+_restart_rolling_parser.add_argument('--interval', type=float)
+_restart_rolling_parser.add_argument('--timeout', type=float)
+_restart_rolling_parser.set_defaults(func=restartRolling)
 _restart_parser = _subparsers.add_parser('restart')
 _restart_parser.add_argument('name')
 _restart_parser.set_defaults(func=restart)
 _remove_parser = _subparsers.add_parser('remove')
 _remove_parser.add_argument('name')
 _remove_parser.set_defaults(func=remove)
+_status_parser = _subparsers.add_parser('status')
+_status_parser.set_defaults(func=status)
 _add_parser = _subparsers.add_parser('add')
 _add_parser.add_argument('name')
 _add_parser.add_argument('--cmd', required=True)
@@ -151,12 +246,15 @@ def call(results):
     """Call results.func on the attributes of results
 
     :params result: dictionary-like object
-    :returns: None
+    :returns: the result of the function
     """
     results = vars(results)
     places = Places(config=results.pop('config'), messages=results.pop('messages'))
+    control = results.pop('control', None)
+    if control is not None:
+        places = ControlPlaces(control=control, **places._asdict())
     func = results.pop('func')
-    func(places, **results)
+    return func(places, **results)
 
 @mainlib.COMMANDS.register(name='ctl')
 def main(argv):
@@ -166,6 +264,8 @@ def main(argv):
 
         --config: configuration directory
 
+        --control: control socket (optional)
+
     subcommands:
         add:
             name (positional)
@@ -186,6 +286,22 @@ def main(argv):
             name (positional)
         restart-all:
             no arguments
+        restart-rolling:
+            --batch -- number of processes to restart at once
+
+            --percent -- batch size as a percentage of the processes
+
+            --max-in-flight -- maximum number of processes restarting at once
+
+            --gate -- wait for health checks before moving on
+
+            --interval -- seconds between checks
+
+            --timeout -- seconds to wait for each process
+        status:
+            no arguments, needs --control
     """
     ns = PARSER.parse_args(argv[1:])
-    call(ns)
+    result = call(ns)
+    if result is not None:
+        print(json.dumps(result, indent=4, sort_keys=True))
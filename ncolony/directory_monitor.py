@@ -6,65 +6,260 @@
 Monitor directories for configuration and messages
 """
 
+import errno
 import functools
+import hashlib
+import json
 import os
+import time
 
 from twisted.python import filepath
+from twisted.application import service as taservice
 
-def checker(location, receiver):
+try:
+    from twisted.internet import inotify
+except ImportError: # pragma: no cover
+    inotify = None
+
+def _readContent(child):
+    try:
+        return child.getContent()
+    except (IOError, OSError) as e:
+        if e.errno != errno.ENOENT:
+            raise
+        return None
+
+def _signature(stat):
+    return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+def _statSignature(child):
+    try:
+        return _signature(os.stat(child.path))
+    except OSError:
+        return None
+
+def _scan(location):
+    ret = {}
+    for entry in os.scandir(location):
+        if entry.name.endswith('.new'):
+            continue
+        try:
+            ret[entry.name] = _signature(entry.stat())
+        except OSError:
+            continue
+    return ret
+
+def _update(path, receiver, filesContents, fname, signature, force=False):
+    oldSignature, oldDigest = filesContents.get(fname, (None, None))
+    if not force and signature is not None and signature == oldSignature:
+        return
+    newContents = _readContent(path.child(fname))
+    newDigest = None
+    if newContents is not None:
+        newDigest = hashlib.sha256(newContents).digest()
+        filesContents[fname] = signature, newDigest
+    if newDigest == oldDigest:
+        return
+    if oldDigest is not None:
+        if newDigest is None:
+            del filesContents[fname]
+        receiver.remove(fname)
+    if newDigest is not None:
+        receiver.add(fname, newContents)
+
+def checker(location, receiver, stat=False):
     """Construct a function that checks a directory for process configuration
 
     The function checks for additions or removals
     of JSON process configuration files and calls the appropriate receiver
     methods.
 
+    Only a hash of each file's contents is kept. By default, every file
+    is read and hashed on every scan. In stat mode, the scan only
+    looks at each file's modification time, size and inode, and reads
+    the file only if one of those changed.
+
+    When called with no arguments, the function scans the whole directory.
+    It can also be called with a list of file names, in which case only
+    those files are checked -- this is how a :py:class:`Watcher` passes on
+    the names it was notified about. Named files are always read.
+
+    The events from each call are sent to the receiver as one batch,
+    between calls to its begin and commit methods.
+
     :param location: string, the directory to monitor
     :param receiver: IEventReceiver
-    :returns: a function with no parameters
+    :param stat: boolean, whether to use stat mode
+    :returns: a function with an optional names parameter
     """
     path = filepath.FilePath(location)
-    files = set()
     filesContents = {}
-    def _check(path):
-        currentFiles = set(fname for fname in os.listdir(location) if not fname.endswith('.new'))
-        removed = files - currentFiles
-        added = currentFiles - files
-        for fname in added:
-            contents = path.child(fname).getContent()
-            filesContents[fname] = contents
-            receiver.add(fname, contents)
-        for fname in removed:
-            receiver.remove(fname)
-        same = currentFiles & files
-        for fname in same:
-            newContents = path.child(fname).getContent()
-            oldContents = filesContents[fname]
-            if newContents == oldContents:
-                continue
-            receiver.remove(fname)
-            filesContents[fname] = newContents
-            receiver.add(fname, newContents)
-        files.clear()
-        files.update(currentFiles)
+    def _checkNames(path, names):
+        for fname in names:
+            signature = None
+            if stat:
+                signature = _statSignature(path.child(fname))
+            _update(path, receiver, filesContents, fname, signature, force=True)
+    def _checkAll(path):
+        if stat:
+            signatures = _scan(location)
+        else:
+            signatures = dict.fromkeys(fname for fname in os.listdir(location)
+                                       if not fname.endswith('.new'))
+        for fname in sorted(set(signatures) | set(filesContents)):
+            _update(path, receiver, filesContents, fname, signatures.get(fname))
+    def _check(path, names=None):
+        receiver.begin()
+        try:
+            if names is None:
+                _checkAll(path)
+            else:
+                _checkNames(path, names)
+        finally:
+            receiver.commit()
     return functools.partial(_check, path)
 
-def messages(location, receiver):
+def _restartTarget(content):
+    try:
+        parsed = json.loads(content.decode('utf-8'))
+    except ValueError:
+        return None, None
+    if not isinstance(parsed, dict):
+        return None, None
+    return parsed.get('type'), parsed.get('name')
+
+def messages(location, receiver, cooldown=0, timer=time.time):
     """Construct a function that checks a directory for messages
 
     The function checks for new messages and
-    calls the appropriate method on the receiver. Sent messages are
-    deleted.
+    calls the appropriate method on the receiver, in order of
+    file name. Sent messages are deleted.
+
+    When called with no arguments, the function sweeps the whole
+    directory. It can also be called with a list of file names, as
+    passed on by a :py:class:`Watcher`, in which case only those
+    messages are sent.
+
+    Restart messages found in the same call are coalesced: only the
+    first restart of each process is sent, and none are sent if there
+    is also a restart-all message (only the first of which is sent).
+    A restart of a process which was restarted less than cooldown
+    seconds ago (by itself, or by a restart-all) is not sent either.
+    Messages which are not sent are still deleted. The function
+    returns the names of the messages which were sent.
 
     :param location: string, the directory to monitor
     :param receiver: IEventReceiver
-    :returns: a function with no parameters
+    :param cooldown: number, seconds to ignore restarts of a process
+                     after it was restarted
+    :param timer: a function of zero arguments, intended to return current time
+    :returns: a function with an optional names parameter
     """
     path = filepath.FilePath(location)
-    def _check(path):
-        messageFiles = path.globChildren('*')
-        for message in messageFiles:
-            if message.basename().endswith('.new'):
+    lastRestart = {}
+    def _isCooling(name, now):
+        last = max(lastRestart.get(name, -float('inf')), lastRestart.get(None, -float('inf')))
+        return now - last < cooldown
+    def _check(path, names=None):
+        if names is None:
+            names = os.listdir(location)
+        batch = []
+        for name in sorted(names):
+            if name.startswith('.') or name.endswith('.new'):
                 continue
-            receiver.message(message.getContent())
+            message = path.child(name)
+            content = _readContent(message)
+            if content is None:
+                continue
+            batch.append((message, content) + _restartTarget(content))
+        restartAll = any(entry[2] == 'RESTART-ALL' for entry in batch)
+        now = timer()
+        seen = set()
+        sent = []
+        for message, content, tp, name in batch:
+            send = True
+            if tp == 'RESTART':
+                send = not restartAll and name not in seen and not _isCooling(name, now)
+                seen.add(name)
+            elif tp == 'RESTART-ALL':
+                send = None not in seen
+                seen.add(None)
+            if send:
+                receiver.message(content)
+                sent.append(message.basename())
+                if tp == 'RESTART':
+                    lastRestart[name] = now
+                elif tp == 'RESTART-ALL':
+                    lastRestart[None] = now
             message.remove()
+        return sent
     return functools.partial(_check, path)
+
+CONFIG_MASK = MESSAGES_MASK = 0
+if inotify is not None: # pragma: no branch
+    CONFIG_MASK = (inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO |
+                   inotify.IN_DELETE | inotify.IN_MOVED_FROM)
+    MESSAGES_MASK = inotify.IN_CLOSE_WRITE | inotify.IN_MOVED_TO
+
+class Watcher(taservice.Service):
+
+    """Call a checker with the names inotify reports as changed
+
+    Names reported in the same reactor iteration are collected, and
+    passed to the checker together, in sorted order. Changes which
+    are never reported (for example, because the kernel queue
+    overflowed) are picked up by the periodic full scan, which
+    should still be running, at a lower frequency.
+
+    :param location: string, the directory to watch
+    :param check: function accepting a list of names
+    :param mask: inotify event mask
+    :param reactor: an IReactorFDSet and IReactorTime
+    """
+
+    def __init__(self, location, check, mask=CONFIG_MASK, reactor=None):
+        if reactor is None:
+            from twisted.internet import reactor
+        self.location = location
+        self.check = check
+        self.mask = mask
+        self.reactor = reactor
+        self.notifier = None
+        self.pending = set()
+        self.call = None
+
+    def startService(self):
+        """Start watching the directory"""
+        taservice.Service.startService(self)
+        self.notifier = inotify.INotify(self.reactor)
+        self.notifier.startReading()
+        self.notifier.watch(filepath.FilePath(self.location), mask=self.mask,
+                            callbacks=[self.notify])
+
+    def stopService(self):
+        """Stop watching the directory"""
+        taservice.Service.stopService(self)
+        self.notifier.loseConnection()
+        self.notifier = None
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
+        self.pending.clear()
+
+    def notify(self, dummyWatch, path, dummyMask):
+        """Note a changed name, and schedule a check
+
+        :param path: a twisted.python.filepath.FilePath
+        """
+        name = path.asTextMode().basename()
+        if name.endswith('.new'):
+            return
+        self.pending.add(name)
+        if self.call is None:
+            self.call = self.reactor.callLater(0, self._flush)
+
+    def _flush(self):
+        self.call = None
+        names = sorted(self.pending)
+        self.pending.clear()
+        self.check(names)
@@ -0,0 +1,165 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Check processes' health in one service
+
+Running :py:mod:`ncolony.beatcheck`, :py:mod:`ncolony.httpcheck` and
+:py:mod:`ncolony.connectcheck` as separate services means each one
+scans (and reads) the configuration directory on its own, and
+each one asks for a restart of a process which fails its checks.
+
+This service scans the configuration once, passing the changes
+on to every kind of check, and checks them all on the same tick.
+A process which fails several checks on the same tick is only
+restarted once. A check which fails (or whose receiver fails) is
+logged, and does not stop the other checks. The limits on checks
+in flight (:code:`--max-in-flight` and :code:`--max-per-host`) are
+shared by all the kinds of checks.
+
+The kinds of checks are in :py:data:`CHECKS`, which maps a name to a
+function of the options, the configuration path and the shared
+:py:class:`ncolony.httpcheck.Limiter` (or None). The function
+returns the receiver which is kept up to date with the configuration,
+a function of the current time returning the names of processes
+to restart and a list of services the check needs running.
+By default, all kinds of checks are run; :code:`--check` can be
+given (several times) to run only some.
+"""
+
+import functools
+import time
+
+from twisted.application import internet as tainternet
+from twisted.python import log, usage
+
+from ncolony import beatcheck
+from ncolony import connectcheck
+from ncolony import httpcheck
+from ncolony import instrument
+from ncolony.client import heart
+
+def _isolated(function, *args):
+    ## pylint: disable=broad-except
+    try:
+        return function(*args)
+    except Exception as e:
+        log.msg("Health check failed: ", repr(function), repr(e))
+        return []
+    ## pylint: enable=broad-except
+
+class Fanout(object):
+
+    """Pass configuration changes on to several receivers
+
+    :params receivers: list of receivers
+    """
+
+    def __init__(self, receivers):
+        self.receivers = receivers
+
+    def begin(self):
+        """Start a batch of configuration changes"""
+        for receiver in self.receivers:
+            _isolated(receiver.begin)
+
+    def commit(self):
+        """Finish a batch of configuration changes"""
+        for receiver in self.receivers:
+            _isolated(receiver.commit)
+
+    def add(self, name, contents):
+        """Note a new or changed configuration
+
+        :params name: string, name of process
+        :params contents: bytes, JSON-encoded configuration
+        """
+        for receiver in self.receivers:
+            _isolated(receiver.add, name, contents)
+
+    def remove(self, name):
+        """Note a removed configuration
+
+        :params name: string, name of process
+        """
+        for receiver in self.receivers:
+            _isolated(receiver.remove, name)
+
+def _untimed(checker, dummyNow):
+    return checker()
+
+def _beatcheck(opt, path, dummyLimiter):
+    return beatcheck.makeCheck(opt, path)
+
+def _httpcheck(opt, path, limiter):
+    index = httpcheck.makeIndex(opt, path, limiter=limiter)
+    return index, functools.partial(_untimed, index.check), []
+
+def _connectcheck(opt, path, limiter):
+    index = connectcheck.makeIndex(opt, path, limiter)
+    return index, functools.partial(_untimed, index.check), []
+
+CHECKS = dict(beatcheck=_beatcheck, httpcheck=_httpcheck, connectcheck=_connectcheck)
+
+def run(restarter, checkers, timer):
+    """Restart each process which any of the checkers flags, once
+
+    :params restarter: something to run on each name to restart
+    :params checkers: list of functions expected to get one argument
+                      (current time) and return a list of names
+    :params timer: a function of zero arguments, intended to return current time
+    :returns: None
+    """
+    now = timer()
+    bad = set()
+    for checker in checkers:
+        bad.update(_isolated(checker, now))
+    for name in sorted(bad):
+        restarter(name)
+
+def makeService(opt):
+    """Make a service
+
+    :params opt: dictionary-like object with 'freq', 'config', 'messages',
+                 (optionally) 'checks' and the options of each check
+    :returns: twisted.application.service.MultiService that at opt['freq']
+              checks the processes in opt['config'], and sends
+              restart messages through opt['messages']
+    """
+    restarter, path = beatcheck.parseConfig(opt)
+    receivers = []
+    checkers = []
+    services = []
+    limiter = httpcheck.makeLimiter(opt)
+    for name in opt.get('checks') or sorted(CHECKS):
+        receiver, checker, checkServices = CHECKS[name](opt, path, limiter)
+        receivers.append(receiver)
+        checkers.append(checker)
+        services.extend(checkServices)
+    restarter, runner, metricServices, instrumentation = instrument.instrumentCheck(
+        opt, 'health', restarter, run)
+    services.extend(metricServices)
+    health = tainternet.TimerService(opt['freq'], runner, restarter, checkers, time.time)
+    health.setName('health')
+    master = heart.wrapHeart(health)
+    beatcheck.watchConfig(master, opt, path, Fanout(receivers), 'health', instrumentation)
+    for service in services:
+        service.setServiceParent(master)
+    return master
+
+## pylint: disable=too-few-public-methods
+
+class Options(beatcheck.Options, httpcheck.Options):
+
+    """Options for ncolony health service"""
+
+    def __init__(self):
+        beatcheck.Options.__init__(self)
+        self['checks'] = []
+
+    def opt_check(self, name):
+        """Run a kind of check (beatcheck, httpcheck or connectcheck)"""
+        if name not in CHECKS:
+            raise usage.UsageError("Unknown check", name)
+        self['checks'].append(name)
+
+## pylint: enable=too-few-public-methods
@@ -1,30 +1,130 @@
 # Copyright (c) Moshe Zadka
 # See LICENSE for details.
 
-"""Check HTTP server for responsiveness"""
-
+"""Check HTTP server for responsiveness
+
+The configurations are kept in an :py:class:`Index`, which is
+updated every :code:`--config-freq` seconds (or when inotify reports
+a change, given :code:`--inotify`), only for the configurations
+which changed.
+
+Each check is first due at a random point in its first period after
+the grace period, so checks of processes which were added together
+are spread out. The number of requests in flight can be limited, both
+overall (:code:`--max-in-flight`) and per host (:code:`--max-per-host`).
+Requests over the limit wait for their turn, and their timeout only
+starts once they are sent.
+
+The response time of each successful check is recorded in a
+:py:class:`Histogram` of the last :code:`slowWindow` (default 100)
+checks. If the section has a :code:`slowThreshold` (in seconds),
+a successful check counts as unsuccessful when the
+:code:`slowPercentile` (default 99) of the response times is above it.
+"""
+
+import bisect
 import collections
-import functools
 import json
+import math
+import random
 import sys
-
-import six
+from urllib import parse as urlparse
 
 import twisted
 
 from twisted.application import internet as tainternet
 from twisted.internet import defer, reactor
+from twisted.python import log
 from twisted.web import client
 
 import ncolony
 from ncolony import beatcheck
+from ncolony import instrument
 from ncolony.client import heart
 
+BUCKETS = tuple(0.001 * 2 ** (i / 4) for i in range(4 * 17))
+
+class Histogram(object):
+
+    """Response times of the last few checks
+
+    Times are counted in buckets whose bounds grow by a factor of
+    2 to the 1/4 (about 19%) from a millisecond to two minutes, so
+    percentiles are accurate to within a bucket.
+
+    :params window: integer, number of times to keep
+    """
+
+    __slots__ = ('counts', 'recent')
+
+    def __init__(self, window=100):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.recent = collections.deque(maxlen=window)
+
+    def __len__(self):
+        return len(self.recent)
+
+    def add(self, seconds):
+        """Record a response time
+
+        :params seconds: number
+        """
+        if len(self.recent) == self.recent.maxlen:
+            self.counts[self.recent[0]] -= 1
+        bucket = bisect.bisect_left(BUCKETS, seconds)
+        self.recent.append(bucket)
+        self.counts[bucket] += 1
+
+    def _bucket(self, percent):
+        rank = max(int(math.ceil(len(self.recent) * percent / 100)), 1)
+        seen = 0
+        for bucket, count in enumerate(self.counts): # pragma: no branch
+            seen += count
+            if seen >= rank:
+                break
+        return bucket
+
+    def percentile(self, percent):
+        """Estimate a percentile of the recorded times
+
+        :params percent: number between 0 and 100
+        :returns: the upper bound of the bucket the percentile is in
+                  (infinity if it is over the last bound),
+                  or None if nothing was recorded
+        """
+        if not self.recent:
+            return None
+        bucket = self._bucket(percent)
+        if bucket == len(BUCKETS):
+            return float('inf')
+        return BUCKETS[bucket]
+
+    def exceeds(self, percent, threshold):
+        """Whether a percentile of the recorded times is over a threshold
+
+        Only a percentile whose whole bucket is over the threshold counts,
+        so times just under the threshold are never taken to be over it.
+
+        :params percent: number between 0 and 100
+        :params threshold: number
+        :returns: boolean, False if nothing was recorded
+        """
+        if not self.recent:
+            return False
+        bucket = self._bucket(percent)
+        return bucket > 0 and BUCKETS[bucket - 1] >= threshold
+
+Slow = collections.namedtuple('Slow', 'threshold percentile')
+
 class _ScoreCard(object):
 
-    def __init__(self, maxBad=0):
+    __slots__ = ('maxBad', 'bad', 'histogram', 'slow')
+
+    def __init__(self, maxBad=0, window=100, slow=None):
         self.maxBad = maxBad
         self.bad = 0
+        self.histogram = Histogram(window)
+        self.slow = slow
 
     def isBad(self):
         """Too many unsuccessful checks"""
@@ -35,9 +135,20 @@ class _ScoreCard(object):
         self.bad += 1
 
     def markGood(self, dummyValue):
-        """Note a successful check"""
+        """Note a successful check, unless responses are too slow"""
+        if (self.slow is not None and
+                self.histogram.exceeds(self.slow.percentile, self.slow.threshold)):
+            self.bad += 1
+            return
         self.bad = 0
 
+    def markTime(self, seconds):
+        """Note the response time of a successful check
+
+        :params seconds: number
+        """
+        self.histogram.add(seconds)
+
     def __repr__(self):
         return ('<%(klass)s:%(id)s:maxBad=%(maxBad)s,bad=%(bad)s>' %
                 dict(klass=self.__class__.__name__,
@@ -45,7 +156,46 @@ class _ScoreCard(object):
                      maxBad=self.maxBad,
                      bad=self.bad))
 
-Settings = collections.namedtuple('Settings', 'reactor agent')
+class Limiter(object):
+
+    """Limit the number of calls in flight
+
+    :params maxInFlight: integer or None (no limit), overall limit
+    :params maxPerHost: integer or None (no limit), limit for each host
+    """
+
+    def __init__(self, maxInFlight=None, maxPerHost=None):
+        self.overall = None
+        if maxInFlight is not None:
+            self.overall = defer.DeferredSemaphore(maxInFlight)
+        self.maxPerHost = maxPerHost
+        self.hosts = {}
+
+    def _forHost(self, host, func, *args, **kwargs):
+        if self.maxPerHost is None:
+            return func(*args, **kwargs)
+        semaphore = self.hosts.get(host)
+        if semaphore is None:
+            semaphore = self.hosts[host] = defer.DeferredSemaphore(self.maxPerHost)
+        def _cleanup(result):
+            if semaphore.tokens == semaphore.limit and not semaphore.waiting:
+                self.hosts.pop(host, None)
+            return result
+        return semaphore.run(func, *args, **kwargs).addBoth(_cleanup)
+
+    def run(self, host, func, *args, **kwargs):
+        """Call a function once there is room
+
+        :params host: string, the host the call talks to
+        :params func: a function returning a Deferred
+        :returns: a Deferred, firing with the function's result
+        """
+        if self.overall is not None:
+            return self._forHost(host, self.overall.run, func, *args, **kwargs)
+        return self._forHost(host, func, *args, **kwargs)
+
+Settings = collections.namedtuple('Settings', 'reactor agent limiter random')
+Settings.__new__.__defaults__ = (None, random.random)
 
 _USER_AGENT = ('NColony HTTP Check ('
                'NColony/' + str(ncolony.__version__) + ', '
@@ -61,6 +211,9 @@ class State(object):
 
     """State of an HTTP check"""
 
+    __slots__ = ('location', 'settings', 'closed', 'content', 'call', 'card', 'url',
+                 'nextCheck', 'period', 'timeout')
+
     KEY = 'ncolony.httpcheck'
 
     def __init__(self, location, settings):
@@ -87,8 +240,8 @@ class State(object):
                      card=self.card))
 
     def _reset(self):
-        self.content = None
-        self._maybeReset()
+        content, self.content = self.content, None
+        self.load(content)
 
     def close(self):
         """Discard data and cancel all calls.
@@ -102,16 +255,28 @@ class State(object):
         self.closed = True
 
     def check(self):
-        """Check the state of HTTP"""
+        """Check the state of HTTP, reading the configuration"""
         if self.closed:
             raise ValueError("Cannot check a closed state")
         self._maybeReset()
+        return self.checkLoaded()
+
+    def checkLoaded(self):
+        """Check the state of HTTP, with the configuration last loaded"""
+        if self.closed:
+            raise ValueError("Cannot check a closed state")
         if self.url is None:
             return False
         return self._maybeCheck()
 
     def _maybeReset(self):
-        content = self.location.getContent().decode('utf-8')
+        self.load(self.location.getContent().decode('utf-8'))
+
+    def load(self, content):
+        """Load a configuration, if it changed
+
+        :params content: string, JSON-encoded configuration
+        """
         if content == self.content:
             return
         self.content = content
@@ -124,27 +289,55 @@ class State(object):
             self.url = None
             self.card = _ScoreCard()
             return
-        self.url = config['url']
+        self._configure(config)
         self.period = config['period']
-        self.card = _ScoreCard(config['maxBad'])
+        slow = None
+        if config.get('slowThreshold') is not None:
+            slow = Slow(threshold=config['slowThreshold'],
+                        percentile=config.get('slowPercentile', 99))
+        self.card = _ScoreCard(config['maxBad'], window=config.get('slowWindow', 100),
+                               slow=slow)
         self.timeout = min(self.period, config['timeout'])
-        self.nextCheck = self.settings.reactor.seconds() + config['grace'] * self.period
+        phase = self.settings.random() * self.period
+        self.nextCheck = self.settings.reactor.seconds() + config['grace'] * self.period + phase
+
+    def _configure(self, config):
+        self.url = config['url']
+
+    def _host(self):
+        return urlparse.urlparse(self.url).netloc
+
+    def _probe(self):
+        return self.settings.agent.request('GET', self.url, _standardHeaders, None)
+
+    def _request(self):
+        reactor = self.settings.reactor
+        card = self.card
+        started = reactor.seconds()
+        call = self._probe()
+        delayedCall = reactor.callLater(self.timeout, call.cancel)
+        def _gotResult(result):
+            if delayedCall.active():
+                delayedCall.cancel()
+            return result
+        def _gotResponse(response):
+            card.markTime(reactor.seconds() - started)
+            return response
+        return call.addBoth(_gotResult).addCallback(_gotResponse)
 
     def _maybeCheck(self):
         if self.settings.reactor.seconds() <= self.nextCheck:
             return False
-        assert self.call is None, 'Timeout reached, call still outstanding'
+        if self.call is not None:
+            return False
         if self.card.isBad():
             self._reset()
             return True
         self.nextCheck = self.settings.reactor.seconds() + self.period
-        self.call = self.settings.agent.request('GET', self.url, _standardHeaders, None)
-        delayedCall = self.settings.reactor.callLater(self.timeout, self.call.cancel)
-        def _gotResult(result):
-            if delayedCall.active():
-                delayedCall.cancel()
-            return result
-        self.call.addBoth(_gotResult)
+        if self.settings.limiter is None:
+            self.call = self._request()
+        else:
+            self.call = self.settings.limiter.run(self._host(), self._request)
         self.call.addErrback(defer.logError)
         self.call.addCallbacks(callback=self.card.markGood, errback=self.card.markBad)
         def _removeCall(dummy):
@@ -166,7 +359,77 @@ def check(settings, states, location):
         del states[name]
     for name in added:
         states[name] = State(location=children[name], settings=settings)
-    return [name for name, state in six.iteritems(states) if state.check()]
+    return [name for name, state in states.items() if state.check()]
+
+class Index(object):
+
+    """HTTP checks, kept up to date by a configuration checker
+
+    (see :py:func:`ncolony.directory_monitor.checker`)
+
+    Only configurations with an :code:`ncolony.httpcheck` section
+    have a :py:class:`State`, and a state is only loaded again when
+    its configuration changes.
+
+    :params path: a twisted.python.filepath.FilePath with configurations
+    :params settings: Settings
+    :params stateFactory: the :py:class:`State` subclass to keep, for other
+                          kinds of checks
+    """
+
+    def __init__(self, path, settings, stateFactory=State):
+        self.path = path
+        self.settings = settings
+        self.stateFactory = stateFactory
+        self.states = {}
+
+    def begin(self):
+        """Start a batch of configuration changes"""
+
+    def commit(self):
+        """Finish a batch of configuration changes"""
+
+    def add(self, name, contents):
+        """Note a new or changed configuration
+
+        A configuration which cannot be parsed (for example, because
+        its section has no period) is logged and skipped.
+
+        :params name: string, name of process
+        :params contents: bytes, JSON-encoded configuration
+        """
+        state = self.states.get(name)
+        if state is None:
+            state = self.stateFactory(location=self.path.child(name), settings=self.settings)
+        ## pylint: disable=broad-except
+        try:
+            state.load(contents.decode('utf-8'))
+            loaded = state.url is not None
+        except Exception as e:
+            log.msg("Could not apply configuration: ", name, repr(e))
+            loaded = False
+        ## pylint: enable=broad-except
+        if not loaded:
+            self.states.pop(name, None)
+            state.close()
+            return
+        self.states[name] = state
+
+    def remove(self, name):
+        """Note a removed configuration
+
+        :params name: string, name of process
+        """
+        state = self.states.pop(name, None)
+        if state is not None:
+            state.close()
+
+    def check(self):
+        """Check all processes
+
+        :returns: list of strings, names of processes which should be restarted
+        """
+        return [name for name, state in self.states.items() if state.checkLoaded()]
 
 def run(restarter, checker):
     """Run restarter on the checker's output
@@ -180,22 +443,74 @@ def run(restarter, checker):
     for bad in checker():
         restarter(bad)
 
-def makeService(opt):
+def makeLimiter(opt):
+    """Make a limiter, if any limits are set
+
+    :params opt: dictionary-like object with 'max-in-flight' and 'max-per-host'
+    :returns: Limiter or None
+    """
+    if opt.get('max-in-flight') is None and opt.get('max-per-host') is None:
+        return None
+    return Limiter(opt.get('max-in-flight'), opt.get('max-per-host'))
+
+def makeIndex(opt, path, settings=None, limiter=None):
+    """Make an index of HTTP checks
+
+    :params opt: dictionary-like object with the limit and connection pool options
+    :params path: a twisted.python.filepath.FilePath with configurations
+    :params settings: Settings to check with (the limiter is taken from opt),
+                      or None to check with a real agent on the global reactor
+    :params limiter: Limiter shared with other checks, or None to make one from opt
+    :returns: Index
+    """
+    if limiter is None:
+        limiter = makeLimiter(opt)
+    if settings is not None:
+        return Index(path, settings._replace(limiter=limiter))
+    pool = client.HTTPConnectionPool(reactor, persistent=not opt.get('no-persistent'))
+    if opt.get('pool-size') is not None:
+        pool.maxPersistentPerHost = opt['pool-size']
+    agent = client.Agent(reactor=reactor, pool=pool)
+    settings = Settings(reactor=reactor, agent=agent, limiter=limiter)
+    return Index(path, settings)
+
+def makeService(opt, settings=None):
     """Make a service
 
     :params opt: dictionary-like object with 'freq', 'config' and 'messages'
+    :params settings: Settings to check with (see :py:func:`makeIndex`), or None
     :returns: twisted.application.internet.TimerService that at opt['freq']
               checks for stale processes in opt['config'], and sends
               restart messages through opt['messages']
     """
     restarter, path = beatcheck.parseConfig(opt)
-    pool = client.HTTPConnectionPool(reactor)
-    agent = client.Agent(reactor=reactor, pool=pool)
-    settings = Settings(reactor=reactor, agent=agent)
-    states = {}
-    checker = functools.partial(check, settings, states, path)
-    httpcheck = tainternet.TimerService(opt['freq'], run, restarter, checker)
+    index = makeIndex(opt, path, settings)
+    clock = None if settings is None else settings.reactor
+    restarter, runner, services, instrumentation = instrument.instrumentCheck(
+        opt, 'httpcheck', restarter, run, reactor=clock)
+    httpcheck = tainternet.TimerService(opt['freq'], runner, restarter, index.check)
+    httpcheck.clock = clock
     httpcheck.setName('httpcheck')
-    return heart.wrapHeart(httpcheck)
+    master = heart.wrapHeart(httpcheck)
+    beatcheck.watchConfig(master, opt, path, index, 'httpcheck', instrumentation, clock)
+    for service in services:
+        service.setServiceParent(master)
+    return master
+
+## pylint: disable=too-few-public-methods
+
+class Options(beatcheck.CheckOptions):
+
+    """Options for ncolony httpcheck service"""
+
+    optParameters = [
+        ["max-in-flight", None, None, "Maximum number of requests in flight", int],
+        ["max-per-host", None, None, "Maximum number of requests in flight to a host", int],
+        ["pool-size", None, None, "Number of persistent connections to keep per host", int],
+    ]
+
+    optFlags = [
+        ["no-persistent", None, "Do not keep connections open between checks"],
+    ]
 
-Options = beatcheck.Options
+## pylint: enable=too-few-public-methods
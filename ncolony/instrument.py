@@ -0,0 +1,372 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""ncolony.instrument
+=====================
+
+Measure how long the reactor's work takes.
+
+All the ncolony services do their work in timed calls on one reactor,
+so a slow scan delays everything else: reaping processes, restarting
+them and checking them. Instrumentation (see
+:py:class:`ncolony.interfaces.IInstrumentation`) is told
+
+ * how late a repeating call, every :code:`interval` seconds, ran
+   (the reactor's lag),
+ * when each instrumented callback (directory scans, rounds of checks,
+   scheduled runs) starts and how long it took, and
+ * when the reactor has run nothing else for :code:`--slow-threshold`
+   seconds, with a sample of the reactor thread's stack.
+
+The last one is noticed by a :py:class:`Watchdog` in a thread of its
+own, since the reactor thread is busy at the time. Taking the sample
+only costs a look at the reactor thread's current frame. The watchdog
+works in real time, and tells the instrumentation about a stall
+through the (global) reactor, once it is free again.
+
+The instrumentation which comes with ncolony logs slow callbacks and
+stalls (:py:class:`LogInstrumentation`) and exports everything as
+metrics (:py:class:`MetricsInstrumentation`, see :py:mod:`ncolony.metrics`).
+"""
+
+import functools
+import sys
+import threading
+import time
+import traceback
+
+from zope import interface
+
+from twisted.application import internet as tainternet, service as taservice
+from twisted.python import log
+
+from ncolony import interfaces, metrics
+
+STACK_LIMIT = 20
+
+@interface.implementer(interfaces.IInstrumentation)
+class LogInstrumentation(object):
+
+    """Log slow callbacks, lag and stalls
+
+    :params threshold: number, seconds from which things are slow
+    """
+
+    def __init__(self, threshold):
+        self.threshold = threshold
+
+    def tick(self, lag):
+        """Log a tick which was late"""
+        if lag >= self.threshold:
+            log.msg("Reactor ran late: %.3f seconds" % lag)
+
+    def started(self, name):
+        """Ignore a callback starting"""
+
+    def timed(self, name, seconds):
+        """Log a callback which was slow"""
+        if seconds >= self.threshold:
+            log.msg("Slow callback: %s took %.3f seconds" % (name, seconds))
+
+    def stalled(self, name, seconds, stack):
+        """Log a stall"""
+        log.msg("Reactor stalled: %s running for %.3f seconds\n%s" %
+                (name, seconds, ''.join(stack)))
+
+@interface.implementer(interfaces.IInstrumentation)
+class MetricsInstrumentation(object):
+
+    """Export lag, callback times and stalls as metrics
+
+    :params registry: a metrics.Registry
+    """
+
+    def __init__(self, registry):
+        self.lag = registry.gauge('ncolony_reactor_lag_seconds',
+                                  'How late the latest repeating call ran')
+        self.callbacks = registry.histogram('ncolony_callback_seconds',
+                                            'Time taken by each callback')
+        self.stalls = registry.counter('ncolony_stalls_total',
+                                       'Times the reactor stalled, by callback')
+
+    def tick(self, lag):
+        """Set the lag gauge"""
+        self.lag.set(lag)
+
+    def started(self, name):
+        """Ignore a callback starting"""
+
+    def timed(self, name, seconds):
+        """Observe the time a callback took"""
+        self.callbacks.observe(seconds, name=name)
+
+    def stalled(self, name, seconds, stack):
+        """Count a stall"""
+        self.stalls.inc(name=name)
+
+@interface.implementer(interfaces.IInstrumentation)
+class Fanout(object):
+
+    """Pass events on to several instrumentations
+
+    :params instrumentations: list of IInstrumentation
+    """
+
+    def __init__(self, instrumentations):
+        self.instrumentations = instrumentations
+
+    def tick(self, lag):
+        """Pass a tick on"""
+        for instrumentation in self.instrumentations:
+            instrumentation.tick(lag)
+
+    def started(self, name):
+        """Pass a callback starting on"""
+        for instrumentation in self.instrumentations:
+            instrumentation.started(name)
+
+    def timed(self, name, seconds):
+        """Pass a callback finishing on"""
+        for instrumentation in self.instrumentations:
+            instrumentation.timed(name, seconds)
+
+    def stalled(self, name, seconds, stack):
+        """Pass a stall on"""
+        for instrumentation in self.instrumentations:
+            instrumentation.stalled(name, seconds, stack)
+
+def timed(instrumentation, name, timer, function, *args, **kwargs):
+    """Call a function, telling the instrumentation how long it took
+
+    Only the time the function itself took is measured: if it returns
+    a Deferred (like a scheduled run, which fires when the process
+    exits), the reactor is free while the Deferred waits. A function
+    which raises is still timed (so a stall is not reported for it),
+    and the exception is raised again.
+
+    :params instrumentation: an IInstrumentation
+    :params name: string, what the function does
+    :params timer: a function of zero arguments, intended to return current time
+    :params function: the function to call
+    :returns: the function's result
+    """
+    instrumentation.started(name)
+    start = timer()
+    try:
+        return function(*args, **kwargs)
+    finally:
+        instrumentation.timed(name, timer() - start)
+
+class LagMeter(object):
+
+    """Measure how late a repeating call is
+
+    :params instrumentation: an IInstrumentation
+    :params interval: number, seconds between calls
+    :params timer: a function of zero arguments, intended to return current time
+    """
+
+    def __init__(self, instrumentation, interval, timer=time.time):
+        self.instrumentation = instrumentation
+        self.interval = interval
+        self.timer = timer
+        self.expected = None
+
+    def tick(self):
+        """Note a call"""
+        now = self.timer()
+        if self.expected is not None:
+            self.instrumentation.tick(max(now - self.expected, 0))
+        self.expected = now + self.interval
+
+## pylint: disable=protected-access,too-many-arguments,too-many-instance-attributes
+@interface.implementer(interfaces.IInstrumentation)
+class Watchdog(object):
+
+    """Notice when the reactor thread has been busy for too long
+
+    The watchdog is itself an instrumentation: every event it is told
+    about shows the reactor is not stalled. Its :py:meth:`check` is
+    called from another thread.
+
+    :params instrumentation: an IInstrumentation, told about stalls
+    :params threshold: number, seconds after which the reactor is stalled
+    :params timer: a function of zero arguments, intended to return current time
+    :params frames: a function of zero arguments, returning the current
+                    frame of each thread by thread id
+    :params deliver: a function to call the instrumentation through,
+                     from the watchdog's thread
+    """
+
+    def __init__(self, instrumentation, threshold, timer=time.time,
+                 frames=sys._current_frames, deliver=None):
+        if deliver is None:
+            from twisted.internet import reactor
+            deliver = reactor.callFromThread
+        self.instrumentation = instrumentation
+        self.threshold = threshold
+        self.timer = timer
+        self.frames = frames
+        self.deliver = deliver
+        self.threadID = None
+        self.running = None
+        self.last = timer()
+        self.reported = False
+    ## pylint: enable=too-many-arguments
+
+    def beat(self):
+        """The reactor is running"""
+        self.last = self.timer()
+        self.reported = False
+
+    def tick(self, lag):
+        """The reactor is running, and free to run timed calls"""
+        self.running = None
+        self.beat()
+
+    def started(self, name):
+        """Note the callback which is running"""
+        self.running = name
+        self.beat()
+
+    def timed(self, name, seconds):
+        """Note that no callback is running"""
+        self.running = None
+        self.beat()
+
+    def stalled(self, name, seconds, stack):
+        """Ignore stalls"""
+
+    def check(self):
+        """Report a stall, with the reactor thread's stack, once per stall"""
+        stalled = self.timer() - self.last
+        if self.reported or stalled < self.threshold:
+            return
+        self.reported = True
+        frame = self.frames().get(self.threadID)
+        stack = []
+        if frame is not None:
+            stack = traceback.format_stack(frame, limit=STACK_LIMIT)
+        self.deliver(self.instrumentation.stalled, self.running or 'reactor', stalled, stack)
+## pylint: enable=protected-access,too-many-instance-attributes
+
+class WatchdogService(taservice.Service):
+
+    """Run a watchdog's checks in a thread
+
+    :params watchdog: a Watchdog
+    :params interval: number, seconds between checks
+    """
+
+    def __init__(self, watchdog, interval):
+        self.watchdog = watchdog
+        self.interval = interval
+        self.stopping = None
+        self.thread = None
+
+    def startService(self):
+        """Start checking, watching the thread which starts the service"""
+        taservice.Service.startService(self)
+        self.watchdog.threadID = threading.current_thread().ident
+        self.watchdog.beat()
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self._run, args=(self.stopping,),
+                                       name='ncolony-watchdog')
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stopService(self):
+        """Stop checking"""
+        taservice.Service.stopService(self)
+        self.stopping.set()
+        self.thread.join()
+
+    def _run(self, stopping):
+        while not stopping.wait(self.interval):
+            self.watchdog.check()
+
+def makeInstrumentation(registry=None, slowThreshold=None, reactor=None):
+    """Make the instrumentation asked for
+
+    :params registry: a metrics.Registry to export metrics to, or None
+    :params slowThreshold: number, seconds from which callbacks are slow
+                           and the reactor is stalled, or None
+    :params reactor: an IReactorTime, or None for the global reactor
+    :returns: the IInstrumentation (or None if nothing was asked for),
+              and a list of services measuring lag and watching for stalls
+    """
+    instrumentations = []
+    if registry is not None:
+        instrumentations.append(MetricsInstrumentation(registry))
+    if slowThreshold is not None:
+        instrumentations.append(LogInstrumentation(slowThreshold))
+    if not instrumentations:
+        return None, []
+    timer = time.time
+    if reactor is not None:
+        timer = reactor.seconds
+    interval = 1
+    services = []
+    if slowThreshold is not None:
+        interval = min(interval, slowThreshold / 2)
+        watchdog = Watchdog(Fanout(list(instrumentations)), slowThreshold)
+        instrumentations.append(watchdog)
+        watcher = WatchdogService(watchdog, interval)
+        watcher.setName('watchdog')
+        services.append(watcher)
+    instrumentation = Fanout(instrumentations)
+    lag = tainternet.TimerService(interval, LagMeter(instrumentation, interval, timer).tick)
+    lag.clock = reactor
+    lag.setName('lag')
+    services.append(lag)
+    return instrumentation, services
+
+def fromOptions(opt, reactor=None):
+    """Make the metrics and instrumentation asked for by options
+
+    :params opt: dictionary-like object with (optionally) 'metrics'
+                 and 'slow-threshold'
+    :params reactor: the reactor to serve metrics and measure lag on,
+                     or None for the global reactor
+    :returns: the metrics.Registry (or None), the IInstrumentation
+              (or None) and a list of services
+    """
+    registry = None
+    services = []
+    if opt.get('metrics') is not None:
+        registry = metrics.Registry()
+        services.append(metrics.serve(registry, opt['metrics'], reactor=reactor))
+    instrumentation, instrumentServices = makeInstrumentation(registry,
+                                                              opt.get('slow-threshold'),
+                                                              reactor=reactor)
+    return registry, instrumentation, services + instrumentServices
+
+def wrap(instrumentation, name, function):
+    """Time a function, if there is instrumentation
+
+    :params instrumentation: an IInstrumentation, or None
+    :params name: string, what the function does
+    :params function: the function to time
+    :returns: a function
+    """
+    if instrumentation is None:
+        return function
+    return functools.partial(timed, instrumentation, name, time.time, function)
+
+def instrumentCheck(opt, name, restarter, runner, reactor=None):
+    """Instrument a checking service, if asked to
+
+    :params opt: dictionary-like object with (optionally) 'metrics'
+                 and 'slow-threshold'
+    :params name: string, what the runner does
+    :params restarter: a function of a name, asking for a restart
+    :params runner: the function which runs the checks
+    :params reactor: the reactor the service runs on, or None for the global reactor
+    :returns: the restarter and runner to use, a list of services,
+              and the IInstrumentation (or None)
+    """
+    registry, instrumentation, services = fromOptions(opt, reactor)
+    if registry is not None:
+        restarts = registry.counter(name + '_restarts_total', 'Restarts asked for')
+        restarter = functools.partial(metrics.counted, restarts, restarter)
+    return restarter, wrap(instrumentation, name, runner), services, instrumentation
@@ -29,11 +29,56 @@ Interface definitions
 
       :params contents: string, message contents
       :returns: None
+
+   .. py:method:: begin
+
+      A batch of add/remove events is starting
+
+      :returns: None
+
+   .. py:method:: commit
+
+      The batch of add/remove events is done
+
+      :returns: None
+
+.. py:class:: IInstrumentation
+
+   .. py:method:: tick
+
+      A repeating timed call ran
+
+      :params lag: number, how many seconds later than expected it ran
+      :returns: None
+
+   .. py:method:: started
+
+      A callback is starting
+
+      :params name: string, what the callback does
+      :returns: None
+
+   .. py:method:: timed
+
+      A callback finished
+
+      :params name: string, what the callback does
+      :params seconds: number, how long it took
+      :returns: None
+
+   .. py:method:: stalled
+
+      The reactor has not run anything else for a while
+
+      :params name: string, the callback running (or :code:`reactor`)
+      :params seconds: number, how long the reactor has been stalled
+      :params stack: list of strings, the formatted stack of the reactor thread
+      :returns: None
 """
 
 from zope import interface
 
-__all__ = ['IMonitorEventReceiver']
+__all__ = ['IMonitorEventReceiver', 'IInstrumentation']
 
 ## pylint: disable=no-self-argument,no-init
 
@@ -52,3 +97,31 @@ class IMonitorEventReceiver(interface.Interface):
     def message(contents):
         """New message"""
         pass
+
+    def begin():
+        """Batch of events starting"""
+        pass
+
+    def commit():
+        """Batch of events done"""
+        pass
+
+class IInstrumentation(interface.Interface):
+
+    """Event sink for how long the reactor's work takes"""
+
+    def tick(lag):
+        """A repeating timed call ran"""
+        pass
+
+    def started(name):
+        """A callback is starting"""
+        pass
+
+    def timed(name, seconds):
+        """A callback finished"""
+        pass
+
+    def stalled(name, seconds, stack):
+        """The reactor has not run anything else for a while"""
+        pass
@@ -0,0 +1,218 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""ncolony.launcher
+===================
+
+Start a process with scheduling and resource settings.
+
+The process monitor can only pass a command line, a uid, a gid
+and an environment to the processes it starts. When a configuration
+has any of the keys in :py:data:`LAUNCH_KEYS`, the process is started
+through
+
+.. code-block:: bash
+
+   $ python -m ncolony launch <command line>
+
+with the keys, JSON-encoded, in :code:`NCOLONY_LAUNCH`.
+The launcher applies them to itself, and then executes the command line.
+
+Joining a cgroup, lowering the niceness and raising hard resource
+limits need privileges. So the process monitor does not switch to
+the configuration's :code:`uid` and :code:`gid` itself: they are
+passed on in :code:`NCOLONY_LAUNCH` as well, and the launcher
+switches to them after applying the settings, just before executing
+the command line (through :command:`ionice`, if asked to).
+
+The keys are:
+
+affinity
+    a list of CPU numbers, :code:`"spread"` (one CPU per process,
+    in turn) or :code:`"spread-numa"` (all CPUs of one NUMA node per
+    process, in turn). The monitor numbers all the processes with
+    spread affinity, whichever configuration they come from, and
+    passes each its number as :code:`placement`.
+
+nice
+    the niceness to run at.
+
+ionice
+    a dictionary with :code:`class` and (optionally) :code:`level`,
+    passed to the :command:`ionice` utility.
+
+rlimits
+    a dictionary mapping resource names (such as :code:`nofile` or
+    :code:`core`) to :code:`[soft, hard]` limits.
+
+cgroup
+    a dictionary with the :code:`path` of a cgroup v2 group,
+    relative to :code:`/sys/fs/cgroup`, and (optionally) the
+    :code:`limits` to write to its files, such as
+    :code:`{"cpu.max": "50000 100000", "memory.max": "1G"}`.
+    The group is created if it does not exist.
+"""
+
+import json
+import os
+import resource
+
+from twisted.python import util
+
+from ncolony import main as mainlib
+
+LAUNCH_KEYS = frozenset(['affinity', 'nice', 'ionice', 'rlimits', 'cgroup'])
+
+CGROUP_ROOT = '/sys/fs/cgroup'
+
+NODES = '/sys/devices/system/node'
+
+def parseCPUList(text):
+    """Parse a Linux CPU list
+
+    :params text: string, like '0-3,8'
+    :returns: list of integers
+    """
+    ret = []
+    for part in text.strip().split(','):
+        if not part:
+            continue
+        start, _, end = part.partition('-')
+        ret.extend(range(int(start), int(end or start) + 1))
+    return ret
+
+def numaNodes(location=NODES):
+    """Read the CPUs of each NUMA node
+
+    :params location: string, the sysfs directory of the nodes
+    :returns: list of lists of integers, in order of node number
+              (empty if there is no NUMA information)
+    """
+    try:
+        names = os.listdir(location)
+    except OSError:
+        return []
+    numbers = sorted(int(name[len('node'):]) for name in names
+                     if name.startswith('node') and name[len('node'):].isdigit())
+    ret = []
+    for number in numbers:
+        with open(os.path.join(location, 'node%d' % number, 'cpulist')) as fp:
+            ret.append(parseCPUList(fp.read()))
+    return ret
+
+def cpus(affinity, placement, available, nodes):
+    """Choose the CPUs to run on
+
+    :params affinity: list of integers, 'spread' or 'spread-numa'
+    :params placement: integer, number of the process among those spreading
+    :params available: sorted list of integers, CPUs the launcher may run on
+    :params nodes: list of lists of integers, CPUs of each NUMA node
+    :returns: list of integers
+    """
+    if affinity == 'spread':
+        return [available[placement % len(available)]]
+    if affinity == 'spread-numa':
+        if not nodes:
+            return available
+        node = nodes[placement % len(nodes)]
+        return [cpu for cpu in node if cpu in available] or available
+    return affinity
+
+def joinCgroup(cgroup, pid, root=CGROUP_ROOT):
+    """Move a process into a cgroup v2 group, creating it if needed
+
+    :params cgroup: dictionary with 'path' and (optionally) 'limits'
+    :params pid: integer, the process to move
+    :params root: string, where the cgroup v2 hierarchy is mounted
+    :returns: None
+    """
+    path = os.path.join(root, cgroup['path'].lstrip('/'))
+    if not os.path.isdir(path):
+        os.makedirs(path)
+    for name, value in sorted(cgroup.get('limits', {}).items()):
+        with open(os.path.join(path, name), 'w') as fp:
+            fp.write(str(value))
+    with open(os.path.join(path, 'cgroup.procs'), 'w') as fp:
+        fp.write(str(pid))
+
+def prepare(spec, cgroupRoot=CGROUP_ROOT, nodesLocation=NODES):
+    """Apply scheduling and resource settings to the current process
+
+    :params spec: dictionary with (some of) the keys in LAUNCH_KEYS,
+                  and the placement
+    :params cgroupRoot: string, where the cgroup v2 hierarchy is mounted
+    :params nodesLocation: string, the sysfs directory of the NUMA nodes
+    :returns: None
+    """
+    if 'cgroup' in spec:
+        joinCgroup(spec['cgroup'], os.getpid(), root=cgroupRoot)
+    if 'affinity' in spec:
+        available = sorted(os.sched_getaffinity(0))
+        chosen = cpus(spec['affinity'], spec.get('placement', 0), available,
+                      numaNodes(nodesLocation))
+        os.sched_setaffinity(0, chosen)
+    if 'nice' in spec:
+        os.setpriority(os.PRIO_PROCESS, 0, spec['nice'])
+    for name, (soft, hard) in sorted(spec.get('rlimits', {}).items()):
+        resource.setrlimit(getattr(resource, 'RLIMIT_' + name.upper()), (soft, hard))
+
+def switchUser(spec, switchUID=util.switchUID):
+    """Switch to the user and group to run as, if any
+
+    As when the process monitor switches, a missing uid or gid
+    is the current one.
+
+    :params spec: dictionary with (optionally) 'uid' and 'gid'
+    :params switchUID: function of a uid and a gid, which switches to them
+    :returns: None
+    """
+    uid, gid = spec.get('uid'), spec.get('gid')
+    if uid is None and gid is None:
+        return
+    if uid is None:
+        uid = os.geteuid()
+    if gid is None:
+        gid = os.getegid()
+    switchUID(uid, gid)
+
+def command(spec, args):
+    """The command line to execute
+
+    :params spec: dictionary with (some of) the keys in LAUNCH_KEYS
+    :params args: list of strings, the process's command line
+    :returns: list of strings
+    """
+    ionice = spec.get('ionice')
+    if ionice is None:
+        return args
+    prefix = ['ionice', '-c', str(ionice['class'])]
+    if ionice.get('level') is not None:
+        prefix.extend(['-n', str(ionice['level'])])
+    return prefix + args
+
+def wrap(args, spec, executable):
+    """Wrap a command line so it runs through the launcher
+
+    :params args: list of strings, the process's command line
+    :params spec: dictionary with (some of) the keys in LAUNCH_KEYS,
+                  and (optionally) the placement, uid and gid
+    :params executable: string, the Python interpreter
+    :returns: the new command line, and the value for NCOLONY_LAUNCH
+    """
+    return ([executable, '-m', 'ncolony', 'launch'] + list(args),
+            json.dumps(spec, sort_keys=True))
+
+@mainlib.COMMANDS.register(name='launch')
+def main(argv, environ=None, execvp=os.execvp, switchUID=util.switchUID):
+    """command-line entry point
+
+    Applies the settings in NCOLONY_LAUNCH, switches user, and
+    executes the rest of the command line.
+    """
+    if environ is None:
+        environ = os.environ
+    spec = json.loads(environ.pop('NCOLONY_LAUNCH', '{}'))
+    prepare(spec)
+    switchUser(spec, switchUID)
+    args = command(spec, argv[1:])
+    execvp(args[0], args)
@@ -0,0 +1,269 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""ncolony.metrics
+==================
+
+Export what ncolony itself is doing, in the Prometheus text format.
+
+The ncolony service, and the beatcheck, httpcheck, connectcheck, health
+and scheduler services, take a :code:`--metrics` option with a Twisted
+server endpoint description, like :code:`tcp:9100` or
+:code:`unix:/run/ncolony-metrics.sock`. When it is given, the service
+answers HTTP GET requests there with its metrics.
+
+Metrics are kept in a :py:class:`Registry`. Counters, gauges and
+histograms are updated as things happen; collected metrics are computed,
+by a function, each time the metrics are read -- which is how state
+that is already kept elsewhere (such as the process monitor's restart
+delays) is exported without touching the code that keeps it.
+
+How long the services' work takes, and the reactor's lag, are exported
+through :py:class:`ncolony.instrument.MetricsInstrumentation`.
+"""
+
+import bisect
+
+from twisted.application import strports
+from twisted.web import resource, server
+
+BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+
+CONTENT_TYPE = b'text/plain; version=0.0.4; charset=utf-8'
+
+def _key(labels):
+    return tuple(sorted(labels.items()))
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+def _format(value):
+    value = float(value)
+    if value == float('inf'):
+        return '+Inf'
+    if value == float('-inf'):
+        return '-Inf'
+    return repr(value)
+
+def _line(name, key, value):
+    if key:
+        name += '{%s}' % ','.join('%s="%s"' % (label, _escape(labelValue))
+                                  for label, labelValue in key)
+    return '%s %s\n' % (name, _format(value))
+
+class _Metric(object):
+
+    """A named metric
+
+    :params name: string, the metric's name
+    :params description: string, the metric's help text
+    """
+
+    kind = None
+
+    def __init__(self, name, description):
+        self.name = name
+        self.description = description
+
+    def samples(self):
+        """The metric's current values
+
+        :returns: iterable of (name, labels, value), where labels is
+                  a sorted tuple of (label, value) pairs
+        """
+        raise NotImplementedError()
+
+class Counter(_Metric):
+
+    """A number which only goes up"""
+
+    kind = 'counter'
+
+    def __init__(self, name, description):
+        super(Counter, self).__init__(name, description)
+        self.values = {}
+
+    def inc(self, amount=1, **labels):
+        """Add to the counter
+
+        :params amount: number
+        :params labels: the labels of the value to add to
+        """
+        key = _key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def samples(self):
+        for key, value in sorted(self.values.items()):
+            yield self.name, key, value
+
+class Gauge(Counter):
+
+    """A number which goes up and down"""
+
+    kind = 'gauge'
+
+    def set(self, value, **labels):
+        """Set the gauge
+
+        :params value: number
+        :params labels: the labels of the value to set
+        """
+        self.values[_key(labels)] = value
+
+class Histogram(_Metric):
+
+    """Counts of observations in buckets
+
+    :params buckets: sorted tuple of upper bounds
+    """
+
+    kind = 'histogram'
+
+    def __init__(self, name, description, buckets=BUCKETS):
+        super(Histogram, self).__init__(name, description)
+        self.buckets = buckets
+        self.values = {}
+
+    def observe(self, value, **labels):
+        """Record an observation
+
+        :params value: number
+        :params labels: the labels of the observation
+        """
+        key = _key(labels)
+        if key not in self.values:
+            self.values[key] = [[0] * (len(self.buckets) + 1), 0]
+        counts, total = self.values[key]
+        counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.values[key][1] = total + value
+
+    def samples(self):
+        bounds = [_format(bound) for bound in self.buckets] + ['+Inf']
+        for key, (counts, total) in sorted(self.values.items()):
+            seen = 0
+            for bound, count in zip(bounds, counts):
+                seen += count
+                yield self.name + '_bucket', key + (('le', bound),), seen
+            yield self.name + '_sum', key, total
+            yield self.name + '_count', key, seen
+
+class Collected(_Metric):
+
+    """A metric computed when it is read
+
+    :params kind: string, 'counter' or 'gauge'
+    :params function: a function of no arguments, returning an iterable
+                      of (labels dict, value)
+    """
+
+    def __init__(self, name, description, kind, function):
+        super(Collected, self).__init__(name, description)
+        self.kind = kind
+        self.function = function
+
+    def samples(self):
+        for key, value in sorted((_key(labels), value) for labels, value in self.function()):
+            yield self.name, key, value
+
+class Registry(object):
+
+    """A collection of metrics"""
+
+    def __init__(self):
+        self.metrics = []
+
+    def add(self, metric):
+        """Add a metric
+
+        :params metric: a Counter, Gauge, Histogram or Collected
+        :returns: the metric
+        """
+        self.metrics.append(metric)
+        return metric
+
+    def counter(self, name, description):
+        """Add a counter
+
+        :returns: Counter
+        """
+        return self.add(Counter(name, description))
+
+    def gauge(self, name, description):
+        """Add a gauge
+
+        :returns: Gauge
+        """
+        return self.add(Gauge(name, description))
+
+    def histogram(self, name, description, buckets=BUCKETS):
+        """Add a histogram
+
+        :returns: Histogram
+        """
+        return self.add(Histogram(name, description, buckets))
+
+    def collect(self, name, description, kind, function):
+        """Add a metric computed when it is read
+
+        :returns: Collected
+        """
+        return self.add(Collected(name, description, kind, function))
+
+    def render(self):
+        """All metrics, in the Prometheus text format
+
+        :returns: bytes
+        """
+        lines = []
+        for metric in self.metrics:
+            lines.append('# HELP %s %s\n' % (metric.name, metric.description))
+            lines.append('# TYPE %s %s\n' % (metric.name, metric.kind))
+            for name, key, value in metric.samples():
+                lines.append(_line(name, key, value))
+        return ''.join(lines).encode('utf-8')
+
+def counted(counter, function, name):
+    """Call a function on a name, counting the calls for each name
+
+    :params counter: a Counter
+    :params function: the function to call
+    :params name: string
+    :returns: the function's result
+    """
+    counter.inc(name=name)
+    return function(name)
+
+class MetricsResource(resource.Resource):
+
+    """Answer GET requests with the metrics
+
+    :params registry: a Registry
+    """
+
+    isLeaf = True
+
+    def __init__(self, registry):
+        resource.Resource.__init__(self)
+        self.registry = registry
+
+    def render_GET(self, request):
+        """Render the metrics
+
+        :params request: a twisted.web.server.Request
+        :returns: bytes
+        """
+        request.setHeader(b'content-type', CONTENT_TYPE)
+        return self.registry.render()
+
+def serve(registry, description, reactor=None):
+    """Make a service serving the metrics
+
+    :params registry: a Registry
+    :params description: string, a server endpoint description
+    :params reactor: an IReactorCore, or None for the global reactor
+    :returns: service
+    """
+    ret = strports.service(description, server.Site(MetricsResource(registry)),
+                           reactor=reactor)
+    ret.setName('metrics')
+    return ret
@@ -0,0 +1,207 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+"""ncolony.monitor
+==================
+
+The process monitor used by the ncolony service.
+"""
+
+import collections
+
+from twisted.application import service as taservice
+from twisted.python import failure, log
+from twisted.runner import procmon as procmonlib
+
+from ncolony import adopt
+
+RestartPolicy = collections.namedtuple('RestartPolicy',
+                                       'threshold minRestartDelay maxRestartDelay factor '
+                                       'maxFailures window')
+
+class ProcessMonitor(procmonlib.ProcessMonitor):
+
+    """A Twisted ProcessMonitor with a few additions
+
+    A process can have its own :py:class:`RestartPolicy`. A process
+    with a policy which dies within the policy's threshold is restarted
+    after a delay which starts at minRestartDelay and is multiplied by
+    factor with each such death, up to maxRestartDelay. If maxFailures
+    is not None, a process which exits (without being stopped) that
+    many times within window seconds is parked: it is not restarted
+    until it gets a new policy, or is removed and added again.
+
+    The monitor counts how many times each process exited, in exits.
+
+    If the monitor has a table (an :py:class:`ncolony.adopt.ProcessTable`),
+    processes are recorded in it, adopted from it if they were left
+    running by a previous monitor, and left running when the monitor stops.
+    Processes left running which are not monitored are stopped once
+    the configuration was applied in full (see :py:meth:`settled`).
+    """
+
+    def __init__(self, *args, **kwargs):
+        procmonlib.ProcessMonitor.__init__(self, *args, **kwargs)
+        self.policies = {}
+        self.failures = {}
+        self.parked = set()
+        self.exits = collections.Counter()
+        self.table = None
+        self.cleaned = False
+
+    def setPolicy(self, name, policy):
+        """Set the restart policy of a process
+
+        Forgets the process's failures, and starts it if it was parked.
+
+        :param name: string, name of the process
+        :param policy: RestartPolicy or None (use the monitor's parameters)
+        """
+        if policy is None:
+            self.policies.pop(name, None)
+        else:
+            self.policies[name] = policy
+            self.delay[name] = policy.minRestartDelay
+        self.failures.pop(name, None)
+        if name in self.parked:
+            self.parked.remove(name)
+            log.msg("Unparking monitored process: ", name)
+            if self.running:
+                self.startProcess(name)
+
+    def removeProcess(self, name):
+        """Stop and remove a process, forgetting its policy
+
+        :param name: string, name of the process
+        """
+        procmonlib.ProcessMonitor.removeProcess(self, name)
+        self.policies.pop(name, None)
+        self.failures.pop(name, None)
+        self.parked.discard(name)
+        self.exits.pop(name, None)
+
+    def _failed(self, name, policy, now):
+        failures = self.failures.setdefault(name, collections.deque())
+        failures.append(now)
+        while failures[0] <= now - policy.window:
+            failures.popleft()
+        return len(failures) >= policy.maxFailures
+
+    ## pylint: disable=protected-access
+    def startProcess(self, name):
+        """Start a process, unless it is running
+
+        With a table, a process left running is adopted, and a process
+        which is started is recorded. A process left running with other
+        parameters is stopped, and started again when it exits.
+
+        :param name: string, name of the process
+        """
+        if self.table is None or name in self.protocols:
+            procmonlib.ProcessMonitor.startProcess(self, name)
+            return
+        process = self._processes[name]
+        spec = adopt.specHash(process)
+        proto = procmonlib.LoggingProtocol()
+        proto.service = self
+        proto.name = name
+        self.protocols[name] = proto
+        transport = self.table.adopt(name, spec, self._reactor, proto)
+        if transport is not None and transport.stale:
+            self.timeStarted[name] = transport.started
+            log.msg("Replacing monitored process left running: ", name)
+            self.stopProcess(name)
+            return
+        if transport is not None:
+            self.timeStarted[name] = transport.started
+            log.msg("Adopted monitored process: ", name)
+            return
+        self.timeStarted[name] = self._clock.seconds()
+        try:
+            self._reactor.spawnProcess(proto, process.args[0], process.args,
+                                       uid=process.uid, gid=process.gid, env=process.env,
+                                       path=process.cwd, childFDs=adopt.CHILD_FDS)
+        except OSError:
+            self._monitoredProcessExited(name, failure.Failure())
+            return
+        self.table.record(name, proto.transport.pid, spec, self.timeStarted[name])
+    ## pylint: enable=protected-access
+
+    def settled(self):
+        """All configured processes were added
+
+        With a table, the first time, processes left running
+        which are not monitored any more are stopped.
+        """
+        if self.table is None or self.cleaned:
+            return
+        self.cleaned = True
+        self.table.clean(self._processes)
+
+    def stopService(self):
+        """Stop all processes, unless there is a table"""
+        if self.table is None:
+            procmonlib.ProcessMonitor.stopService(self)
+            return
+        taservice.Service.stopService(self)
+        for call in self.restart.values():
+            if call.active():
+                call.cancel()
+
+    def _monitoredProcessExited(self, name, reason=None):
+        self.exits[name] += 1
+        if self.table is not None:
+            self.table.forget(name)
+        policy = self.policies.get(name)
+        if policy is None:
+            procmonlib.ProcessMonitor._monitoredProcessExited(self, name, reason)
+            return
+        now = self._clock.seconds()
+        stopped = name in self.murder
+        fast = now - self.timeStarted[name] < policy.threshold
+        delay = self.delay[name]
+        procmonlib.ProcessMonitor._monitoredProcessExited(self, name, reason)
+        if fast:
+            self.delay[name] = min(delay * policy.factor, policy.maxRestartDelay)
+        else:
+            delay = 0
+            self.delay[name] = policy.minRestartDelay
+        call = self.restart.get(name)
+        if call is None or not call.active():
+            return
+        call.cancel()
+        if (not stopped and policy.maxFailures is not None and
+                self._failed(name, policy, now)):
+            self.parked.add(name)
+            log.msg("Parking crash-looping monitored process: ", name)
+            return
+        self.restart[name] = self._clock.callLater(delay, self.startProcess, name)
+
+    ## pylint: disable=too-many-arguments,protected-access
+    def updateProcess(self, name, args, uid=None, gid=None, env=None, cwd=None):
+        """Change the parameters of a process without restarting it
+
+        The new parameters are used the next time the process is started.
+        With a table, a running process is recorded with the new parameters,
+        so it is adopted rather than started again, if only its configuration
+        changed (see :py:func:`ncolony.adopt.canRecord`).
+
+        :param name: string, name of the process
+        :param args: list of strings, arguments (first is executable)
+        :param uid: integer or None, user id to run as
+        :param gid: integer or None, group id to run as
+        :param env: dict, environment
+        :param cwd: string or None, working directory
+        :raises: KeyError if there is no process by this name
+        """
+        if name not in self._processes:
+            raise KeyError("Unrecognized process name", name)
+        if env is None:
+            env = {}
+        old = self._processes[name]
+        self._processes[name] = process = procmonlib._Process(args, uid, gid, env, cwd)
+        proto = self.protocols.get(name)
+        if (self.table is not None and proto is not None and proto.transport is not None and
+                adopt.canRecord(old, process)):
+            self.table.record(name, proto.transport.pid, adopt.specHash(process),
+                              self.timeStarted[name])
+    ## pylint: enable=too-many-arguments,protected-access
@@ -6,33 +6,286 @@
 Convert events into process monitoring actions.
 """
 
+import collections
+import heapq
 import json
 import os
-
-import six
+import sys
 
 from zope import interface
 
 from twisted.python import log
 
-from ncolony import interfaces
+from ncolony import interfaces, launcher, monitor as monitorlib, rolling
 
 VALID_KEYS = frozenset(['args', 'uid', 'gid', 'env', 'env_inherit'])
 
+RESTART_KEYS = dict(threshold='threshold', minDelay='minRestartDelay',
+                    maxDelay='maxRestartDelay', factor='factor',
+                    maxFailures='maxFailures', window='window')
+
+ROLLING_KEYS = dict(batch='batch', percent='percent', max_in_flight='maxInFlight',
+                    gate='gate', interval='interval', timeout='timeout')
+
+def _withoutReplicas(config):
+    return {key: value for key, value in config.items() if key != 'replicas'}
+
+def _spec(params):
+    env = dict(params['env'])
+    del env['NCOLONY_CONFIG']
+    return params['args'], params.get('uid'), params.get('gid'), env
+
+def _take(taken, free, name):
+    if name not in taken:
+        if free:
+            taken[name] = heapq.heappop(free)
+        else:
+            taken[name] = len(taken)
+    return taken[name]
+
+def _release(taken, free, name):
+    number = taken.pop(name, None)
+    if number is not None:
+        heapq.heappush(free, number)
+
 @interface.implementer(interfaces.IMonitorEventReceiver)
 class Receiver(object):
 
     """A wrapper around ProcessMonitor that responds to events
 
+    The parameters of the processes added are kept in
+    :code:`processes`, keyed by name.
+
+    Add and remove events between begin and commit are collected,
+    and only the net change for each name is applied: a process
+    whose configuration was removed and added back with the same
+    parsed JSON is left alone. Changes are applied up to batchSize
+    at a time, batchDelay seconds apart. Add and remove events outside
+    of begin and commit are treated as a batch of one. A configuration
+    which cannot be applied (for example, because it is not valid JSON)
+    is logged and skipped, and why is kept in :code:`errors`, keyed by
+    name, until the name changes again. Once no changes are left to apply, the
+    monitor is told it has settled.
+
+    In semantic mode, a process is only restarted when its arguments,
+    uid, gid or environment change. Other changes (for example, to the
+    :code:`ncolony.beatcheck` or :code:`ncolony.httpcheck` sections,
+    which the checkers read from the configuration directory) are
+    recorded with the monitor's updateProcess, and are seen by the
+    process (in :code:`NCOLONY_CONFIG`) the next time it starts.
+
+    Processes whose :code:`ncolony.beatcheck` section uses the
+    :code:`mmap` transport are given a slot in the heartbeat table,
+    in :code:`NCOLONY_HEART_SLOT`. A process keeps its slot until it
+    is removed, and the lowest free slot is handed out first.
+
+    A configuration with a :code:`replicas` key is run as that many
+    processes, named :code:`<name>.0`, :code:`<name>.1` and so on,
+    with the index in :code:`NCOLONY_INSTANCE` and the process's own
+    name in :code:`NCOLONY_NAME` (so each replica has its own status
+    file or heartbeat slot). A configuration whose processes would have
+    the same name as another configuration's is not applied. Changing
+    the number of replicas only adds or removes the processes at the
+    end. Changing anything which would otherwise restart the processes
+    restarts them with a :py:class:`ncolony.rolling.RollingRestart`.
+    A restart message for the configuration's name restarts all of
+    its processes.
+
+    Processes whose configuration has any of the
+    :py:data:`ncolony.launcher.LAUNCH_KEYS` (CPU affinity, niceness,
+    I/O priority, resource limits or cgroup) are started through
+    :py:mod:`ncolony.launcher`, which applies them, and switches to
+    the process's uid and gid, before executing the process.
+    Processes with spread CPU affinity are numbered (like heartbeat
+    slots) so that they are spread over the CPUs together.
+
+    Processes with an :code:`ncolony.restart` section get their own
+    :py:class:`ncolony.monitor.RestartPolicy`. The section's keys are
+    :code:`threshold`, :code:`minDelay`, :code:`maxDelay` (defaulting
+    to the monitor's parameters), :code:`factor` (default 2),
+    :code:`maxFailures` (default None, never park the process)
+    and :code:`window` (default 60). Any change to the configuration
+    of a parked process starts it again.
+
     :params monitor: a ProcessMonitor
+    :params environ: dict-like object, environment to inherit from
+    :params reactor: IReactorTime, used to pace changes
+    :params batchSize: integer or None (no limit), maximum number of
+                       changes to apply at once
+    :params batchDelay: number, seconds between applying batches
+    :params semantic: boolean, whether to use semantic mode
     """
 
-    def __init__(self, monitor, environ=None):
+    ## pylint: disable=too-many-arguments
+    def __init__(self, monitor, environ=None, reactor=None, batchSize=None, batchDelay=1,
+                 semantic=False):
         """Initialize from ProcessMonitor"""
         if environ is None:
             environ = os.environ
+        if reactor is None:
+            from twisted.internet import reactor
         self.environ = environ
         self.monitor = monitor
+        self.reactor = reactor
+        self.batchSize = batchSize
+        self.batchDelay = batchDelay
+        self.semantic = semantic
+        self.processes = {}
+        self.configs = {}
+        self.batch = None
+        self.queue = collections.OrderedDict()
+        self.errors = {}
+        self.call = None
+        self.rolling = None
+        self.agent = None
+        self.slots = {}
+        self.freeSlots = []
+        self.placements = {}
+        self.freePlacements = []
+        self.instances = {}
+        self.owners = {}
+        self.rolls = {}
+        self.executable = sys.executable
+        self.messageCounts = collections.Counter()
+    ## pylint: enable=too-many-arguments
+
+    def begin(self):
+        """Start collecting a batch of events"""
+        self.batch = {}
+
+    def commit(self):
+        """Apply the collected batch of events"""
+        batch, self.batch = self.batch or {}, None
+        for name in sorted(batch):
+            self.queue.pop(name, None)
+            self.errors.pop(name, None)
+            self.queue[name] = batch[name]
+        if self.call is None:
+            self._drain()
+
+    def _event(self, name, contents):
+        if self.batch is not None:
+            self.batch[name] = contents
+            return
+        self.begin()
+        self.batch[name] = contents
+        self.commit()
+
+    def _drain(self):
+        self.call = None
+        changed = 0
+        while self.queue and (self.batchSize is None or changed < self.batchSize):
+            name, contents = self.queue.popitem(last=False)
+            ## pylint: disable=broad-except
+            try:
+                changed += self._apply(name, contents)
+            except Exception as e:
+                log.msg("Could not apply configuration: ", name, repr(e))
+                self.errors[name] = repr(e)
+            ## pylint: enable=broad-except
+        if self.queue:
+            self.call = self.reactor.callLater(self.batchDelay, self._drain)
+        else:
+            self.monitor.settled()
+
+    def _apply(self, name, contents):
+        if contents is None:
+            if name in self.instances:
+                self._removeReplicas(name)
+                return 1
+            if name not in self.processes or name in self.owners:
+                return 0
+            self._remove(name)
+            self._freeSlots(name)
+            return 1
+        config = json.loads(contents.decode('utf-8'))
+        replicas = config.get('replicas')
+        names = [name]
+        if replicas is not None:
+            names = ['%s.%d' % (name, index) for index in range(replicas)]
+        taken = [instance for instance in names
+                 if instance in self.processes and self.owners.get(instance, instance) != name]
+        if taken:
+            raise ValueError('process names already taken', name, taken)
+        if self.configs.get(name) == config:
+            return 0
+        if replicas is not None:
+            if name in self.processes:
+                self._remove(name)
+                self._freeSlots(name)
+            return self._applyReplicas(name, contents, config, names)
+        if name in self.instances:
+            self._removeReplicas(name)
+        params = self._params(name, contents, config)
+        if name in self.processes:
+            if self.semantic and _spec(self.processes[name]) == _spec(params):
+                self._update(name, params, config)
+                return 0
+            self._remove(name)
+        self._add(name, params, config)
+        return 1
+
+    def _applyReplicas(self, name, contents, config, new):
+        old = self.instances.get(name, [])
+        changed = 0
+        for instance in old[len(new):]:
+            self._removeInstance(instance)
+            changed = 1
+        roll = []
+        for index, instance in enumerate(new):
+            params = self._params(name, contents, config, instance, index)
+            if instance not in self.processes:
+                self._add(instance, params, config)
+                self.owners[instance] = name
+                changed = 1
+                continue
+            oldConfig = self.configs[instance]
+            if oldConfig == config:
+                continue
+            if (_spec(self.processes[instance]) != _spec(params) or
+                    (not self.semantic and
+                     _withoutReplicas(oldConfig) != _withoutReplicas(config))):
+                roll.append(instance)
+            self._update(instance, params, config)
+        self.instances[name] = new
+        if roll:
+            self._stopRoll(name)
+            self.rolls[name] = rolling.RollingRestart(self.monitor, roll, self.configs,
+                                                      self.reactor, agent=self.agent,
+                                                      slots=self.slots)
+            self.rolls[name].start()
+        return changed
+
+    def _removeReplicas(self, name):
+        self._stopRoll(name)
+        for instance in self.instances.pop(name):
+            self._removeInstance(instance)
+
+    def _removeInstance(self, instance):
+        self._remove(instance)
+        self._freeSlots(instance)
+        del self.owners[instance]
+
+    def _stopRoll(self, name):
+        roll = self.rolls.pop(name, None)
+        if roll is not None:
+            roll.stop()
+
+    def _add(self, name, params, config):
+        self.monitor.addProcess(**params)
+        if 'ncolony.restart' in config:
+            self.monitor.setPolicy(name, self._policy(config))
+        self.processes[name] = params
+        self.configs[name] = config
+        log.msg("Added monitored process: ", name)
+
+    def _update(self, name, params, config):
+        self.monitor.updateProcess(**params)
+        if 'ncolony.restart' in config or 'ncolony.restart' in self.configs[name]:
+            self.monitor.setPolicy(name, self._policy(config))
+        self.processes[name] = params
+        self.configs[name] = config
+        log.msg("Updated monitored process: ", name)
 
     def add(self, name, contents):
         """Add a process
@@ -42,44 +295,108 @@ class Receiver(object):
            parsed as JSON for process params
         :returns: None
         """
-        parsedContents = json.loads(contents.decode('utf-8'))
+        self._event(name, contents)
+
+    ## pylint: disable=too-many-arguments
+    def _params(self, name, contents, config, instance=None, index=None):
         parsedContents = {key: value
-                          for key, value in six.iteritems(parsedContents)
+                          for key, value in config.items()
                           if key in VALID_KEYS}
-        parsedContents['name'] = name
-        parsedContents['env'] = parsedContents.get('env', {})
+        parsedContents['name'] = name if instance is None else instance
+        parsedContents['env'] = dict(parsedContents.get('env', {}))
         for key in parsedContents.pop('env_inherit', []):
             parsedContents['env'][key] = self.environ.get(key, '')
         parsedContents['env']['NCOLONY_CONFIG'] = contents
-        parsedContents['env']['NCOLONY_NAME'] = name
-        self.monitor.addProcess(**parsedContents)
-        log.msg("Added monitored process: ", name)
+        parsedContents['env']['NCOLONY_NAME'] = parsedContents['name']
+        if index is not None:
+            parsedContents['env']['NCOLONY_INSTANCE'] = str(index)
+        processName = parsedContents['name']
+        launch = {key: config[key] for key in launcher.LAUNCH_KEYS if key in config}
+        if launch.get('affinity') in ('spread', 'spread-numa'):
+            launch['placement'] = _take(self.placements, self.freePlacements, processName)
+        else:
+            _release(self.placements, self.freePlacements, processName)
+        if launch:
+            for key in ('uid', 'gid'):
+                if key in parsedContents:
+                    launch[key] = parsedContents.pop(key)
+            parsedContents['args'], parsedContents['env']['NCOLONY_LAUNCH'] = launcher.wrap(
+                parsedContents['args'], launch, self.executable)
+        if config.get('ncolony.beatcheck', {}).get('transport') == 'mmap':
+            slot = _take(self.slots, self.freeSlots, processName)
+            parsedContents['env']['NCOLONY_HEART_SLOT'] = str(slot)
+        else:
+            _release(self.slots, self.freeSlots, processName)
+        return parsedContents
+    ## pylint: enable=too-many-arguments
+
+    def _policy(self, config):
+        section = config.get('ncolony.restart')
+        if section is None:
+            return None
+        params = dict(threshold=self.monitor.threshold,
+                      minRestartDelay=self.monitor.minRestartDelay,
+                      maxRestartDelay=self.monitor.maxRestartDelay,
+                      factor=2, maxFailures=None, window=60)
+        params.update((RESTART_KEYS[key], value)
+                      for key, value in section.items()
+                      if key in RESTART_KEYS)
+        return monitorlib.RestartPolicy(**params)
+
+    def _freeSlots(self, name):
+        _release(self.slots, self.freeSlots, name)
+        _release(self.placements, self.freePlacements, name)
 
     def remove(self, name):
         """Remove a process
 
         :params name: string, name of process
         """
+        self._event(name, None)
+
+    def _remove(self, name):
         self.monitor.removeProcess(name)
+        del self.processes[name]
+        del self.configs[name]
         log.msg("Removed monitored process: ", name)
 
     def message(self, contents):
-        """Respond to a restart or a restart-all message
+        """Respond to a restart, restart-all or restart-rolling message
 
         :params contents: string, contents of message
            parsed as JSON, and assumed to have a 'type'
-           key, with value either 'restart' or 'restart-all'.
+           key, with value either 'restart', 'restart-all'
+           or 'restart-rolling'.
            If the value is 'restart', another key
            ('value') should exist with a logical process
            name.
+           If the value is 'restart-rolling', the keys
+           'batch', 'percent', 'max_in_flight', 'gate',
+           'interval' and 'timeout' are passed on to
+           :py:class:`ncolony.rolling.RollingRestart`.
+           A rolling restart replaces any rolling restart
+           still in progress.
         """
         contents = json.loads(contents.decode('utf-8'))
         tp = contents['type']
         if tp == 'RESTART':
-            self.monitor.stopProcess(contents['name'])
+            for name in self.instances.get(contents['name'], [contents['name']]):
+                self.monitor.stopProcess(name)
             log.msg("Restarting monitored process: ", contents['name'])
         elif tp == 'RESTART-ALL':
             self.monitor.restartAll()
             log.msg("Restarting all monitored processes")
+        elif tp == 'RESTART-ROLLING':
+            params = {ROLLING_KEYS[key]: value
+                      for key, value in contents.items()
+                      if key in ROLLING_KEYS}
+            if self.rolling is not None:
+                self.rolling.stop()
+            self.rolling = rolling.RollingRestart(self.monitor, sorted(self.processes),
+                                                  self.configs, self.reactor,
+                                                  agent=self.agent, slots=self.slots,
+                                                  **params)
+            self.rolling.start()
         else:
             raise ValueError('unknown type', contents)
+        self.messageCounts[tp] += 1
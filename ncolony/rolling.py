@@ -0,0 +1,206 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+"""ncolony.rolling
+==================
+
+Restart processes a few at a time.
+
+A rolling restart stops a batch of processes, and starts stopping
+the next batch only once enough of the previous ones are back.
+A process is back once it has been started again; if the restart
+is gated, it also has to look healthy: if it has a
+:code:`ncolony.beatcheck` section, it must have beaten since it
+started, and if it has an :code:`ncolony.httpcheck` section, its URL
+must answer a GET (within the section's :code:`timeout`, or the
+rolling restart's if it has none).
+
+Beats with the file transport are seen in the status file, and beats
+with the mmap transport in the process's slot of the table. Beats
+with the datagram transport only reach the beatcheck, so such a
+process never passes the gate, and is given up on after the timeout.
+"""
+
+import collections
+import math
+import struct
+import time
+
+from twisted.python import filepath, log
+from twisted.web import client
+
+from ncolony.client import heart
+
+## pylint: disable=too-many-instance-attributes
+
+class RollingRestart(object):
+
+    """Restart processes a few at a time
+
+    :param monitor: a ProcessMonitor
+    :param names: list of strings, names of processes to restart, in order
+    :param configs: dict-like object, mapping names to parsed configurations
+    :param reactor: IReactorTime, should be the monitor's
+    :param batch: integer or None, number of processes to stop at once
+    :param percent: number or None, batch size as a percentage of the
+                    number of processes (used when batch is None)
+    :param maxInFlight: integer or None (the batch size), maximum number of
+                        processes which are restarting at the same time
+    :param gate: boolean, whether to wait for health signals
+    :param interval: number, seconds between checking on restarting processes
+    :param timeout: number, seconds after which a process that is not back
+                    is given up on
+    :param agent: twisted.web.client.Agent or None, for HTTP health checks
+    :param slots: dict-like object or None, mapping names to slots in the
+                  table of processes beating with the mmap transport
+    """
+
+    ## pylint: disable=too-many-arguments
+    def __init__(self, monitor, names, configs, reactor, batch=None, percent=None,
+                 maxInFlight=None, gate=False, interval=1, timeout=60, agent=None, slots=None):
+        if batch is None:
+            if percent is None:
+                batch = 1
+            else:
+                batch = int(math.ceil(len(names) * percent / 100))
+        batch = max(batch, 1)
+        if maxInFlight is None:
+            maxInFlight = batch
+        self.monitor = monitor
+        self.pending = collections.deque(names)
+        self.configs = configs
+        self.reactor = reactor
+        self.batch = batch
+        self.maxInFlight = maxInFlight
+        self.gate = gate
+        self.interval = interval
+        self.timeout = timeout
+        self.agent = agent
+        self.slots = {} if slots is None else slots
+        self.inFlight = {}
+        self.healthy = set()
+        self.probes = {}
+        self.call = None
+    ## pylint: enable=too-many-arguments
+
+    def start(self):
+        """Start restarting"""
+        log.msg("Starting rolling restart of %d monitored processes" % len(self.pending))
+        self._tick()
+
+    def stop(self):
+        """Stop restarting, leaving processes which were not restarted alone"""
+        if self.call is not None:
+            self.call.cancel()
+            self.call = None
+        for probe in list(self.probes.values()):
+            probe.cancel()
+        self.pending.clear()
+        self.inFlight.clear()
+
+    @property
+    def done(self):
+        """Whether all processes are back"""
+        return not self.pending and not self.inFlight
+
+    def _tick(self):
+        self.call = None
+        now = self.reactor.seconds()
+        for name, stopped in list(self.inFlight.items()):
+            if name not in self.configs:
+                del self.inFlight[name]
+            elif self._isBack(name, stopped):
+                del self.inFlight[name]
+            elif now - stopped > self.timeout:
+                log.msg("Rolling restart gave up waiting for: ", name)
+                del self.inFlight[name]
+        stopped = 0
+        while self.pending and len(self.inFlight) < self.maxInFlight and stopped < self.batch:
+            name = self.pending.popleft()
+            if name not in self.configs:
+                continue
+            self.healthy.discard(name)
+            beat = self.configs[name].get('ncolony.beatcheck')
+            if self.gate and beat is not None and beat.get('transport') == 'datagram':
+                log.msg("Rolling restart cannot see datagram beats of: ", name)
+            self.monitor.stopProcess(name)
+            self.inFlight[name] = now
+            stopped += 1
+        if self.done:
+            log.msg("Finished rolling restart")
+            return
+        self.call = self.reactor.callLater(self.interval, self._tick)
+
+    def _isBack(self, name, stopped):
+        if name not in self.monitor.protocols:
+            return False
+        started = self.monitor.timeStarted.get(name, stopped)
+        if started < stopped:
+            return False
+        if not self.gate:
+            return True
+        config = self.configs[name]
+        beat = config.get('ncolony.beatcheck')
+        if beat is not None and not self._beatSince(beat, name, started):
+            return False
+        http = config.get('ncolony.httpcheck')
+        if http is not None and name not in self.healthy:
+            self._probe(name, http)
+            return False
+        return True
+
+    def _beatSince(self, params, name, started):
+        transport = params.get('transport', 'file')
+        if transport == 'file':
+            return _statusBeatSince(params, name, started)
+        if transport == 'mmap' and name in self.slots:
+            return _slotBeatSince(params, self.slots[name], name, started,
+                                  self.reactor.seconds())
+        return False
+
+    def _probe(self, name, params):
+        if name in self.probes:
+            return
+        if self.agent is None:
+            self.agent = client.Agent(self.reactor)
+        url = params['url']
+        if not isinstance(url, bytes):
+            url = url.encode('utf-8')
+        d = self.probes[name] = self.agent.request(b'GET', url)
+        delayedCall = self.reactor.callLater(params.get('timeout', self.timeout), d.cancel)
+        def _read(response):
+            return client.readBody(response).addCallback(lambda dummy: response.code)
+        def _done(result):
+            del self.probes[name]
+            if delayedCall.active():
+                delayedCall.cancel()
+            return result
+        def _healthy(code):
+            if 200 <= code < 300:
+                self.healthy.add(name)
+        d.addCallback(_read)
+        d.addBoth(_done)
+        d.addCallbacks(_healthy, lambda dummy: None)
+
+## pylint: enable=too-many-instance-attributes
+
+def _statusBeatSince(params, name, started):
+    status = filepath.FilePath(params['status'])
+    if status.isdir():
+        status = status.child(name)
+    if not status.exists():
+        return False
+    return status.getModificationTime() >= started
+
+def _slotBeatSince(params, slot, name, started, now):
+    try:
+        with open(params['table'], 'rb') as fp:
+            fp.seek(slot * heart.SLOT_SIZE)
+            content = fp.read(heart.SLOT_SIZE)
+    except (IOError, OSError):
+        return False
+    if len(content) < heart.SLOT_SIZE:
+        return False
+    timestamp, slotName = struct.unpack(heart.SLOT_FORMAT, content)
+    if not timestamp or slotName.rstrip(b'\0').decode('utf-8', 'replace') != name:
+        return False
+    return now - (time.monotonic() - timestamp) >= started
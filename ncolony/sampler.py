@@ -0,0 +1,124 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""ncolony.sampler
+==================
+
+Sample the resource use of monitored processes from :code:`/proc`.
+
+Every sampling interval, the sampler reads :code:`stat`, :code:`statm`,
+:code:`status` and :code:`fd` for the PID of each running monitored
+process, and adds a :py:class:`Sample` to the process's ring buffer
+of recent samples. The buffer outlives restarts of the process,
+and is dropped once the process is removed.
+
+The samples are available through the control socket
+(see :py:mod:`ncolony.control`).
+"""
+
+import collections
+import os
+import time
+
+Sample = collections.namedtuple('Sample', 'time pid cpu rss threads fds ctxSwitches')
+
+TICKS = os.sysconf('SC_CLK_TCK')
+
+PAGE_SIZE = os.sysconf('SC_PAGE_SIZE')
+
+_CTXT_SWITCHES = frozenset(['voluntary_ctxt_switches', 'nonvoluntary_ctxt_switches'])
+
+def _read(path):
+    with open(path) as fp:
+        return fp.read()
+
+def readSample(pid, now, proc='/proc'):
+    """Read the resource use of a process
+
+    :params pid: integer, the process id
+    :params now: number, the time to put in the sample
+    :params proc: string, where procfs is mounted
+    :returns: Sample, or None if the process is gone
+    """
+    base = os.path.join(proc, str(pid))
+    try:
+        stat = _read(os.path.join(base, 'stat'))
+        statm = _read(os.path.join(base, 'statm'))
+        status = _read(os.path.join(base, 'status'))
+        fds = len(os.listdir(os.path.join(base, 'fd')))
+    except (IOError, OSError):
+        return None
+    fields = stat[stat.rindex(')') + 2:].split()
+    ctxSwitches = sum(int(line.split()[1]) for line in status.splitlines()
+                      if line.split(':')[0] in _CTXT_SWITCHES)
+    return Sample(time=now, pid=pid,
+                  cpu=(int(fields[11]) + int(fields[12])) / TICKS,
+                  rss=int(statm.split()[1]) * PAGE_SIZE,
+                  threads=int(fields[17]),
+                  fds=fds,
+                  ctxSwitches=ctxSwitches)
+
+class Sampler(object):
+
+    """Keep recent samples of monitored processes
+
+    :params monitor: a ProcessMonitor
+    :params size: integer, number of samples to keep for each process
+    :params proc: string, where procfs is mounted
+    :params timer: a function of zero arguments, intended to return current time
+    """
+
+    def __init__(self, monitor, size=60, proc='/proc', timer=time.time):
+        self.monitor = monitor
+        self.size = size
+        self.proc = proc
+        self.timer = timer
+        self.samples = {}
+
+    def sample(self):
+        """Sample every running monitored process"""
+        now = self.timer()
+        ## pylint: disable=protected-access
+        processes = self.monitor._processes
+        ## pylint: enable=protected-access
+        for name in list(self.samples):
+            if name not in processes:
+                del self.samples[name]
+        for name, proto in sorted(self.monitor.protocols.items()):
+            pid = getattr(proto.transport, 'pid', None)
+            if pid is None:
+                continue
+            sample = readSample(pid, now, self.proc)
+            if sample is None:
+                continue
+            if name not in self.samples:
+                self.samples[name] = collections.deque(maxlen=self.size)
+            self.samples[name].append(sample)
+
+    def summary(self, name):
+        """Describe the latest resource use of a process
+
+        :params name: string, name of the process
+        :returns: dict with the latest sample's fields, and the CPU use
+                  (in CPUs) since the previous sample of the same process;
+                  or None if there are no samples
+        """
+        samples = self.samples.get(name)
+        if not samples:
+            return None
+        latest = samples[-1]
+        ret = latest._asdict()
+        ret['cpuRate'] = None
+        if len(samples) > 1:
+            previous = samples[-2]
+            if previous.pid == latest.pid and latest.time > previous.time:
+                ret['cpuRate'] = (latest.cpu - previous.cpu) / (latest.time - previous.time)
+        return ret
+
+    def recent(self, name):
+        """All kept samples of a process
+
+        :params name: string, name of the process
+        :returns: list of dicts, oldest first
+        """
+        return [sample._asdict() for sample in self.samples.get(name, ())]
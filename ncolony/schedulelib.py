@@ -9,7 +9,6 @@ Construct a Twisted service for process scheduling.
 
    $ twistd -n ncolonysched --timeout 2 --grace 1 --frequency 10 --arg /bin/echo --arg hello
 """
-from __future__ import print_function
 
 import os
 
@@ -24,6 +23,7 @@ from twisted.internet import reactor as tireactor
 
 from twisted.application import internet as tainternet, service
 
+from ncolony import instrument
 from ncolony.client import heart
 
 @interface.implementer(tiinterfaces.IProcessProtocol)
@@ -101,6 +101,9 @@ class Options(usage.Options):
         ['grace', None, None,
          'Time between terminating the command and sending an umaskable kill', int],
         ['frequency', None, None, 'How often to run the command', int],
+        ['metrics', None, None, 'Endpoint to serve metrics on'],
+        ['slow-threshold', None, None, 'Seconds from which runs are slow, '
+         'and the reactor stalled', float],
     ]
 
     def __init__(self):
@@ -120,12 +123,16 @@ def makeService(opts):
     """Make scheduler service
 
     :params opts: dict-like object.
-       keys: frequency, args, timeout, grace
+       keys: frequency, args, timeout, grace, (optionally) metrics, slow-threshold
     """
-    ser = tainternet.TimerService(opts['frequency'], runProcess, opts['args'],
+    _, instrumentation, services = instrument.fromOptions(opts)
+    runner = instrument.wrap(instrumentation, 'scheduler', runProcess)
+    ser = tainternet.TimerService(opts['frequency'], runner, opts['args'],
                                   opts['timeout'], opts['grace'], tireactor)
     ret = service.MultiService()
     ser.setName('scheduler')
     ser.setServiceParent(ret)
+    for metricService in services:
+        metricService.setServiceParent(ret)
     heart.maybeAddHeart(ret)
     return ret
@@ -14,11 +14,14 @@ in the configuration directory (and shuts them down if the files
 ago away), and listens for restart messages on the messages directory.
 """
 
+import time
+
 from twisted.python import usage
 from twisted.application import service as taservice, internet
-from twisted.runner import procmon as procmonlib, procmontap
+from twisted.runner import procmontap
 
-from ncolony import directory_monitor, process_events
+from ncolony import adopt as nadopt, control as ncontrol, directory_monitor, instrument
+from ncolony import metrics as nmetrics, monitor, process_events, sampler
 
 ## pylint: disable=too-few-public-methods
 
@@ -49,8 +52,34 @@ class TransportDirectoryDict(dict):
 
 ## pylint: enable=too-few-public-methods
 
+def _collect(registry, procmon, receiver):
+    registry.collect('ncolony_processes', 'Number of monitored processes', 'gauge',
+                     lambda: [({}, len(receiver.processes))])
+    registry.collect('ncolony_process_running', 'Whether a process is running', 'gauge',
+                     lambda: [(dict(name=name), int(name in procmon.protocols))
+                              for name in receiver.processes])
+    registry.collect('ncolony_process_exits_total', 'Times a process exited', 'counter',
+                     lambda: [(dict(name=name), count)
+                              for name, count in procmon.exits.items()])
+    registry.collect('ncolony_restart_delay_seconds',
+                     'Delay before restarting a process after it exits', 'gauge',
+                     lambda: [(dict(name=name), delay)
+                              for name, delay in procmon.delay.items()])
+    registry.collect('ncolony_process_parked', 'Whether a process is parked', 'gauge',
+                     lambda: [(dict(name=name), 1) for name in procmon.parked])
+    registry.collect('ncolony_messages_total', 'Messages processed', 'counter',
+                     lambda: [(dict(type=tp), count)
+                              for tp, count in receiver.messageCounts.items()])
+
+def _timer(reactor):
+    if reactor is None:
+        return time.time
+    return reactor.seconds
 
-def get(config, messages, freq, pidDir=None, reactor=None):
+## pylint: disable=too-many-arguments,too-many-locals
+def get(config, messages, freq, pidDir=None, reactor=None, inotify=False, stat=False,
+        control=None, batchSize=None, batchDelay=1, semantic=False, restartCooldown=0,
+        sampleFreq=None, sampleSize=60, metrics=None, slowThreshold=None, adopt=False):
     """Return a service which monitors processes based on directory contents
 
     Construct and return a service that, when started, will run processes
@@ -67,26 +96,97 @@ def get(config, messages, freq, pidDir=None, reactor=None):
     :param reactor: something implementing the interfaces
                        {twisted.internet.interfaces.IReactorTime} and
                        {twisted.internet.interfaces.IReactorProcess} and
+    :param inotify: boolean, whether to also watch the configuration and
+                    messages directories with inotify, so changes are noticed
+                    without waiting for the next check
+    :param stat: boolean, whether to only re-read configuration files
+                 whose modification time, size or inode changed
+    :param control: string or None, location of a Unix socket to listen
+                    on for control commands
+    :param batchSize: integer or None, maximum number of configuration
+                      changes to apply at once
+    :param batchDelay: number, seconds between applying batches of
+                       configuration changes
+    :param semantic: boolean, whether to only restart processes when their
+                     arguments, uid, gid or environment change
+    :param restartCooldown: number, seconds to ignore restart messages for
+                            a process after it was restarted
+    :param sampleFreq: number or None, frequency to sample the resource
+                       use of monitored processes from /proc
+    :param sampleSize: integer, number of samples to keep for each process
+    :param metrics: string or None, server endpoint description to serve
+                    metrics on (see :py:mod:`ncolony.metrics`)
+    :param slowThreshold: number or None, seconds from which scans are
+                          slow and the reactor is stalled
+                          (see :py:mod:`ncolony.instrument`)
+    :param adopt: boolean, whether to record processes in the pid directory,
+                  leave them running when stopped, and adopt them when
+                  started again (see :py:mod:`ncolony.adopt`)
     :returns: service, {twisted.application.interfaces.IService}
     """
     ret = taservice.MultiService()
     args = ()
     if reactor is not None:
         args = reactor,
-    procmon = procmonlib.ProcessMonitor(*args)
-    if pidDir is not None:
+    procmon = monitor.ProcessMonitor(*args)
+    if pidDir is not None and adopt:
+        # From the command line, the pid directory is a string
+        procmon.table = nadopt.ProcessTable(getattr(pidDir, 'path', pidDir))
+    elif pidDir is not None:
         protocols = TransportDirectoryDict(pidDir)
         procmon.protocols = protocols
     procmon.setName('procmon')
-    receiver = process_events.Receiver(procmon)
-    confcheck = directory_monitor.checker(config, receiver)
+    receiver = process_events.Receiver(procmon, reactor=reactor,
+                                       batchSize=batchSize, batchDelay=batchDelay,
+                                       semantic=semantic)
+    confcheck = directory_monitor.checker(config, receiver, stat=stat)
+    messagecheck = directory_monitor.messages(messages, receiver, cooldown=restartCooldown,
+                                              timer=_timer(reactor))
+    registry = None
+    if metrics is not None:
+        registry = nmetrics.Registry()
+        _collect(registry, procmon, receiver)
+        nmetrics.serve(registry, metrics, reactor=reactor).setServiceParent(ret)
+    instrumentation, instrumentServices = instrument.makeInstrumentation(registry, slowThreshold,
+                                                                         reactor=reactor)
+    for instrumentService in instrumentServices:
+        instrumentService.setServiceParent(ret)
+    confcheck = instrument.wrap(instrumentation, 'config', confcheck)
+    messagecheck = instrument.wrap(instrumentation, 'messages', messagecheck)
     confserv = internet.TimerService(freq, confcheck)
+    confserv.clock = reactor
     confserv.setServiceParent(ret)
-    messagecheck = directory_monitor.messages(messages, receiver)
+    if inotify:
+        confwatch = directory_monitor.Watcher(config, confcheck, reactor=reactor)
+        confwatch.setName('confwatch')
+        confwatch.setServiceParent(ret)
     messageserv = internet.TimerService(freq, messagecheck)
+    messageserv.clock = reactor
     messageserv.setServiceParent(ret)
+    if inotify:
+        messagewatch = directory_monitor.Watcher(messages, messagecheck,
+                                                 mask=directory_monitor.MESSAGES_MASK,
+                                                 reactor=reactor)
+        messagewatch.setName('messagewatch')
+        messagewatch.setServiceParent(ret)
+    resources = None
+    if sampleFreq is not None:
+        resources = sampler.Sampler(procmon, size=sampleSize, timer=_timer(reactor))
+        sampleserv = internet.TimerService(sampleFreq, instrument.wrap(instrumentation, 'sampler',
+                                                                       resources.sample))
+        sampleserv.clock = reactor
+        sampleserv.setName('sampler')
+        sampleserv.setServiceParent(ret)
+    if control is not None:
+        controller = ncontrol.Controller(config, confcheck, messages, messagecheck, receiver,
+                                         procmon, sampler=resources)
+        controlserv = internet.UNIXServer(control, ncontrol.ControlFactory(controller),
+                                          mode=0o600, wantPID=True, reactor=reactor)
+        controlserv.setName('control')
+        controlserv.setServiceParent(ret)
     procmon.setServiceParent(ret)
     return ret
+## pylint: enable=too-many-arguments,too-many-locals
 
 ## pylint: disable=too-few-public-methods
 
@@ -99,13 +199,39 @@ class Options(usage.Options):
         ["messages", None, None, "Directory for messages"],
         ["frequency", None, 10, "Frequency of checking for updates", float],
         ["pid", None, None, "Directory of PID files"],
+        ["control", None, None, "Unix socket to listen on for control commands"],
+        ["batch-size", None, None, "Maximum number of configuration changes to apply at once",
+         int],
+        ["batch-delay", None, 1, "Seconds between applying batches of configuration changes",
+         float],
+        ["restart-cooldown", None, 0, "Seconds to ignore restart messages for a process "
+         "after it was restarted", float],
+        ["sample-frequency", None, None, "Frequency of sampling the resource use "
+         "of processes", float],
+        ["sample-size", None, 60, "Number of resource samples to keep for each process", int],
+        ["metrics", None, None, "Endpoint to serve metrics on"],
+        ["slow-threshold", None, None, "Seconds from which scans are slow, "
+         "and the reactor stalled", float],
     ] + procmontap.Options.optParameters
 
+    optFlags = [
+        ["inotify", None, "Watch for configuration changes and messages with inotify"],
+        ["stat", None, "Only re-read configuration files whose metadata changed"],
+        ["semantic", None, "Only restart processes when their command line, "
+         "user, group or environment change"],
+        ["adopt", None, "Leave processes running when stopped, "
+         "and adopt them when started again (needs --pid)"],
+    ]
+
     def postOptions(self):
         """Checks that required messages/config directories are present"""
         for param in ('messages', 'config'):
             if self[param] is None:
                 raise usage.UsageError("Missing required", param)
+        if self['inotify'] and directory_monitor.inotify is None:
+            raise usage.UsageError("inotify is not available on this platform")
+        if self['adopt'] and self['pid'] is None:
+            raise usage.UsageError("--adopt needs --pid")
 
 ## pylint: enable=too-few-public-methods
 
@@ -113,12 +239,19 @@ def makeService(opt):
     """Return a service based on parsed command-line options
 
     :param opt: dict-like object. Relevant keys are config, messages,
-                pid, frequency, threshold, killtime, minrestartdelay
-                and maxrestartdelay
+                pid, frequency, inotify, stat, semantic, control, batch-size,
+                batch-delay, restart-cooldown, sample-frequency, sample-size,
+                metrics, slow-threshold, adopt, threshold, killtime,
+                minrestartdelay and maxrestartdelay
     :returns: service, {twisted.application.interfaces.IService}
     """
     ret = get(config=opt['config'], messages=opt['messages'],
-              pidDir=opt['pid'], freq=opt['frequency'])
+              pidDir=opt['pid'], freq=opt['frequency'], inotify=opt['inotify'],
+              stat=opt['stat'], control=opt['control'],
+              batchSize=opt['batch-size'], batchDelay=opt['batch-delay'],
+              semantic=opt['semantic'], restartCooldown=opt['restart-cooldown'],
+              sampleFreq=opt['sample-frequency'], sampleSize=opt['sample-size'],
+              metrics=opt['metrics'], slowThreshold=opt['slow-threshold'], adopt=opt['adopt'])
     pm = ret.getServiceNamed("procmon")
     pm.threshold = opt["threshold"]
     pm.killTime = opt["killtime"]
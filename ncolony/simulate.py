@@ -0,0 +1,380 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""ncolony.simulate
+===================
+
+Run a colony in simulated time.
+
+A :py:class:`Simulation` runs the real supervisor
+(:py:func:`ncolony.service.get`), heart beat check
+(:py:func:`ncolony.beatcheck.makeService`) and HTTP check
+(:py:func:`ncolony.httpcheck.makeService`) on a
+:py:class:`SimulatedReactor`: a :py:class:`twisted.internet.task.Clock`
+which keeps a table of simulated processes instead of spawning real
+ones. How each process behaves -- when it exits, how often it beats,
+when it hangs and whether it answers HTTP checks -- is given by a
+:py:class:`Behaviour`. Hours of a colony of thousands of processes
+run in seconds, and a simulation always runs the same way, so restart
+storms, backoff and how checks are spread out can be reproduced in tests.
+
+.. code-block:: python
+
+   sim = simulate.Simulation('/tmp/colony',
+                             lambda name: simulate.Behaviour(lifetime=30, beat=5))
+   for index in range(1000):
+       sim.add('worker-%d' % index, {'ncolony.beatcheck': dict(period=10, grace=3)})
+   sim.start()
+   sim.run(3600)
+   print(sim.reactor.spawned.most_common(10))
+
+The configuration, messages and heart beat status directories are
+real files in a scratch directory, but their modification times are
+in simulated time: configurations are touched when added, and the
+status files when the processes beat. Simulated time starts at
+:code:`START` (some time in 2001), so that the modification times are
+not in the future of the wall-clock time.
+"""
+
+import collections
+import itertools
+import os
+import random
+
+from zope import interface
+
+from twisted.application import service as taservice
+from twisted.internet import base, defer, error, interfaces, task
+from twisted.python import failure
+
+from ncolony import beatcheck, ctllib, httpcheck, service
+
+START = 1000000000
+
+FIRST_PID = 1000
+
+Behaviour = collections.namedtuple('Behaviour', 'lifetime beat hang healthy stubborn')
+Behaviour.__new__.__defaults__ = (None, None, None, True, False)
+Behaviour.__doc__ = """How a simulated process behaves
+
+:params lifetime: number, seconds after which the process exits
+                  by itself, or None to run until it is stopped
+:params beat: number, seconds between heart beats, or None to never beat
+:params hang: number, seconds after which the process stops beating
+              and answering HTTP checks, or None to never hang
+:params healthy: boolean, whether the process answers HTTP checks
+:params stubborn: boolean, whether the process ignores SIGTERM
+"""
+
+class SimulatedProcess(object):
+
+    """A process in the simulated process table
+
+    :params reactor: the SimulatedReactor
+    :params pid: integer, the process id
+    :params name: string, the name of the process
+    :params protocol: the IProcessProtocol
+    :params behaviour: Behaviour
+    """
+
+    ## pylint: disable=too-many-arguments
+    def __init__(self, reactor, pid, name, protocol, behaviour):
+        self.reactor = reactor
+        self.pid = pid
+        self.name = name
+        self.protocol = protocol
+        self.behaviour = behaviour
+        self.started = reactor.seconds()
+        self.exiting = False
+        self.ended = None
+        self.call = None
+        if behaviour.lifetime is not None:
+            self.call = reactor.callLater(behaviour.lifetime, self._end,
+                                          error.ProcessTerminated(exitCode=1))
+    ## pylint: enable=too-many-arguments
+
+    def hung(self, now):
+        """Whether the process has hung
+
+        :params now: current time
+        :returns: boolean
+        """
+        hang = self.behaviour.hang
+        return hang is not None and now >= self.started + hang
+
+    def lastBeat(self, now):
+        """When the process last beat
+
+        :params now: current time
+        :returns: the time of the last beat, or None if it never beat
+        """
+        period = self.behaviour.beat
+        if period is None:
+            return None
+        if self.behaviour.hang is not None:
+            now = min(now, self.started + self.behaviour.hang)
+        if now < self.started + period:
+            return None
+        return self.started + (now - self.started) // period * period
+
+    def signalProcess(self, signal):
+        """Send a signal
+
+        The process exits on the next reactor iteration, unless it
+        is stubborn and the signal is TERM.
+
+        :params signal: string, the signal's name
+        :raises: twisted.internet.error.ProcessExitedAlready
+        """
+        if self.exiting or self.ended is not None:
+            raise error.ProcessExitedAlready()
+        if signal == 'TERM' and self.behaviour.stubborn:
+            return
+        self.exiting = True
+        self.reactor.callLater(0, self._end, error.ProcessTerminated(signal=signal))
+
+    def _end(self, reason):
+        if self.ended is not None:
+            return
+        if self.call is not None and self.call.active():
+            self.call.cancel()
+        self.ended = self.reactor.seconds()
+        self.reactor.reap(self)
+        self.protocol.processEnded(failure.Failure(reason))
+
+@interface.implementer(interfaces.IReactorProcess)
+class SimulatedReactor(task.Clock):
+
+    """A clock with a table of simulated processes
+
+    Processes are named by their protocol's :code:`name`
+    (as set by the process monitor).
+
+    :params behaviour: a function of a process name, returning its Behaviour
+    """
+
+    def __init__(self, behaviour):
+        task.Clock.__init__(self)
+        self.behaviour = behaviour
+        self.processes = {}
+        self.running = {}
+        self.spawned = collections.Counter()
+        self.pids = itertools.count(FIRST_PID)
+
+    ## pylint: disable=too-many-arguments,unused-argument
+    def spawnProcess(self, processProtocol, executable, args=(), env=None, path=None,
+                     uid=None, gid=None, usePTY=0, childFDs=None):
+        """Start a simulated process
+
+        :returns: SimulatedProcess
+        """
+        name = processProtocol.name
+        process = SimulatedProcess(self, next(self.pids), name, processProtocol,
+                                   self.behaviour(name))
+        self.processes[process.pid] = process
+        self.running[name] = process
+        self.spawned[name] += 1
+        processProtocol.makeConnection(process)
+        return process
+    ## pylint: enable=too-many-arguments,unused-argument
+
+    def callLater(self, delay, function, *args, **kwargs):
+        """Call a function later
+
+        Unlike :py:class:`twisted.internet.task.Clock`, which sorts all
+        its calls whenever one is added or run, a call is inserted in
+        order, so thousands of pending calls stay cheap.
+
+        :returns: twisted.internet.base.DelayedCall
+        """
+        call = base.DelayedCall(self.seconds() + delay, function, args, kwargs,
+                                self.calls.remove, self._resort, self.seconds)
+        when = call.getTime()
+        low, high = 0, len(self.calls)
+        while low < high:
+            middle = (low + high) // 2
+            if when < self.calls[middle].getTime():
+                high = middle
+            else:
+                low = middle + 1
+        self.calls.insert(low, call)
+        return call
+
+    def _resort(self, dummyCall):
+        self.calls.sort(key=lambda call: call.getTime())
+
+    def advance(self, amount):
+        """Move time forward, and run the calls which are due
+
+        :params amount: number, seconds
+        """
+        self.rightNow += amount
+        while self.calls and self.calls[0].getTime() <= self.rightNow:
+            call = self.calls.pop(0)
+            call.called = 1
+            call.func(*call.args, **call.kw)
+
+    def reap(self, process):
+        """Remove a process which ended from the table
+
+        :params process: SimulatedProcess
+        """
+        del self.processes[process.pid]
+        if self.running.get(process.name) is process:
+            del self.running[process.name]
+
+## pylint: disable=too-few-public-methods
+class SimulatedAgent(object):
+
+    """An HTTP agent answering for simulated processes
+
+    A running healthy process answers at once, one which is hung or
+    unhealthy never answers, and a request to a process which is not
+    running is refused.
+
+    :params reactor: the SimulatedReactor
+    :params names: dict mapping URLs to process names
+    """
+
+    def __init__(self, reactor, names):
+        self.reactor = reactor
+        self.names = names
+
+    ## pylint: disable=unused-argument
+    def request(self, method, uri, headers=None, bodyProducer=None):
+        """Make a request
+
+        :returns: Deferred
+        """
+        process = self.reactor.running.get(self.names.get(uri))
+        if process is None:
+            return defer.fail(error.ConnectionRefusedError())
+        if process.hung(self.reactor.seconds()) or not process.behaviour.healthy:
+            return defer.Deferred()
+        return defer.succeed(None)
+    ## pylint: enable=unused-argument
+## pylint: enable=too-few-public-methods
+
+def _healthy(dummyName):
+    return Behaviour()
+
+class Simulation(object):
+
+    """A colony running in simulated time
+
+    The supervisor, heart beat check and HTTP check all scan and
+    check every :code:`freq` seconds. Further options for the
+    supervisor (see :py:func:`ncolony.service.get`) are given in
+    :code:`options`; the process monitor's own parameters can be
+    set on :code:`monitor`.
+
+    :params location: string, an empty directory for the configuration,
+                      messages and status files
+    :params behaviour: a function of a process name, returning its Behaviour
+    :params freq: number, seconds between scans and checks
+    :params start: number, simulated time to start at
+    :params seed: the seed for spreading out HTTP checks
+    :params options: dict, keyword arguments for :py:func:`ncolony.service.get`,
+                     or None
+    """
+
+    ## pylint: disable=too-many-arguments
+    def __init__(self, location, behaviour=_healthy, freq=10, start=START, seed=0,
+                 options=None):
+        self.places = ctllib.Places(config=os.path.join(location, 'config'),
+                                    messages=os.path.join(location, 'messages'))
+        self.status = os.path.join(location, 'status')
+        for place in (self.places.config, self.places.messages, self.status):
+            os.makedirs(place)
+        self.reactor = SimulatedReactor(behaviour)
+        self.reactor.advance(start)
+        self.names = {}
+        self.beats = {}
+        self.service = taservice.MultiService()
+        supervisor = service.get(self.places.config, self.places.messages, freq,
+                                 reactor=self.reactor, **(options or {}))
+        supervisor.setServiceParent(self.service)
+        self.monitor = supervisor.getServiceNamed('procmon')
+        opt = {'config': self.places.config, 'messages': self.places.messages,
+               'freq': freq, 'config-freq': freq}
+        beatcheck.makeService(opt, reactor=self.reactor).setServiceParent(self.service)
+        settings = httpcheck.Settings(reactor=self.reactor,
+                                      agent=SimulatedAgent(self.reactor, self.names),
+                                      random=random.Random(seed).random)
+        httpcheck.makeService(opt, settings=settings).setServiceParent(self.service)
+    ## pylint: enable=too-many-arguments
+
+    def _touch(self, path, when):
+        os.utime(path, (when, when))
+
+    def add(self, name, extras=None):
+        """Add (or change) a process
+
+        A :code:`ncolony.beatcheck` section gets the simulation's status
+        directory, and a :code:`ncolony.httpcheck` section a URL the
+        simulated agent answers for, unless they are given.
+
+        :params name: string, the name of the process
+        :params extras: dict, more configuration, or None
+        """
+        config = dict(extras or {})
+        if beatcheck.Index.KEY in config:
+            config[beatcheck.Index.KEY] = dict(config[beatcheck.Index.KEY])
+            config[beatcheck.Index.KEY].setdefault('status', self.status)
+        if httpcheck.State.KEY in config:
+            config[httpcheck.State.KEY] = dict(config[httpcheck.State.KEY])
+            url = config[httpcheck.State.KEY].setdefault('url', 'http://%s/' % name)
+            self.names[url] = name
+        ctllib.add(self.places, name, 'simulated', [name], extras=config)
+        self._touch(os.path.join(self.places.config, name), self.reactor.seconds())
+
+    def remove(self, name):
+        """Remove a process
+
+        :params name: string, the name of the process
+        """
+        ctllib.remove(self.places, name)
+
+    def start(self):
+        """Start the services"""
+        self.service.startService()
+
+    def beat(self):
+        """Touch the status files of the processes which beat since the last time"""
+        now = self.reactor.seconds()
+        for name, process in self.reactor.running.items():
+            last = process.lastBeat(now)
+            if last is None or self.beats.get(name) == last:
+                continue
+            self.beats[name] = last
+            path = os.path.join(self.status, name)
+            with open(path, 'a'):
+                pass
+            self._touch(path, last)
+
+    def run(self, seconds, step=1):
+        """Run for a while
+
+        Time moves from one timed call to the next, so every call runs
+        at its own time, and beats are written every :code:`step` seconds.
+
+        :params seconds: number, how long to run for
+        :params step: number, seconds between beats
+        """
+        end = self.reactor.seconds() + seconds
+        nextBeat = self.reactor.seconds() + step
+        while self.reactor.seconds() < end:
+            until = min(end, nextBeat)
+            if self.reactor.calls:
+                until = min(until, self.reactor.calls[0].getTime())
+            self.reactor.advance(until - self.reactor.seconds())
+            if self.reactor.seconds() >= nextBeat:
+                self.beat()
+                nextBeat += step
+
+    def stop(self):
+        """Stop the services, and run until every process exited"""
+        self.service.stopService()
+        self.reactor.advance(0)
+        if self.reactor.processes:
+            self.reactor.advance(self.monitor.killTime)
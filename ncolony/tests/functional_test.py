@@ -2,7 +2,6 @@
 # See LICENSE for details.
 
 """Functional/integration test for ncolony"""
-from __future__ import print_function
 
 import errno
 import os
@@ -3,8 +3,6 @@
 
 """Automatic nitpicker, so humans won't have to"""
 
-from __future__ import print_function
-
 import difflib
 import os
 import sys
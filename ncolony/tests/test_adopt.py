@@ -0,0 +1,256 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Tests for ncolony.adopt"""
+
+import json
+import os
+import select
+import shutil
+import signal
+import subprocess
+import unittest
+
+from zope.interface import verify
+
+from twisted.internet import error, interfaces
+from twisted.runner import procmon as procmonlib
+from twisted.test import proto_helpers
+
+from ncolony import adopt
+
+def startChild(testCase):
+    """Start a process which sleeps, and make sure it is gone after the test
+
+    :params testCase: the TestCase
+    :returns: subprocess.Popen
+    """
+    child = subprocess.Popen(['sleep', '60'])
+    def _cleanup():
+        if child.poll() is None:
+            child.kill()
+            child.wait()
+    testCase.addCleanup(_cleanup)
+    return child
+
+class RecordingProtocol(object):
+
+    """Record what happens to a process"""
+
+    def __init__(self):
+        self.transport = None
+        self.ended = []
+
+    def makeConnection(self, transport):
+        """Record the transport"""
+        self.transport = transport
+
+    def processEnded(self, reason):
+        """Record the process ending"""
+        self.ended.append(reason)
+
+class BaseTableTest(unittest.TestCase):
+
+    """Set up a pid directory"""
+
+    def setUp(self):
+        """Set up the test"""
+        self.directory = os.path.abspath('dummy-pids')
+        def _cleanup():
+            if os.path.exists(self.directory):
+                shutil.rmtree(self.directory)
+        _cleanup()
+        self.addCleanup(_cleanup)
+        self.table = adopt.ProcessTable(self.directory)
+        self.reactor = proto_helpers.MemoryReactor()
+        self.protocol = RecordingProtocol()
+
+class TestSpec(unittest.TestCase):
+
+    """Tests for hashing and identifying processes"""
+
+    def test_hash(self):
+        """The hash depends on every parameter, not on the order of the environment"""
+        env = dict(A='1', B='2')
+        process = procmonlib._Process(['/bin/foo'], None, None, env, None)
+        same = procmonlib._Process(['/bin/foo'], None, None, dict(B='2', A='1'), None)
+        self.assertEquals(adopt.specHash(process), adopt.specHash(same))
+        for changed in [procmonlib._Process(['/bin/bar'], None, None, env, None),
+                        procmonlib._Process(['/bin/foo'], 5, None, env, None),
+                        procmonlib._Process(['/bin/foo'], None, 5, env, None),
+                        procmonlib._Process(['/bin/foo'], None, None, {}, None),
+                        procmonlib._Process(['/bin/foo'], None, None, env, '/')]:
+            self.assertNotEqual(adopt.specHash(process), adopt.specHash(changed))
+
+    def test_spec_hash_bytes(self):
+        """Bytes in the environment are hashed as text, and other values cannot be hashed"""
+        process = procmonlib._Process(['/bin/foo'], None, None, dict(A=b'{}'), None)
+        same = procmonlib._Process(['/bin/foo'], None, None, dict(A='{}'), None)
+        self.assertEquals(adopt.specHash(process), adopt.specHash(same))
+        process = procmonlib._Process(['/bin/foo'], None, None, dict(A=object()), None)
+        with self.assertRaises(TypeError):
+            adopt.specHash(process)
+
+    def test_can_record(self):
+        """A process can be recorded with parameters which only differ in its configuration"""
+        env = dict(NCOLONY_CONFIG='{}', A='1')
+        process = procmonlib._Process(['/bin/foo'], 5, 6, env, '/')
+        self.assertTrue(adopt.canRecord(process, process))
+        same = procmonlib._Process(['/bin/foo'], 5, 6, dict(env, NCOLONY_CONFIG='[]'), '/')
+        self.assertTrue(adopt.canRecord(process, same))
+        for changed in [procmonlib._Process(['/bin/foo'], 5, 6, dict(env, A='2'), '/'),
+                        procmonlib._Process(['/bin/bar'], 5, 6, env, '/'),
+                        procmonlib._Process(['/bin/foo'], 7, 6, env, '/'),
+                        procmonlib._Process(['/bin/foo'], 5, 7, env, '/'),
+                        procmonlib._Process(['/bin/foo'], 5, 6, env, '/tmp')]:
+            self.assertFalse(adopt.canRecord(process, changed))
+
+    def test_start(self):
+        """The start time is the 22nd field of the process's stat"""
+        self.assertIsInstance(adopt.processStart(os.getpid()), int)
+        proc = os.path.abspath('dummy-proc')
+        self.addCleanup(shutil.rmtree, proc)
+        os.makedirs(os.path.join(proc, '5'))
+        fields = ['0'] * 18 + ['12345', '0']
+        with open(os.path.join(proc, '5', 'stat'), 'w') as fp:
+            fp.write('5 (a (strange) name) S ' + ' '.join(fields) + '\n')
+        self.assertEquals(adopt.processStart(5, proc), 12345)
+        self.assertIsNone(adopt.processStart(6, proc))
+
+class TestTable(BaseTableTest):
+
+    """Tests for recording processes"""
+
+    def test_record(self):
+        """Recording writes the pid file and the record, forgetting removes them"""
+        child = startChild(self)
+        self.table.record('foo', child.pid, 'spec', 5)
+        with open(os.path.join(self.directory, 'foo')) as fp:
+            self.assertEquals(fp.read(), str(child.pid))
+        with open(os.path.join(self.directory, adopt.TABLE, 'foo')) as fp:
+            details = json.loads(fp.read())
+        self.assertEquals(details, dict(pid=child.pid, spec='spec', started=5,
+                                        processStart=adopt.processStart(child.pid)))
+        self.assertEquals(os.listdir(os.path.join(self.directory, adopt.TABLE)), ['foo'])
+        self.table.forget('foo')
+        self.table.forget('foo')
+        self.assertEquals(os.listdir(self.directory), [adopt.TABLE])
+        self.assertEquals(adopt.ProcessTable(self.directory).records, self.table.records)
+
+    def test_adopt(self):
+        """A running process with the same spec is adopted, and watched with a pidfd"""
+        child = startChild(self)
+        self.table.record('foo', child.pid, 'spec', 5)
+        transport = self.table.adopt('foo', 'spec', self.reactor, self.protocol)
+        verify.verifyObject(interfaces.IReadDescriptor, transport)
+        self.assertIs(self.protocol.transport, transport)
+        self.assertEquals((transport.pid, transport.started), (child.pid, 5))
+        self.assertFalse(transport.stale)
+        self.assertEquals(transport.logPrefix(), 'AdoptedProcess')
+        self.assertIn(transport, self.reactor.getReaders())
+        transport.signalProcess('TERM')
+        self.assertEquals(child.wait(), -signal.SIGTERM)
+        readable, _, _ = select.select([transport.fileno()], [], [], 10)
+        self.assertEquals(readable, [transport.fileno()])
+        transport.doRead()
+        transport.connectionLost(None)
+        self.assertNotIn(transport, self.reactor.getReaders())
+        reason, = self.protocol.ended
+        self.assertTrue(reason.check(error.ProcessTerminated))
+        with self.assertRaises(error.ProcessExitedAlready):
+            transport.signalProcess('KILL')
+
+    def test_signal_exited(self):
+        """Signalling a process which exited fails"""
+        child = startChild(self)
+        self.table.record('foo', child.pid, 'spec', 5)
+        transport = self.table.adopt('foo', 'spec', self.reactor, self.protocol)
+        child.kill()
+        child.wait()
+        with self.assertRaises(error.ProcessExitedAlready):
+            transport.signalProcess('TERM')
+        transport.fd = -1
+        with self.assertRaises(OSError):
+            transport.signalProcess('TERM')
+
+    def test_nothing(self):
+        """A process without a valid record is not adopted"""
+        self.assertIsNone(self.table.adopt('foo', 'spec', self.reactor, self.protocol))
+        with open(os.path.join(self.table.records, 'foo'), 'w') as fp:
+            fp.write('not json')
+        self.assertIsNone(self.table.adopt('foo', 'spec', self.reactor, self.protocol))
+        self.assertEquals(os.listdir(self.table.records), [])
+
+    def test_reused(self):
+        """A pid which started at another time is not the process"""
+        child = startChild(self)
+        self.table.record('foo', os.getpid(), 'spec', 5)
+        path = os.path.join(self.table.records, 'foo')
+        with open(path) as fp:
+            details = json.loads(fp.read())
+        details['pid'] = child.pid
+        with open(path, 'w') as fp:
+            fp.write(json.dumps(details))
+        self.assertIsNone(self.table.adopt('foo', 'spec', self.reactor, self.protocol))
+        self.assertIsNone(child.poll())
+        self.assertEquals(os.listdir(self.table.records), [])
+
+    def test_changed(self):
+        """A running process with another spec is adopted as stale, and left running"""
+        child = startChild(self)
+        self.table.record('foo', child.pid, 'spec', 5)
+        transport = self.table.adopt('foo', 'other', self.reactor, self.protocol)
+        self.assertTrue(transport.stale)
+        self.assertIsNone(child.poll())
+        transport.signalProcess('TERM')
+        self.assertEquals(child.wait(), -signal.SIGTERM)
+        transport.doRead()
+        self.assertEquals(len(self.protocol.ended), 1)
+
+    def test_no_pidfd(self):
+        """Without pidfds, a running process is stopped"""
+        child = startChild(self)
+        table = adopt.ProcessTable(self.directory, pidfdOpen=None)
+        table.record('foo', child.pid, 'spec', 5)
+        self.assertIsNone(table.adopt('foo', 'spec', self.reactor, self.protocol))
+        self.assertEquals(child.wait(), -signal.SIGTERM)
+
+    def test_exited_while_adopting(self):
+        """A process which exits before its pidfd is opened is not adopted"""
+        def _pidfdOpen(dummyPid):
+            raise OSError()
+        child = startChild(self)
+        table = adopt.ProcessTable(self.directory, pidfdOpen=_pidfdOpen)
+        table.record('foo', child.pid, 'spec', 5)
+        self.assertIsNone(table.adopt('foo', 'spec', self.reactor, self.protocol))
+        self.assertEquals(os.listdir(self.table.records), [])
+
+    def test_clean(self):
+        """Processes which are not configured are stopped and forgotten"""
+        configured = startChild(self)
+        removed = startChild(self)
+        self.table.record('foo', configured.pid, 'spec', 5)
+        self.table.record('bar', removed.pid, 'spec', 5)
+        self.table.record('baz', os.getpid(), 'spec', 5)
+        os.remove(os.path.join(self.directory, 'baz'))
+        with open(os.path.join(self.table.records, 'baz'), 'w') as fp:
+            fp.write(json.dumps(dict(pid=os.getpid(), spec='spec', started=5,
+                                     processStart=None)))
+        self.table.clean(['foo'])
+        self.assertEquals(removed.wait(), -signal.SIGTERM)
+        self.assertIsNone(configured.poll())
+        self.assertEquals(os.listdir(self.table.records), ['foo'])
+
+    def test_stop_exited(self):
+        """Stopping a process which just exited is fine"""
+        child = startChild(self)
+        self.table.record('foo', child.pid, 'spec', 5)
+        oldKill = os.kill
+        def _kill(pid, sig):
+            oldKill(pid, signal.SIGKILL)
+            child.wait()
+            oldKill(pid, sig)
+        os.kill = _kill
+        self.addCleanup(setattr, os, 'kill', oldKill)
+        self.table.clean([])
+        self.assertEquals(os.listdir(self.table.records), [])
@@ -6,14 +6,17 @@
 import functools
 import os
 import shutil
+import socket
 import time
 import unittest
 
 from twisted.python import filepath, usage
 
 from twisted.application import internet as tainternet
+from twisted.internet import error, task
 
-from ncolony import beatcheck, ctllib
+from ncolony import beatcheck, ctllib, directory_monitor, instrument, metrics
+from ncolony.client import heart
 from ncolony.client.tests import test_heart
 from ncolony.tests import helper
 
@@ -142,6 +145,156 @@ class TestBeatChecker(unittest.TestCase):
         self.assertFalse(self.checker(mtime, mtime))
         self.assertEquals(set(self.checker(mtime, mtime+11)), set(['foo', 'bar']))
 
+    def test_index(self):
+        """Test that the index only reports processes whose deadline passed"""
+        index = beatcheck.Index(self.filepath, 0)
+        check = directory_monitor.checker(self.path, index, stat=True)
+        status = os.path.join(self.status, 'foo')
+        heartParams = {'ncolony.beatcheck': {'period': 10, 'grace': 3, 'status': status}}
+        fooFile = self.filepath.child('foo')
+        fooFile.setContent(helper.dumps2utf8(heartParams))
+        os.utime(fooFile.path, (100, 100))
+        self.filepath.child('bar').setContent(helper.dumps2utf8({}))
+        check()
+        self.assertEquals(sorted(index.entries), ['foo'])
+        self.assertFalse(index.check(130))
+        self.assertEquals(index.check(131), ['foo'])
+        self.assertFalse(index.check(140))
+        statusFile = filepath.FilePath(status)
+        statusFile.setContent(b"111")
+        os.utime(status, (155, 155))
+        self.assertFalse(index.check(162))
+        self.assertEquals(len(index.heap), 1)
+        self.assertFalse(index.check(165))
+        self.assertEquals(index.check(166), ['foo'])
+
+    def test_index_status_dir(self):
+        """Test that the status can be a directory"""
+        index = beatcheck.Index(self.filepath, 100)
+        heartParams = {'ncolony.beatcheck': {'period': 10, 'grace': 1, 'status': self.status}}
+        index.add('foo', helper.dumps2utf8(heartParams))
+        statusFile = filepath.FilePath(self.status).child('foo')
+        statusFile.setContent(b"111")
+        os.utime(statusFile.path, (105, 105))
+        self.assertFalse(index.check(111))
+        self.assertEquals(index.check(116), ['foo'])
+
+    def test_index_replicas(self):
+        """Test that each replica beats on its own"""
+        index = beatcheck.Index(self.filepath, 100)
+        heartParams = {'ncolony.beatcheck': {'period': 10, 'grace': 1, 'status': self.status},
+                       'replicas': 2}
+        index.add('foo', helper.dumps2utf8(heartParams))
+        self.assertEquals(sorted(index.entries), ['foo.0', 'foo.1'])
+        statusFile = filepath.FilePath(self.status).child('foo.1')
+        statusFile.setContent(b"111")
+        os.utime(statusFile.path, (105, 105))
+        self.assertEquals(index.check(111), ['foo.0'])
+        index.remove('foo')
+        self.assertEquals(index.entries, {})
+
+    def test_index_bad(self):
+        """Test that configurations which cannot be parsed are skipped"""
+        index = beatcheck.Index(self.filepath, 100)
+        configs = dict(a={'ncolony.beatcheck': {'grace': 1, 'status': self.status},
+                          'replicas': 2},
+                       b={'ncolony.beatcheck': {'period': 10, 'grace': 1, 'status': self.status}},
+                       c={'ncolony.beatcheck': ['period']})
+        for name, config in configs.items():
+            self.filepath.child(name).setContent(helper.dumps2utf8(config))
+        self.filepath.child('d').setContent(b'{')
+        directory_monitor.checker(self.path, index)()
+        self.assertEquals((list(index.entries), index.replicas), (['b'], {}))
+
+    def test_index_changes(self):
+        """Test that changed and removed configurations are not checked"""
+        index = beatcheck.Index(self.filepath, 100)
+        heartParams = {'ncolony.beatcheck': {'period': 10, 'grace': 1, 'status': self.status}}
+        index.add('foo', helper.dumps2utf8(heartParams))
+        index.add('bar', helper.dumps2utf8(heartParams))
+        index.remove('bar')
+        index.remove('baz')
+        index.begin()
+        index.add('foo', helper.dumps2utf8({}))
+        index.commit()
+        self.assertFalse(index.entries)
+        self.assertFalse(index.check(200))
+        self.assertFalse(index.heap)
+
+    def test_index_datagram(self):
+        """Test that beats for the datagram transport are kept in memory"""
+        index = beatcheck.Index(self.filepath, 100)
+        heartParams = {'ncolony.beatcheck': {'period': 10, 'grace': 1, 'transport': 'datagram',
+                                       'socket': 'beats.sock'}}
+        index.add('foo', helper.dumps2utf8(heartParams))
+        index.beat('bar', 105)
+        self.assertEquals(index.beats, {})
+        index.beat('foo', 105)
+        self.assertFalse(index.check(111))
+        self.assertEquals(index.check(116), ['foo'])
+        proto = beatcheck.BeatProtocol(index, lambda: 120)
+        proto.datagramReceived(b'foo', None)
+        proto.datagramReceived(b'\xff', None)
+        self.assertEquals(index.beats, dict(foo=120))
+        index.beat('foo', 110)
+        self.assertEquals(index.beats, dict(foo=120))
+        self.assertFalse(index.check(130))
+        index.remove('foo')
+        self.assertEquals(index.beats, {})
+
+    def test_beat_server(self):
+        """Test the beat server replaces a stale socket"""
+        address = os.path.join(self.status, 'beats.sock')
+        stale = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+        stale.bind(address)
+        stale.close()
+        index = beatcheck.Index(self.filepath, 100)
+        server = beatcheck.BeatServer(address, beatcheck.BeatProtocol(index, time.time))
+        server.privilegedStartService()
+        server.startService()
+        self.addCleanup(server.stopService)
+        self.assertTrue(os.path.exists(address))
+
+    def test_beat_server_no_socket(self):
+        """Test the beat server leaves things which are not sockets alone"""
+        address = os.path.join(self.status, 'beats.sock')
+        index = beatcheck.Index(self.filepath, 100)
+        server = beatcheck.BeatServer(address, beatcheck.BeatProtocol(index, time.time))
+        server.privilegedStartService()
+        server.startService()
+        server.stopService()
+        os.remove(address)
+        os.makedirs(address)
+        server = beatcheck.BeatServer(address, beatcheck.BeatProtocol(index, time.time))
+        with self.assertRaises(error.CannotListenError):
+            server.privilegedStartService()
+        self.assertTrue(os.path.isdir(address))
+
+    def test_table(self):
+        """Test that beats written to the table are passed to the index"""
+        path = os.path.join(self.status, 'beats')
+        index = beatcheck.Index(self.filepath, 100)
+        heartParams = {'ncolony.beatcheck': {'period': 10, 'grace': 1, 'transport': 'mmap',
+                                             'table': path}}
+        for name in ['foo', 'bar']:
+            index.add(name, helper.dumps2utf8(heartParams))
+        table = beatcheck.HeartTable(path, 4, timer=lambda: 1000.0)
+        checker = functools.partial(beatcheck._checkTable, table, index)
+        self.assertFalse(checker(105))
+        table.startService()
+        self.assertEquals(os.path.getsize(path), 4 * heart.SLOT_SIZE)
+        myHeart = heart.TableHeart(path, 2, u'foo', timer=lambda: 995.0)
+        myHeart.beat()
+        self.addCleanup(myHeart.table.close)
+        self.assertEquals(checker(111), ['bar'])
+        self.assertEquals(index.beats, dict(foo=106))
+        table.stopService()
+        self.assertIsNone(table.table)
+        table = beatcheck.HeartTable(path, 2, timer=lambda: 1000.0)
+        table.startService()
+        self.addCleanup(table.stopService)
+        self.assertEquals(os.path.getsize(path), 4 * heart.SLOT_SIZE)
+
     def test_run(self):
         """Test the runner"""
         _checker_args = []
@@ -159,9 +312,7 @@ class TestBeatChecker(unittest.TestCase):
 
     def test_make_service(self):
         """Test makeService"""
-        opt = dict(config='config',
-                   messages='messages',
-                   freq=5)
+        opt = {'config': 'config', 'messages': 'messages', 'freq': 5, 'config-freq': 7}
         before = time.time()
         masterService = beatcheck.makeService(opt)
         service = masterService.getServiceNamed("beatcheck")
@@ -177,12 +328,96 @@ class TestBeatChecker(unittest.TestCase):
         self.assertFalse(restarter.keywords)
         places, = restarter.args
         self.assertEquals(places, ctllib.Places(config='config', messages='messages'))
-        self.assertIs(checker.func, beatcheck.check)
-        self.assertFalse(checker.keywords)
-        path, start = checker.args
-        self.assertEquals(path.basename(), 'config')
-        self.assertLessEqual(before, start)
-        self.assertLessEqual(start, after)
+        index = checker.__self__
+        self.assertIsInstance(index, beatcheck.Index)
+        self.assertEquals(index.path.basename(), 'config')
+        self.assertLessEqual(before, index.start)
+        self.assertLessEqual(index.start, after)
+        configService = masterService.getServiceNamed("beatcheck-config")
+        self.assertEquals(configService.step, 7)
+        configCheck, args, kwargs = configService.call
+        self.assertFalse(args)
+        self.assertFalse(kwargs)
+        self.assertEquals(configCheck.args[0].basename(), 'config')
+        with self.assertRaises(KeyError):
+            masterService.getServiceNamed("beatcheck-watch")
+        with self.assertRaises(KeyError):
+            masterService.getServiceNamed("beatcheck-socket")
+        with self.assertRaises(KeyError):
+            masterService.getServiceNamed("beatcheck-table")
+
+    def test_make_service_reactor(self):
+        """Test makeService running on a given reactor"""
+        clock = task.Clock()
+        clock.advance(1000)
+        opt = {'config': 'config', 'messages': 'messages', 'freq': 5, 'config-freq': 7,
+               'socket': 'beats.sock'}
+        masterService = beatcheck.makeService(opt, reactor=clock)
+        service = masterService.getServiceNamed("beatcheck")
+        self.assertIs(service.clock, clock)
+        dummyRestarter, checker, timer = service.call[1]
+        self.assertEquals(timer, clock.seconds)
+        self.assertEquals(checker.__self__.start, 1000)
+        self.assertIs(masterService.getServiceNamed("beatcheck-config").clock, clock)
+        server = masterService.getServiceNamed("beatcheck-socket")
+        self.assertIs(server.reactor, clock)
+        self.assertEquals(server.args[1].timer, clock.seconds)
+
+    def test_make_service_table(self):
+        """Test makeService reading beats from a table"""
+        opt = {'config': 'config', 'messages': 'messages', 'freq': 5, 'config-freq': 7,
+               'table': 'beats', 'slots': 20}
+        masterService = beatcheck.makeService(opt)
+        table = masterService.getServiceNamed("beatcheck-table")
+        self.assertEquals((table.path, table.slots), ('beats', 20))
+        checker = masterService.getServiceNamed("beatcheck").call[1][1]
+        self.assertIs(checker.func, beatcheck._checkTable)
+        tableArg, index = checker.args
+        self.assertIs(tableArg, table)
+        self.assertIsInstance(index, beatcheck.Index)
+
+    def test_make_service_socket(self):
+        """Test makeService listening for datagram beats"""
+        opt = {'config': 'config', 'messages': 'messages', 'freq': 5, 'config-freq': 7,
+               'socket': 'beats.sock'}
+        masterService = beatcheck.makeService(opt)
+        server = masterService.getServiceNamed("beatcheck-socket")
+        self.assertIsInstance(server, beatcheck.BeatServer)
+        address, proto = server.args
+        self.assertEquals(address, 'beats.sock')
+        index = masterService.getServiceNamed("beatcheck").call[1][1].__self__
+        self.assertIs(proto.index, index)
+        self.assertIs(proto.timer, time.time)
+
+    def test_make_service_inotify(self):
+        """Test makeService with an inotify watcher"""
+        opt = {'config': 'config', 'messages': 'messages', 'freq': 5, 'config-freq': 7,
+               'inotify': True}
+        masterService = beatcheck.makeService(opt)
+        configService = masterService.getServiceNamed("beatcheck-config")
+        watcher = masterService.getServiceNamed("beatcheck-watch")
+        self.assertEquals(watcher.location, os.path.abspath('config'))
+        self.assertIs(watcher.check, configService.call[0])
+
+    def test_make_service_metrics(self):
+        """Test makeService serving metrics, and timing checks and scans"""
+        opt = {'config': 'config', 'messages': 'messages', 'freq': 5, 'config-freq': 7,
+               'metrics': 'tcp:0', 'slow-threshold': 2}
+        masterService = beatcheck.makeService(opt)
+        callableThing, (restarter, dummyChecker, dummyTimer), _ = \
+            masterService.getServiceNamed("beatcheck").call
+        self.assertIs(callableThing.func, instrument.timed)
+        instrumentation, name, dummyTimer, runner = callableThing.args
+        self.assertEquals((name, runner), ('beatcheck', beatcheck.run))
+        self.assertIs(restarter.func, metrics.counted)
+        self.assertIs(restarter.args[1].func, ctllib.restart)
+        server = masterService.getServiceNamed("metrics")
+        metricsInstrumentation = instrumentation.instrumentations[0]
+        self.assertIn(metricsInstrumentation.callbacks, server.factory.resource.registry.metrics)
+        configCheck = masterService.getServiceNamed("beatcheck-config").call[0]
+        self.assertEquals(configCheck.args[:2], (instrumentation, 'beatcheck-config'))
+        masterService.getServiceNamed("lag")
+        masterService.getServiceNamed("watchdog")
 
     def test_make_service_with_health(self):
         """Test beatcheck with heart beater"""
@@ -190,9 +425,7 @@ class TestBeatChecker(unittest.TestCase):
 
 def testWrappedHeart(utest, serviceMaker):
     """Service has a child heart beater"""
-    opt = dict(config='config',
-               messages='messages',
-               freq=5)
+    opt = {'config': 'config', 'messages': 'messages', 'freq': 5, 'config-freq': 5}
     test_heart.replaceEnvironment(utest)
     masterService = serviceMaker(opt)
     service = masterService.getServiceNamed('heart')
@@ -223,6 +456,30 @@ class TestOptions(unittest.TestCase):
         self.assertEqual(self.opt['messages'], 'message-dir')
         self.assertEqual(self.opt['config'], 'config-dir')
         self.assertEqual(self.opt['freq'], 10)
+        self.assertEqual(self.opt['config-freq'], 10)
+        self.assertEqual(self.opt['slots'], 1024)
+        self.assertIsNone(self.opt['table'])
+        self.assertFalse(self.opt['inotify'])
+
+    def test_config_freq(self):
+        """Test explicit config-freq"""
+        self.opt.parseOptions(self.basic+['--config-freq', '60'])
+        self.assertEqual(self.opt['config-freq'], 60)
+
+    def test_inotify(self):
+        """Test explicit inotify"""
+        self.opt.parseOptions(self.basic+['--inotify'])
+        self.assertTrue(self.opt['inotify'])
+
+    def test_inotify_unavailable(self):
+        """Test inotify is refused when the platform does not support it"""
+        oldInotify = directory_monitor.inotify
+        def _cleanup():
+            directory_monitor.inotify = oldInotify
+        self.addCleanup(_cleanup)
+        directory_monitor.inotify = None
+        with self.assertRaises(usage.UsageError):
+            self.opt.parseOptions(self.basic+['--inotify'])
 
     def test_freq(self):
         """Test explicit freq"""
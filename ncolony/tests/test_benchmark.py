@@ -0,0 +1,164 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Tests for ncolony.benchmark"""
+
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+import ncolony
+from ncolony import benchmark
+
+NAMES = ['config-initial', 'config-steady', 'config-steady-stat', 'config-change',
+         'messages', 'beatcheck', 'httpcheck']
+
+class BaseBenchmarkTest(unittest.TestCase):
+
+    """Set up a directory to generate colonies in"""
+
+    def setUp(self):
+        """Set up the test"""
+        self.location = os.path.abspath('dummy-benchmark')
+        def _cleanup():
+            if os.path.exists(self.location):
+                shutil.rmtree(self.location)
+        _cleanup()
+        os.makedirs(self.location)
+        self.addCleanup(_cleanup)
+
+class TestGenerate(BaseBenchmarkTest):
+
+    """Tests for generating colonies"""
+
+    def test_generate(self):
+        """Every process has a configuration, and half have a heart beat"""
+        places = benchmark.generate(os.path.join(self.location, 'colony'), 5)
+        self.assertEquals(sorted(os.listdir(places['config'])),
+                          ['process-%d' % index for index in range(5)])
+        self.assertEquals(os.listdir(places['messages']), [])
+        self.assertEquals(sorted(os.listdir(places['status'])),
+                          ['process-0', 'process-2', 'process-4'])
+        with open(os.path.join(places['config'], 'process-3')) as fp:
+            config = json.loads(fp.read())
+        self.assertEquals(config['args'], ['/bin/true', '3'])
+        self.assertEquals(config['ncolony.beatcheck']['status'], places['status'])
+        self.assertEquals(config['ncolony.httpcheck']['url'], 'http://localhost:8003/')
+
+class TestFakes(unittest.TestCase):
+
+    """Tests for the fake monitor and agent"""
+
+    def test_monitor(self):
+        """The monitor counts what it is asked to do"""
+        monitor = benchmark.FakeMonitor()
+        monitor.addProcess('foo', ['/bin/true'])
+        monitor.updateProcess('foo', ['/bin/false'], env={})
+        monitor.setPolicy('foo', None)
+        monitor.stopProcess('foo')
+        monitor.restartAll()
+        monitor.removeProcess('foo')
+        self.assertEquals(dict(monitor.calls), dict(addProcess=1, updateProcess=1,
+                                                    setPolicy=1, stopProcess=1,
+                                                    restartAll=1, removeProcess=1))
+
+    def test_agent(self):
+        """The agent answers immediately"""
+        agent = benchmark.FakeAgent()
+        results = []
+        agent.request(b'GET', b'http://localhost/').addCallback(results.append)
+        self.assertEquals((results, agent.requests), ([None], 1))
+
+class TestMeasure(BaseBenchmarkTest):
+
+    """Tests for measuring"""
+
+    def test_summarize(self):
+        """Latencies are summarized with percentiles"""
+        summary = benchmark.summarize(list(range(100, 0, -1)))
+        self.assertEquals(summary, dict(min=1, mean=50.5, p50=50, p95=95, max=100))
+        self.assertEquals(benchmark.summarize([3]), dict(min=3, mean=3, p50=3, p95=3, max=3))
+
+    def test_measure(self):
+        """Only the ticks are timed, not the preparation"""
+        now = [0]
+        calls = []
+        def _tick():
+            calls.append('tick')
+            now[0] += 2
+        def _prepare():
+            calls.append('prepare')
+            now[0] += 5
+        result = benchmark.measure('foo', _tick, 2, prepare=_prepare, timer=lambda: now[0])
+        self.assertEquals(calls, ['prepare', 'tick', 'prepare', 'tick'])
+        self.assertEquals((result['name'], result['ticks']), ('foo', 2))
+        self.assertEquals(result['latency'], dict(min=2, mean=2, p50=2, p95=2, max=2))
+        self.assertGreaterEqual(result['syscalls'], 0)
+        self.assertGreater(result['rss'], 0)
+
+    def test_no_proc(self):
+        """Without a proc filesystem, there are no system calls or memory"""
+        self.assertIsNone(benchmark.syscalls(self.location))
+        self.assertIsNone(benchmark.rss(self.location))
+
+    def test_proc(self):
+        """Read and write system calls are counted"""
+        os.makedirs(os.path.join(self.location, 'self'))
+        with open(os.path.join(self.location, 'self', 'io'), 'w') as fp:
+            fp.write('rchar: 100\nwchar: 50\nsyscr: 7\nsyscw: 3\n\n')
+        self.assertEquals(benchmark.syscalls(self.location), 10)
+
+    def test_run(self):
+        """Every kind of work is measured"""
+        results = benchmark.run(os.path.join(self.location, 'colony'), 3, 2)
+        self.assertEquals([result['name'] for result in results], NAMES)
+        self.assertEquals([result['ticks'] for result in results], [1] + [2] * 6)
+        messages = os.path.join(self.location, 'colony', 'messages')
+        self.assertEquals(os.listdir(messages), [])
+
+class TestMain(BaseBenchmarkTest):
+
+    """Tests for the command-line entry point"""
+
+    def _check(self, report, counts, ticks):
+        self.assertEquals(report['ncolony'], ncolony.__version__)
+        self.assertEquals(report['ticks'], ticks)
+        self.assertEquals([colony['processes'] for colony in report['colonies']], counts)
+        for colony in report['colonies']:
+            self.assertEquals([result['name'] for result in colony['results']], NAMES)
+
+    def test_output(self):
+        """Results are written to the output file, and colonies are kept"""
+        output = os.path.join(self.location, 'results.json')
+        directory = os.path.join(self.location, 'colonies')
+        benchmark.main(['benchmark', '--processes', '2', '--processes', '4', '--ticks', '1',
+                        '--directory', directory, '--output', output])
+        with open(output) as fp:
+            self._check(json.loads(fp.read()), [2, 4], 1)
+        self.assertEquals(sorted(os.listdir(directory)), ['2', '4'])
+
+    def test_stdout(self):
+        """Results are printed, and the temporary directory removed"""
+        oldTempdir = tempfile.tempdir
+        tempfile.tempdir = self.location
+        self.addCleanup(setattr, tempfile, 'tempdir', oldTempdir)
+        output = io.StringIO()
+        oldStdout = sys.stdout
+        def _cleanup():
+            sys.stdout = oldStdout
+        self.addCleanup(_cleanup)
+        sys.stdout = output
+        benchmark.main(['benchmark', '--processes', '3'])
+        _cleanup()
+        self._check(json.loads(output.getvalue()), [3], 10)
+        self.assertEquals(os.listdir(self.location), [])
+
+    def test_defaults(self):
+        """By default, colonies of 100, 1000 and 10000 processes are measured"""
+        args = benchmark.PARSER.parse_args([])
+        self.assertEquals((args.processes, args.ticks, args.directory, args.output),
+                          (None, 10, None, None))
@@ -0,0 +1,205 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Tests for ncolony.connectcheck"""
+
+import os
+
+from twisted.python import failure, filepath, usage
+from twisted.internet import defer, error, reactor
+from twisted.application import internet as tainternet
+from twisted.trial import unittest
+from twisted.test import proto_helpers
+
+from ncolony import connectcheck, httpcheck
+from ncolony.tests import test_beatcheck, test_httpcheck, helper
+
+class TestProbe(unittest.TestCase):
+
+    """Test the probe protocol"""
+
+    def _connect(self, send=None, expect=None):
+        probe = connectcheck._Probe(send, expect)
+        transport = proto_helpers.StringTransport()
+        probe.makeConnection(transport)
+        return probe, transport
+
+    def test_connect(self):
+        """Without anything to expect, connecting is enough"""
+        probe, transport = self._connect()
+        self.assertEquals(transport.value(), b'')
+        self.assertTrue(transport.disconnecting)
+        self.assertIsNone(self.successResultOf(probe.done))
+        probe.dataReceived(b'hello')
+        probe.connectionLost(failure.Failure(error.ConnectionDone()))
+
+    def test_expect(self):
+        """The probe waits for the expected bytes"""
+        probe, transport = self._connect(send=b'PING\r\n', expect=b'+PONG')
+        self.assertEquals(transport.value(), b'PING\r\n')
+        self.assertNoResult(probe.done)
+        probe.dataReceived(b'garbage+PO')
+        self.assertNoResult(probe.done)
+        self.assertFalse(transport.disconnecting)
+        probe.dataReceived(b'NG\r\n')
+        self.assertIsNone(self.successResultOf(probe.done))
+        self.assertTrue(transport.disconnecting)
+
+    def test_lost(self):
+        """Losing the connection before the expected bytes arrive fails"""
+        probe, dummyTransport = self._connect(expect=b'+PONG')
+        probe.connectionLost(failure.Failure(error.ConnectionDone()))
+        self.failureResultOf(probe.done, error.ConnectionDone)
+
+class TestState(test_httpcheck.BaseTestHTTPChecker):
+
+    """Test connect check states"""
+
+    def setUp(self):
+        test_httpcheck.BaseTestHTTPChecker.setUp(self)
+        self.params = {'ncolony.connectcheck': dict(endpoint='tcp:host=localhost:port=6379',
+                                                    send=u'PING\r\n',
+                                                    expect=u'+PONG',
+                                                    period=1,
+                                                    grace=1,
+                                                    maxBad=0,
+                                                    timeout=1)}
+        self.index = httpcheck.Index(self.filepath, self.settings,
+                                     stateFactory=connectcheck.State)
+
+    def _connect(self):
+        self.index.add('foo', helper.dumps2utf8(self.params))
+        self.reactor.advance(2.1)
+        self.assertFalse(self.index.check())
+        host, port, factory, dummyTimeout, dummyBind = self.reactor.tcpClients.pop()
+        self.assertEquals((host, port), ('localhost', 6379))
+        return factory
+
+    def test_no_check(self):
+        """Configurations without a connectcheck section are ignored"""
+        self.index.add('foo', helper.dumps2utf8({'ncolony.httpcheck': {}}))
+        self.assertEquals(self.index.states, {})
+
+    def test_good_check(self):
+        """A check succeeds once the expected bytes arrive"""
+        factory = self._connect()
+        state = self.index.states['foo']
+        self.assertEquals((state.send, state.expect), (b'PING\r\n', b'+PONG'))
+        self.assertIsNotNone(state.call)
+        protocol = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        protocol.makeConnection(transport)
+        self.assertEquals(transport.value(), b'PING\r\n')
+        protocol.dataReceived(b'+PONG\r\n')
+        self.assertIsNone(state.call)
+        self.assertEquals(state.card.bad, 0)
+        self.assertEquals(len(self.reactor.getDelayedCalls()), 0)
+
+    def test_refused(self):
+        """A check fails when the connection is refused"""
+        factory = self._connect()
+        state = self.index.states['foo']
+        factory.clientConnectionFailed(None, failure.Failure(error.ConnectionRefusedError()))
+        self.assertEquals(len(self.flushLoggedErrors(error.ConnectionRefusedError)), 1)
+        self.assertEquals(state.card.bad, 1)
+        self.reactor.advance(1.1)
+        self.assertEquals(self.index.check(), ['foo'])
+
+    def test_timeout_connecting(self):
+        """Checks which cannot connect in time are cancelled"""
+        self._connect()
+        state = self.index.states['foo']
+        self.reactor.advance(1)
+        self.assertEquals(len(self.flushLoggedErrors(error.ConnectingCancelledError)), 1)
+        self.assertEquals(state.card.bad, 1)
+
+    def test_timeout_expecting(self):
+        """Checks which do not get an answer in time are aborted"""
+        factory = self._connect()
+        state = self.index.states['foo']
+        protocol = factory.buildProtocol(None)
+        transport = proto_helpers.StringTransport()
+        protocol.makeConnection(transport)
+        self.reactor.advance(1)
+        self.assertTrue(transport.disconnecting)
+        self.assertEquals(len(self.flushLoggedErrors(defer.CancelledError)), 1)
+        self.assertEquals(state.card.bad, 1)
+        protocol.connectionLost(failure.Failure(error.ConnectionAborted()))
+
+    def test_unix(self):
+        """Unix sockets are just another endpoint"""
+        self.params['ncolony.connectcheck'] = dict(endpoint='unix:path=/run/foo.sock',
+                                                   period=1, grace=1, maxBad=0, timeout=1)
+        self.settings = httpcheck.Settings(reactor=self.reactor, agent=None,
+                                           limiter=httpcheck.Limiter(maxPerHost=1))
+        self.index = httpcheck.Index(self.filepath, self.settings,
+                                     stateFactory=connectcheck.State)
+        self.index.add('foo', helper.dumps2utf8(self.params))
+        self.reactor.advance(2.1)
+        self.assertFalse(self.index.check())
+        self.assertEquals(list(self.settings.limiter.hosts), ['unix:path=/run/foo.sock'])
+        address, factory, dummyTimeout, dummyBind = self.reactor.unixClients.pop()
+        self.assertEquals(address, '/run/foo.sock')
+        protocol = factory.buildProtocol(None)
+        protocol.makeConnection(proto_helpers.StringTransport())
+        state = self.index.states['foo']
+        self.assertIsNone(state.call)
+        self.assertEquals(state.card.bad, 0)
+
+class TestService(unittest.TestCase):
+
+    """Test the connect check service"""
+
+    def test_make_service(self):
+        """Test makeService"""
+        opt = {'config': 'config', 'messages': 'messages', 'freq': 5, 'config-freq': 7,
+               'max-per-host': 1}
+        masterService = connectcheck.makeService(opt)
+        service = masterService.getServiceNamed("connectcheck")
+        self.assertIsInstance(service, tainternet.TimerService)
+        self.assertEquals(service.step, 5)
+        callableThing, args, dummyKwargs = service.call
+        self.assertIs(callableThing, httpcheck.run)
+        dummyRestarter, checker = args
+        index = checker.__self__
+        self.assertIs(index.stateFactory, connectcheck.State)
+        self.assertEquals(index.path, filepath.FilePath(os.path.abspath('config')))
+        self.assertIs(index.settings.reactor, reactor)
+        self.assertIsNone(index.settings.agent)
+        self.assertIsNone(index.settings.limiter.overall)
+        self.assertEquals(index.settings.limiter.maxPerHost, 1)
+        configService = masterService.getServiceNamed("connectcheck-config")
+        self.assertEquals(configService.step, 7)
+
+    def test_make_service_unlimited(self):
+        """Without limits, there is no limiter"""
+        opt = {'config': 'config', 'messages': 'messages', 'freq': 5, 'config-freq': 7}
+        masterService = connectcheck.makeService(opt)
+        service = masterService.getServiceNamed("connectcheck")
+        self.assertIsNone(service.call[1][1].__self__.settings.limiter)
+
+    def test_options(self):
+        """Test connectcheck options"""
+        opt = connectcheck.Options()
+        opt.parseOptions(['--messages', 'm', '--config', 'c', '--max-in-flight', '10'])
+        self.assertEquals(opt['max-in-flight'], 10)
+        self.assertIsNone(opt['max-per-host'])
+        self.assertNotIn('table', opt)
+        with self.assertRaises(usage.UsageError):
+            connectcheck.Options().parseOptions(['--messages', 'm', '--config', 'c',
+                                                 '--socket', 's'])
+
+    def test_make_service_metrics(self):
+        """Test makeService serving metrics"""
+        opt = {'config': 'config', 'messages': 'messages', 'freq': 5, 'config-freq': 7,
+               'metrics': 'tcp:0'}
+        masterService = connectcheck.makeService(opt)
+        callableThing, _, _ = masterService.getServiceNamed("connectcheck").call
+        self.assertEquals(callableThing.args[1], 'connectcheck')
+        self.assertIs(callableThing.args[3], httpcheck.run)
+        registry = masterService.getServiceNamed("metrics").factory.resource.registry
+        self.assertEquals(registry.metrics[-1].name, 'connectcheck_restarts_total')
+
+    def test_make_service_with_health(self):
+        """Test connectcheck with heart beater"""
+        test_beatcheck.testWrappedHeart(self, connectcheck.makeService)
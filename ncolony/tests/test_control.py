@@ -0,0 +1,251 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Tests for ncolony.control"""
+
+import collections
+import json
+import os
+import shutil
+import unittest
+
+from twisted.internet import task
+from twisted.test import proto_helpers
+
+from ncolony import control, directory_monitor, process_events, sampler
+from ncolony.tests import test_process_events
+
+DummyTransport = collections.namedtuple('DummyTransport', 'pid')
+
+## pylint: disable=too-few-public-methods
+
+class DummyProtocol(object):
+
+    """Something that looks like a process monitor protocol"""
+
+    def __init__(self, transport):
+        self.transport = transport
+
+## pylint: enable=too-few-public-methods
+
+class BaseControlTest(unittest.TestCase):
+
+    """Set up a controller on a temporary configuration directory"""
+
+    def setUp(self):
+        """Set up the test"""
+        self.config = os.path.abspath('dummy-config')
+        self.messages = os.path.abspath('dummy-messages')
+        def _cleanup():
+            for directory in (self.config, self.messages):
+                if os.path.exists(directory):
+                    shutil.rmtree(directory)
+        _cleanup()
+        self.addCleanup(_cleanup)
+        os.makedirs(self.config)
+        os.makedirs(self.messages)
+        self.monitor = test_process_events.DummyProcessMonitor()
+        self.monitor.protocols = {}
+        self._setController(process_events.Receiver(self.monitor))
+
+    def _setController(self, receiver, **kwargs):
+        self.receiver = receiver
+        check = directory_monitor.checker(self.config, self.receiver)
+        messageCheck = directory_monitor.messages(self.messages, self.receiver, **kwargs)
+        self.controller = control.Controller(self.config, check, self.messages, messageCheck,
+                                             self.receiver, self.monitor)
+        return check
+
+
+class TestController(BaseControlTest):
+
+    """Tests for Controller"""
+
+    def test_add_remove(self):
+        """Adding writes the configuration and adds the process immediately"""
+        self.controller.handle(dict(type='ADD', name='hello', config=dict(args=['/bin/echo'])))
+        with open(os.path.join(self.config, 'hello')) as fp:
+            self.assertEquals(json.loads(fp.read()), dict(args=['/bin/echo']))
+        (tp, name, args, dummyUID, dummyGID, dummyEnv), = self.monitor.events
+        self.assertEquals((tp, name, args), ('ADD', 'hello', ['/bin/echo']))
+        self.controller.handle(dict(type='REMOVE', name='hello'))
+        self.assertEquals(os.listdir(self.config), [])
+        self.assertEquals(self.monitor.events[1:], [('REMOVE', 'hello')])
+
+    def test_queued(self):
+        """Changes waiting for a later batch are reported as queued"""
+        clock = task.Clock()
+        check = self._setController(process_events.Receiver(self.monitor, reactor=clock,
+                                                            batchSize=1))
+        config = dict(args=['/bin/echo'])
+        for name in ['one', 'two']:
+            with open(os.path.join(self.config, name), 'w') as fp:
+                fp.write(json.dumps(config))
+        check()
+        self.assertEquals(self.controller.handle(dict(type='ADD', name='three', config=config)),
+                          dict(queued=True))
+        self.assertEquals(len(self.monitor.events), 1)
+        clock.advance(self.receiver.batchDelay)
+        clock.advance(self.receiver.batchDelay)
+        self.assertEquals(len(self.monitor.events), 3)
+        self.assertEquals(self.controller.handle(dict(type='REMOVE', name='one')),
+                          dict(queued=False))
+
+    def test_not_applied(self):
+        """Configurations which could not be applied are refused, until fixed"""
+        config = dict(args=['/bin/echo'])
+        self.controller.handle(dict(type='ADD', name='hello', config=dict(config, replicas=2)))
+        with self.assertRaises(ValueError) as context:
+            self.controller.handle(dict(type='ADD', name='hello.0', config=config))
+        self.assertIn('already taken', str(context.exception))
+        self.assertEquals(len(self.monitor.events), 2)
+        self.controller.handle(dict(type='REMOVE', name='hello'))
+        config = dict(args=['/bin/true'])
+        self.assertEquals(self.controller.handle(dict(type='ADD', name='hello.0', config=config)),
+                          dict(queued=False))
+
+    def test_remove_missing(self):
+        """Removing a process which does not exist fails"""
+        with self.assertRaises(EnvironmentError):
+            self.controller.handle(dict(type='REMOVE', name='hello'))
+
+    def test_bad_names(self):
+        """Names which the directory monitor ignores are refused"""
+        for name in ['.hello', 'hello.new']:
+            with self.assertRaises(ValueError):
+                self.controller.handle(dict(type='ADD', name=name, config={}))
+        self.assertEquals(os.listdir(self.config), [])
+
+    def test_restart(self):
+        """Restarts are passed to the receiver as messages"""
+        self.controller.handle(dict(type='RESTART', name='hello'))
+        self.controller.handle(dict(type='RESTART-ALL'))
+        self.assertEquals(self.monitor.events, [('RESTART', 'hello'), ('RESTART-ALL',)])
+        self.controller.handle(dict(type='RESTART-ROLLING', batch=2))
+        self.assertEquals(self.receiver.rolling.batch, 2)
+        self.assertEquals(os.listdir(self.messages), [])
+
+    def test_restart_cooldown(self):
+        """Restarts go through the messages' cooldown"""
+        clock = task.Clock()
+        self._setController(self.receiver, cooldown=10, timer=clock.seconds)
+        self.controller.handle(dict(type='RESTART', name='hello'))
+        clock.advance(5)
+        with self.assertRaises(ValueError):
+            self.controller.handle(dict(type='RESTART', name='hello'))
+        self.assertEquals(self.monitor.events, [('RESTART', 'hello')])
+        clock.advance(5)
+        self.controller.handle(dict(type='RESTART', name='hello'))
+        self.assertEquals(self.monitor.events, [('RESTART', 'hello')] * 2)
+        self.assertEquals(os.listdir(self.messages), [])
+
+    def test_unknown(self):
+        """Unknown commands are refused"""
+        with self.assertRaises(ValueError):
+            self.controller.handle(dict(type='LALALA'))
+
+    def test_status(self):
+        """Status reports processes and their pids"""
+        for name in ['hello', 'goodbye']:
+            self.controller.handle(dict(type='ADD', name=name, config=dict(args=['/bin/' + name])))
+        self.monitor.protocols['hello'] = DummyProtocol(DummyTransport(pid=5))
+        self.monitor.protocols['goodbye'] = DummyProtocol(None)
+        result = self.controller.handle(dict(type='STATUS'))
+        self.assertEquals(result, dict(processes=dict(
+            hello=dict(args=['/bin/hello'], pid=5),
+            goodbye=dict(args=['/bin/goodbye'], pid=None),
+        )))
+
+    def test_samples_not_sampling(self):
+        """Samples are refused when the service does not sample"""
+        with self.assertRaises(ValueError):
+            self.controller.handle(dict(type='SAMPLES', name='hello'))
+
+
+class TestResources(BaseControlTest):
+
+    """Tests for reporting resource use"""
+
+    def setUp(self):
+        """Set up the test"""
+        BaseControlTest.setUp(self)
+        self.sampler = sampler.Sampler(self.monitor)
+        self.controller.sampler = self.sampler
+        sample = sampler.Sample(time=5, pid=5, cpu=1.5, rss=4096, threads=2, fds=3,
+                                ctxSwitches=7)
+        self.sampler.samples['hello'] = [sample]
+        self.expected = sample._asdict()
+
+    def test_status(self):
+        """Status reports the latest resource use"""
+        for name in ['hello', 'goodbye']:
+            self.controller.handle(dict(type='ADD', name=name, config=dict(args=['/bin/' + name])))
+        self.monitor.protocols['hello'] = DummyProtocol(DummyTransport(pid=5))
+        processes = self.controller.handle(dict(type='STATUS'))['processes']
+        self.expected['cpuRate'] = None
+        self.assertEquals(processes['hello']['resources'], self.expected)
+        self.assertIsNone(processes['goodbye']['resources'])
+
+    def test_samples(self):
+        """Samples reports all kept samples"""
+        result = self.controller.handle(dict(type='SAMPLES', name='hello'))
+        self.assertEquals(result, dict(samples=[self.expected]))
+
+
+class TestProtocol(BaseControlTest):
+
+    """Tests for the control protocol"""
+
+    def setUp(self):
+        """Set up the test"""
+        BaseControlTest.setUp(self)
+        factory = control.ControlFactory(self.controller)
+        self.protocol = factory.buildProtocol(None)
+        self.transport = proto_helpers.StringTransport()
+        self.protocol.makeConnection(self.transport)
+
+    def _answers(self):
+        return [json.loads(line.decode('utf-8'))
+                for line in self.transport.value().splitlines()]
+
+    def test_pipelined(self):
+        """Several commands are answered in order"""
+        commands = [dict(type='RESTART', name='hello', id=1),
+                    dict(type='LALALA', id=2),
+                    dict(type='RESTART-ALL')]
+        self.protocol.dataReceived(b''.join(json.dumps(command).encode('utf-8') + b'\n'
+                                            for command in commands))
+        first, second, third = self._answers()
+        self.assertEquals(first, dict(ok=True, id=1))
+        self.assertEquals(second.pop('id'), 2)
+        self.assertFalse(second.pop('ok'))
+        self.assertIn('LALALA', second.pop('error'))
+        self.assertEquals(second, {})
+        self.assertEquals(third, dict(ok=True))
+        self.assertEquals(self.monitor.events, [('RESTART', 'hello'), ('RESTART-ALL',)])
+
+    def test_status(self):
+        """Status answers include the processes"""
+        self.protocol.dataReceived(b'{"type": "STATUS"}\n')
+        answer, = self._answers()
+        self.assertEquals(answer, dict(ok=True, processes={}))
+
+    def test_long(self):
+        """Long configurations are accepted, and too long lines answered with an error"""
+        config = dict(args=['/bin/echo'] + ['x' * 100] * 200)
+        line = json.dumps(dict(type='ADD', name='hello', config=config)).encode('utf-8')
+        self.protocol.dataReceived(line + b'\n')
+        answer, = self._answers()
+        self.assertTrue(answer['ok'])
+        self.protocol.dataReceived(b'x' * (self.protocol.MAX_LENGTH + 1))
+        dummy, answer = self._answers()
+        self.assertEquals(answer, dict(ok=False, error='command longer than %d bytes' %
+                                       self.protocol.MAX_LENGTH))
+        self.assertTrue(self.transport.disconnecting)
+
+    def test_garbage(self):
+        """Lines which are not JSON are answered with an error"""
+        self.protocol.dataReceived(b'hello\n')
+        answer, = self._answers()
+        self.assertFalse(answer['ok'])
+        self.assertFalse(self.transport.disconnecting)
@@ -8,10 +8,11 @@ import io
 import json
 import os
 import shutil
+import socket
+import sys
+import threading
 import unittest
 
-import six
-
 from ncolony import ctllib
 
 def jsonFrom(fname):
@@ -45,6 +46,16 @@ class TestArgParsing(unittest.TestCase):
         self.assertEquals(res.config, 'config')
         self.assertIs(res.func, ctllib.restartAll)
 
+    def test_restart_rolling(self):
+        """Check restart-rolling subcommand parsing"""
+        res = self.parser.parse_args(self.base+['restart-rolling', '--percent', '10',
+                                                '--max-in-flight', '3', '--gate'])
+        self.assertEquals(res.percent, 10)
+        self.assertEquals(res.maxInFlight, 3)
+        self.assertTrue(res.gate)
+        self.assertIsNone(res.batch)
+        self.assertIs(res.func, ctllib.restartRolling)
+
     def test_restart(self):
         """Check restart subcommand parsing"""
         res = self.parser.parse_args(self.base+['restart', 'hello'])
@@ -89,6 +100,12 @@ class TestArgParsing(unittest.TestCase):
         self.assertEquals(res.name, 'hello')
         self.assertIs(res.func, ctllib.remove)
 
+    def test_status(self):
+        """Check status subcommand parsing"""
+        res = self.parser.parse_args(self.base+['--control', 'control', 'status'])
+        self.assertEquals(res.control, 'control')
+        self.assertIs(res.func, ctllib.status)
+
     def test_call(self):
         """Check the 'call' function"""
         ns = argparse.Namespace()
@@ -105,6 +122,23 @@ class TestArgParsing(unittest.TestCase):
                           [(ctllib.Places(config='config1', messages='messages1'),
                             dict(foo='bar', baz='quux'))])
 
+    def test_call_control(self):
+        """Check the 'call' function with a control socket"""
+        ns = argparse.Namespace()
+        results = []
+        def _func(places, **kwargs):
+            results.append((places, kwargs))
+            return 5
+        ns.func = _func
+        ns.config = 'config1'
+        ns.messages = 'messages1'
+        ns.control = 'control1'
+        self.assertEquals(ctllib.call(ns), 5)
+        self.assertEquals(results,
+                          [(ctllib.ControlPlaces(config='config1', messages='messages1',
+                                                 control='control1'),
+                            {})])
+
 class TestController(unittest.TestCase):
 
     """Check the control functions"""
@@ -181,7 +215,7 @@ class TestController(unittest.TestCase):
         names = set()
         for thing in things:
             self.assertEquals(thing.pop('type'), 'RESTART')
-            (k, v), = six.iteritems(thing)
+            (k, v), = thing.items()
             self.assertEquals(k, 'name')
             names.add(v)
         self.assertEquals(names, set(('hello', 'goodbye')))
@@ -194,9 +228,113 @@ class TestController(unittest.TestCase):
         d = jsonFrom(fname)
         self.assertEquals(d, dict(type='RESTART-ALL'))
 
+    def test_restart_rolling(self):
+        """Test that restart-rolling only sends the given parameters"""
+        ctllib.restartRolling(self.places, batch=5, timeout=30)
+        fname, = os.listdir(self.places.messages)
+        fname = os.path.join(self.places.messages, fname)
+        d = jsonFrom(fname)
+        self.assertEquals(d, dict(type='RESTART-ROLLING', batch=5, timeout=30, gate=False))
+
     def test_extra_protection(self):
         """Test that messages have the PID in them"""
         ctllib.restartAll(self.places)
         fname, = os.listdir(self.places.messages)
         pid = str(os.getpid())
         self.assertIn(pid, fname)
+
+class TestControlSocket(unittest.TestCase):
+
+    """Check the control functions talking to a control socket"""
+
+    def setUp(self):
+        """Listen on a control socket"""
+        self.places = ctllib.ControlPlaces(config='config', messages='messages',
+                                           control=os.path.abspath('control.sock'))
+        def _cleanup():
+            if os.path.exists(self.places.control):
+                os.remove(self.places.control)
+        _cleanup()
+        self.addCleanup(_cleanup)
+        self.server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.addCleanup(self.server.close)
+        self.server.bind(self.places.control)
+        self.server.listen(1)
+        self.commands = []
+
+    def _answer(self, answer):
+        def _serve():
+            conn, _ = self.server.accept()
+            fp = conn.makefile('rb')
+            self.commands.append(json.loads(fp.readline().decode('utf-8')))
+            fp.close()
+            if answer is not None:
+                conn.sendall(json.dumps(answer).encode('utf-8') + b'\n')
+            conn.close()
+        thread = threading.Thread(target=_serve)
+        thread.start()
+        self.addCleanup(thread.join)
+
+    def test_add_and_remove(self):
+        """Test that add/remove are sent as commands"""
+        self._answer(dict(ok=True))
+        ctllib.add(self.places, 'hello', cmd='/bin/echo', args=['hello'], env=['world=616'])
+        self._answer(dict(ok=True))
+        ctllib.remove(self.places, 'hello')
+        self.assertEquals(self.commands,
+                          [dict(type='ADD', name='hello',
+                                config=dict(args=['/bin/echo', 'hello'], env=dict(world='616'))),
+                           dict(type='REMOVE', name='hello')])
+        self.assertFalse(os.path.exists('config'))
+
+    def test_restart(self):
+        """Test that restarts are sent as commands"""
+        self._answer(dict(ok=True))
+        ctllib.restart(self.places, 'hello')
+        self._answer(dict(ok=True))
+        ctllib.restartAll(self.places)
+        self._answer(dict(ok=True))
+        ctllib.restartRolling(self.places, percent=10, gate=True)
+        self.assertEquals(self.commands,
+                          [dict(type='RESTART', name='hello'), dict(type='RESTART-ALL'),
+                           dict(type='RESTART-ROLLING', percent=10, gate=True)])
+        self.assertFalse(os.path.exists('messages'))
+
+    def test_status(self):
+        """Test that status returns the processes"""
+        processes = dict(hello=dict(args=['/bin/echo'], pid=5))
+        self._answer(dict(ok=True, processes=processes))
+        self.assertEquals(ctllib.status(self.places), processes)
+        self.assertEquals(self.commands, [dict(type='STATUS')])
+
+    def test_status_needs_control(self):
+        """Test that status cannot be sent through the messages directory"""
+        with self.assertRaises(ValueError):
+            ctllib.status(ctllib.Places(config='config', messages='messages'))
+
+    def test_failure(self):
+        """Test that failed commands raise an error"""
+        self._answer(dict(ok=False, error='no such process'))
+        with self.assertRaises(ctllib.ControlError) as context:
+            ctllib.restart(self.places, 'hello')
+        self.assertEquals(context.exception.args[0], 'no such process')
+
+    def test_no_answer(self):
+        """Test that commands the service did not answer raise an error"""
+        self._answer(None)
+        with self.assertRaises(ctllib.ControlError):
+            ctllib.restart(self.places, 'hello')
+
+    def test_main(self):
+        """Test that status via the main() function prints the processes"""
+        processes = dict(hello=dict(args=['/bin/echo'], pid=5))
+        self._answer(dict(ok=True, processes=processes))
+        output = io.StringIO()
+        oldStdout = sys.stdout
+        def _cleanup():
+            sys.stdout = oldStdout
+        self.addCleanup(_cleanup)
+        sys.stdout = output
+        ctllib.main(['ctl', '--messages', 'messages', '--config', 'config',
+                     '--control', self.places.control, 'status'])
+        self.assertEquals(json.loads(output.getvalue()), processes)
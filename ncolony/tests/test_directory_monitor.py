@@ -3,6 +3,7 @@
 
 """Test the directory monitoring code"""
 
+import json
 import os
 import shutil
 import unittest
@@ -10,8 +11,13 @@ import unittest
 from zope import interface
 from zope.interface import verify
 
+from twisted.internet import reactor
+from twisted.python import filepath
+from twisted.test import proto_helpers
+
 from ncolony import directory_monitor
 from ncolony import interfaces
+from ncolony.tests import helper
 
 @interface.implementer(interfaces.IMonitorEventReceiver)
 class EventRecorder(object):
@@ -21,6 +27,7 @@ class EventRecorder(object):
     def __init__(self):
         """Initialize the event list"""
         self.events = []
+        self.batches = []
 
     def add(self, name, contents):
         """Get an add event"""
@@ -34,6 +41,14 @@ class EventRecorder(object):
         """Get a new message event"""
         self.events.append(('MESSAGE', contents))
 
+    def begin(self):
+        """Get a batch start"""
+        self.batches.append(len(self.events))
+
+    def commit(self):
+        """Get a batch end"""
+        self.batches[-1] = (self.batches[-1], len(self.events))
+
 ## pylint: disable=too-few-public-methods
 @interface.implementer(interfaces.IMonitorEventReceiver)
 class EventRecorderNoAdd(object):
@@ -150,6 +165,91 @@ class TestMessageSender(DirectoryBasedTest):
                                                  ('MESSAGE', b'goodbye')])
 
 
+    def test_order(self):
+        """Test messages are sent in order of file name"""
+        for name in ['02Message', '00Message', '01Message', '.hidden']:
+            self.write(name, name.encode('ascii'))
+        self.message()
+        self.assertEquals(self.receiver.events, [('MESSAGE', b'00Message'),
+                                                 ('MESSAGE', b'01Message'),
+                                                 ('MESSAGE', b'02Message')])
+
+    def test_names(self):
+        """Test sending only the named messages"""
+        self.write('00Message', b'hello')
+        self.write('01Message', b'goodbye')
+        self.message(['01Message', '02Message', '03Message.new'])
+        self.assertEquals(self.receiver.events, [('MESSAGE', b'goodbye')])
+        self.message()
+        self.assertEquals(self.receiver.events, [('MESSAGE', b'goodbye'),
+                                                 ('MESSAGE', b'hello')])
+
+    def _restart(self, fname, name):
+        self.write(fname, helper.dumps2utf8(dict(type='RESTART', name=name)))
+
+    def test_coalesce_restarts(self):
+        """Test only the first restart of each process is sent, and returned"""
+        self._restart('00Message', 'foo')
+        self._restart('01Message', 'bar')
+        self._restart('02Message', 'foo')
+        self.assertEquals(self.message(), ['00Message', '01Message'])
+        self.assertEquals([json.loads(content.decode('utf-8'))['name']
+                           for dummy, content in self.receiver.events], ['foo', 'bar'])
+        self.assertEquals(os.listdir(self.testDirectory), [])
+
+    def test_restart_all(self):
+        """Test a restart-all subsumes restarts of single processes"""
+        self._restart('00Message', 'foo')
+        self.write('01Message', helper.dumps2utf8(dict(type='RESTART-ALL')))
+        self.write('02Message', helper.dumps2utf8(dict(type='RESTART-ALL')))
+        self._restart('03Message', 'bar')
+        self.write('04Message', b'"hello"')
+        self.message()
+        self.assertEquals(self.receiver.events,
+                          [('MESSAGE', helper.dumps2utf8(dict(type='RESTART-ALL'))),
+                           ('MESSAGE', b'"hello"')])
+        self.assertEquals(os.listdir(self.testDirectory), [])
+
+    def test_cooldown(self):
+        """Test restarts of recently restarted processes are not sent"""
+        now = [0]
+        message = directory_monitor.messages(self.testDirectory, self.receiver,
+                                             cooldown=10, timer=lambda: now[0])
+        self._restart('00Message', 'foo')
+        message()
+        now[0] = 5
+        self._restart('00Message', 'foo')
+        self._restart('01Message', 'bar')
+        self.assertEquals(message(), ['01Message'])
+        self.assertEquals(len(self.receiver.events), 2)
+        now[0] = 10
+        self._restart('00Message', 'foo')
+        message()
+        self.assertEquals(len(self.receiver.events), 3)
+        self.write('00Message', helper.dumps2utf8(dict(type='RESTART-ALL')))
+        message()
+        now[0] = 19
+        self._restart('00Message', 'bar')
+        message()
+        self.assertEquals(len(self.receiver.events), 4)
+        self.assertEquals(os.listdir(self.testDirectory), [])
+
+    def test_watched(self):
+        """Test messages are sent as soon as inotify notices them"""
+        myReactor = proto_helpers.MemoryReactorClock()
+        watcher = directory_monitor.Watcher(self.testDirectory, self.message,
+                                            mask=directory_monitor.MESSAGES_MASK,
+                                            reactor=myReactor)
+        watcher.startService()
+        self.addCleanup(watcher.stopService)
+        messages = filepath.FilePath(self.testDirectory)
+        messages.child('00Message').setContent(b'hello')
+        watcher.notifier.doRead()
+        myReactor.advance(0)
+        self.assertEquals(self.receiver.events, [('MESSAGE', b'hello')])
+        self.assertEquals(os.listdir(self.testDirectory), [])
+
+
 class TestEventSender(DirectoryBasedTest):
 
     """Test monitoring the configuration directory"""
@@ -212,3 +312,150 @@ class TestEventSender(DirectoryBasedTest):
         self.assertEquals(self.receiver.events, [('ADD', 'one', b'A'),
                                                  ('REMOVE', 'one'),
                                                  ('ADD', 'one', b'B')])
+
+    def test_batches(self):
+        """Test each check is one batch"""
+        self.write('one', b'A')
+        self.write('two', b'B')
+        self.monitor()
+        self.write('one', b'C')
+        self.monitor(['one'])
+        self.assertEquals(self.receiver.batches, [(0, 2), (2, 4)])
+
+    def test_check_names(self):
+        """Test checking only the given names"""
+        self.write('one', b'A')
+        self.write('two', b'B')
+        self.monitor(['one'])
+        self.assertEquals(self.receiver.events, [('ADD', 'one', b'A')])
+        self.remove('one')
+        self.monitor(['one', 'three'])
+        self.assertEquals(self.receiver.events, [('ADD', 'one', b'A'),
+                                                 ('REMOVE', 'one')])
+        self.monitor()
+        self.assertEquals(self.receiver.events, [('ADD', 'one', b'A'),
+                                                 ('REMOVE', 'one'),
+                                                 ('ADD', 'two', b'B')])
+
+    def test_unreadable(self):
+        """Test that errors other than a missing file are not swallowed"""
+        os.mkdir(os.path.join(self.testDirectory, 'one'))
+        with self.assertRaises(EnvironmentError):
+            self.monitor()
+        self.assertFalse(self.receiver.events)
+
+
+
+class TestStatEventSender(TestEventSender):
+
+    """Test monitoring the configuration directory in stat mode"""
+
+    def setUp(self):
+        """Set up the test"""
+        TestEventSender.setUp(self)
+        self.monitor = directory_monitor.checker(self.testDirectory, self.receiver, stat=True)
+        self.mtime = 1000000000
+
+    def write(self, name, content):
+        """Write a file in the directory, with a new modification time
+
+        File system timestamps are coarse, so files written in quick
+        succession can otherwise end up with the same modification time.
+        """
+        TestEventSender.write(self, name, content)
+        self.mtime += 1
+        os.utime(os.path.join(self.testDirectory, name), (self.mtime, self.mtime))
+
+    def test_same_signature(self):
+        """Test that files whose metadata did not change are not re-read"""
+        self.write('one', b'A')
+        self.monitor()
+        DirectoryBasedTest.write(self, 'one', b'B')
+        os.utime(os.path.join(self.testDirectory, 'one'), (self.mtime, self.mtime))
+        self.monitor()
+        self.assertEquals(self.receiver.events, [('ADD', 'one', b'A')])
+        self.monitor(['one'])
+        self.assertEquals(self.receiver.events, [('ADD', 'one', b'A'),
+                                                 ('REMOVE', 'one'),
+                                                 ('ADD', 'one', b'B')])
+        self.monitor()
+        self.assertEquals(len(self.receiver.events), 3)
+
+    def test_touch(self):
+        """Test that files whose metadata changed but contents did not are ignored"""
+        self.write('one', b'A')
+        self.monitor()
+        self.write('one', b'A')
+        self.monitor()
+        self.assertEquals(self.receiver.events, [('ADD', 'one', b'A')])
+
+    def test_remove_named(self):
+        """Test that named files which are gone are removed"""
+        self.write('one', b'A')
+        self.monitor()
+        self.remove('one')
+        self.monitor(['one'])
+        self.assertEquals(self.receiver.events, [('ADD', 'one', b'A'),
+                                                 ('REMOVE', 'one')])
+
+    def test_gone_while_scanning(self):
+        """Test that files which are gone before they are looked at are skipped"""
+        self.write('one', b'A')
+        os.symlink(os.path.join(self.testDirectory, 'missing'),
+                   os.path.join(self.testDirectory, 'two'))
+        self.monitor()
+        self.assertEquals(self.receiver.events, [('ADD', 'one', b'A')])
+
+
+class TestWatcher(DirectoryBasedTest):
+
+    """Test watching a directory with inotify"""
+
+    def setUp(self):
+        """Set up the test"""
+        DirectoryBasedTest.setUp(self)
+        self.reactor = proto_helpers.MemoryReactorClock()
+        self.checked = []
+        self.watcher = directory_monitor.Watcher(self.testDirectory, self.checked.append,
+                                                 reactor=self.reactor)
+
+    def test_default_reactor(self):
+        """Test that the default reactor is the global reactor"""
+        watcher = directory_monitor.Watcher(self.testDirectory, self.checked.append)
+        self.assertIs(watcher.reactor, reactor)
+
+    def test_notify(self):
+        """Test that notifications in one iteration are checked together"""
+        directory = filepath.FilePath(self.testDirectory)
+        self.watcher.notify(None, directory.child('two').asBytesMode(), 0)
+        self.watcher.notify(None, directory.child('one.new'), 0)
+        self.watcher.notify(None, directory.child('one'), 0)
+        self.assertFalse(self.checked)
+        self.reactor.advance(0)
+        self.assertEquals(self.checked, [['one', 'two']])
+        self.reactor.advance(0)
+        self.assertEquals(self.checked, [['one', 'two']])
+
+    def test_watch(self):
+        """Test that inotify events are passed to the checker"""
+        self.watcher.startService()
+        self.addCleanup(self.watcher.stopService)
+        notifier = self.watcher.notifier
+        self.assertIn(notifier, self.reactor.getReaders())
+        self.write('one', b'A')
+        notifier.doRead()
+        self.reactor.advance(0)
+        self.assertEquals(self.checked, [['one']])
+
+    def test_stop(self):
+        """Test that stopping cancels pending checks"""
+        self.watcher.startService()
+        notifier = self.watcher.notifier
+        self.watcher.notify(None, filepath.FilePath(self.testDirectory).child('one'), 0)
+        self.watcher.stopService()
+        self.assertIsNone(self.watcher.notifier)
+        self.assertNotIn(notifier, self.reactor.getReaders())
+        self.reactor.advance(0)
+        self.assertFalse(self.checked)
+        self.watcher.startService()
+        self.watcher.stopService()
@@ -0,0 +1,222 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Tests for ncolony.health"""
+
+import os
+import shutil
+import time
+import unittest
+
+from twisted.python import log, usage
+
+from ncolony import beatcheck, connectcheck, ctllib, health, httpcheck
+from ncolony.tests import test_beatcheck, helper
+
+## pylint: disable=too-few-public-methods
+
+class EventRecorder(object):
+
+    """Record configuration events"""
+
+    def __init__(self):
+        self.events = []
+
+    def begin(self):
+        """Record a begin"""
+        self.events.append('begin')
+
+    def commit(self):
+        """Record a commit"""
+        self.events.append('commit')
+
+    def add(self, name, contents):
+        """Record an add"""
+        self.events.append(('add', name, contents))
+
+    def remove(self, name):
+        """Record a remove"""
+        self.events.append(('remove', name))
+
+## pylint: enable=too-few-public-methods
+
+class TestFanout(unittest.TestCase):
+
+    """Test passing configuration changes on"""
+
+    def test_fanout(self):
+        """Every receiver gets every event"""
+        receivers = [EventRecorder(), EventRecorder()]
+        fanout = health.Fanout(receivers)
+        fanout.begin()
+        fanout.add('foo', b'{}')
+        fanout.remove('bar')
+        fanout.commit()
+        for receiver in receivers:
+            self.assertEquals(receiver.events,
+                              ['begin', ('add', 'foo', b'{}'), ('remove', 'bar'), 'commit'])
+
+    def test_isolated(self):
+        """A receiver which fails does not stop the others"""
+        messages = []
+        def _observer(msg):
+            messages.append(''.join(msg['message']))
+        self.addCleanup(log.removeObserver, _observer)
+        log.addObserver(_observer)
+        broken = EventRecorder()
+        def _broken(*args):
+            raise ValueError(args)
+        broken.begin = broken.commit = broken.add = broken.remove = _broken
+        working = EventRecorder()
+        fanout = health.Fanout([broken, working])
+        fanout.begin()
+        fanout.add('foo', b'{}')
+        fanout.remove('bar')
+        fanout.commit()
+        self.assertEquals(working.events,
+                          ['begin', ('add', 'foo', b'{}'), ('remove', 'bar'), 'commit'])
+        self.assertEquals(len(messages), 4)
+        self.assertTrue(all(message.startswith('Health check failed: ')
+                            for message in messages))
+
+class TestRun(unittest.TestCase):
+
+    """Test running the checks"""
+
+    def test_deduplicate(self):
+        """A process flagged by several checks is restarted once"""
+        l = []
+        nows = []
+        def _checker(names, now):
+            nows.append(now)
+            return names
+        checkers = [lambda now: _checker(['foo', 'bar'], now),
+                    lambda now: _checker(['foo', 'baz'], now)]
+        health.run(l.append, checkers, lambda: 5)
+        self.assertEquals(l, ['bar', 'baz', 'foo'])
+        self.assertEquals(nows, [5, 5])
+
+    def test_isolated(self):
+        """A checker which fails does not stop the others"""
+        l = []
+        def _broken(dummyNow):
+            raise ValueError('broken')
+        health.run(l.append, [_broken, lambda now: ['foo']], lambda: 5)
+        self.assertEquals(l, ['foo'])
+
+    def test_untimed(self):
+        """Checks which do not need the time are called without it"""
+        for name, factory in [('httpcheck', httpcheck.State),
+                              ('connectcheck', connectcheck.State)]:
+            receiver, checker, services = health.CHECKS[name]({}, None, None)
+            self.assertIs(receiver.stateFactory, factory)
+            self.assertEquals(services, [])
+            self.assertEquals(checker(time.time()), [])
+            self.assertIs(checker.args[0].__self__, receiver)
+
+class TestService(unittest.TestCase):
+
+    """Test the health service"""
+
+    def setUp(self):
+        """Set up a configuration directory"""
+        self.config = os.path.abspath('dummy-config')
+        if os.path.exists(self.config):
+            shutil.rmtree(self.config)
+        os.makedirs(self.config)
+        self.addCleanup(shutil.rmtree, self.config)
+        check = dict(period=1, grace=1, maxBad=0, timeout=1)
+        config = {'ncolony.beatcheck': dict(status=self.config, period=1, grace=1),
+                  'ncolony.httpcheck': dict(url='http://example.com/status', **check),
+                  'ncolony.connectcheck': dict(endpoint='tcp:host=localhost:port=1', **check)}
+        with open(os.path.join(self.config, 'foo'), 'wb') as fp:
+            fp.write(helper.dumps2utf8(config))
+
+    def test_make_service(self):
+        """Test makeService"""
+        opt = {'config': self.config, 'messages': 'messages', 'freq': 5, 'config-freq': 7,
+               'socket': 'beats.sock'}
+        masterService = health.makeService(opt)
+        service = masterService.getServiceNamed('health')
+        self.assertEquals(service.step, 5)
+        callableThing, args, kwargs = service.call
+        self.assertIs(callableThing, health.run)
+        self.assertFalse(kwargs)
+        restarter, checkers, timer = args
+        self.assertIs(restarter.func, ctllib.restart)
+        self.assertIs(timer, time.time)
+        beatChecker, connectChecker, httpChecker = checkers
+        beatIndex = beatChecker.__self__
+        connectIndex = connectChecker.args[0].__self__
+        httpIndex = httpChecker.args[0].__self__
+        self.assertIsInstance(beatIndex, beatcheck.Index)
+        self.assertIs(connectIndex.stateFactory, connectcheck.State)
+        self.assertIs(httpIndex.stateFactory, httpcheck.State)
+        configService = masterService.getServiceNamed('health-config')
+        self.assertEquals(configService.step, 7)
+        configService.call[0]()
+        self.assertEquals(list(beatIndex.entries), ['foo'])
+        self.assertEquals(list(connectIndex.states), ['foo'])
+        self.assertEquals(list(httpIndex.states), ['foo'])
+        server = masterService.getServiceNamed('beatcheck-socket')
+        self.assertIs(server.args[1].index, beatIndex)
+
+    def test_make_service_limiter(self):
+        """The checks share one limiter"""
+        opt = {'config': self.config, 'messages': 'messages', 'freq': 5, 'config-freq': 7,
+               'checks': ['connectcheck', 'httpcheck'], 'max-in-flight': 3}
+        masterService = health.makeService(opt)
+        connectChecker, httpChecker = masterService.getServiceNamed('health').call[1][1]
+        limiter = connectChecker.args[0].__self__.settings.limiter
+        self.assertIsInstance(limiter, httpcheck.Limiter)
+        self.assertIs(httpChecker.args[0].__self__.settings.limiter, limiter)
+
+    def test_make_service_checks(self):
+        """Only the checks asked for are run"""
+        opt = {'config': self.config, 'messages': 'messages', 'freq': 5, 'config-freq': 7,
+               'checks': ['httpcheck']}
+        masterService = health.makeService(opt)
+        httpChecker, = masterService.getServiceNamed('health').call[1][1]
+        masterService.getServiceNamed('health-config').call[0]()
+        self.assertEquals(list(httpChecker.args[0].__self__.states), ['foo'])
+
+    def test_make_service_metrics(self):
+        """Test makeService serving metrics"""
+        opt = {'config': self.config, 'messages': 'messages', 'freq': 5, 'config-freq': 7,
+               'checks': ['httpcheck'], 'metrics': 'tcp:0'}
+        masterService = health.makeService(opt)
+        callableThing, _, _ = masterService.getServiceNamed('health').call
+        self.assertEquals(callableThing.args[1], 'health')
+        self.assertIs(callableThing.args[3], health.run)
+        registry = masterService.getServiceNamed('metrics').factory.resource.registry
+        self.assertEquals(registry.metrics[-1].name, 'health_restarts_total')
+
+    def test_make_service_with_health(self):
+        """Test health with heart beater"""
+        test_beatcheck.testWrappedHeart(self, health.makeService)
+
+class TestOptions(unittest.TestCase):
+
+    """Test option parsing"""
+
+    def setUp(self):
+        """Set up the test"""
+        self.opt = health.Options()
+        self.basic = ['--messages', 'message-dir', '--config', 'config-dir']
+
+    def test_default(self):
+        """By default, no checks are chosen"""
+        self.opt.parseOptions(self.basic)
+        self.assertEquals(self.opt['checks'], [])
+        self.assertIsNone(self.opt['max-in-flight'])
+        self.assertIsNone(self.opt['socket'])
+
+    def test_checks(self):
+        """Checks can be chosen"""
+        self.opt.parseOptions(self.basic + ['--check', 'beatcheck', '--check', 'connectcheck'])
+        self.assertEquals(self.opt['checks'], ['beatcheck', 'connectcheck'])
+
+    def test_unknown_check(self):
+        """Unknown checks are refused"""
+        with self.assertRaises(usage.UsageError):
+            self.opt.parseOptions(self.basic + ['--check', 'lalala'])
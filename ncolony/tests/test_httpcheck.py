@@ -8,19 +8,18 @@ import errno
 import os
 import shutil
 import sys
-
-import six
+import time
 
 import twisted
-from twisted.python import filepath
-from twisted.internet import defer, reactor
+from twisted.python import filepath, usage
+from twisted.internet import defer, reactor, task
 from twisted.web import client
 from twisted.application import internet as tainternet
 from twisted.trial import unittest
 from twisted.test import proto_helpers
 
 import ncolony
-from ncolony import httpcheck, ctllib
+from ncolony import httpcheck, ctllib, directory_monitor
 from ncolony.tests import test_beatcheck, helper
 
 ## pylint: disable=too-few-public-methods
@@ -170,7 +169,7 @@ class TestState(BaseTestHTTPChecker):
         (method, gotUrl, headers, body), = self.agent.calls
         self.assertIsNone(body)
         self.assertEquals(method, 'GET')
-        url = next(six.itervalues(self.params))['url']
+        url = next(iter(self.params.values()))['url']
         self.assertEquals(url, gotUrl)
         self.assertIsInstance(headers, client.Headers)
         userAgent, = headers.getRawHeaders('user-agent')
@@ -189,6 +188,285 @@ class TestState(BaseTestHTTPChecker):
             self.state.close()
         with self.assertRaises(ValueError):
             self.state.check()
+        with self.assertRaises(ValueError):
+            self.state.checkLoaded()
+
+
+class TestHistogram(unittest.TestCase):
+
+    """Test the response time histogram"""
+
+    def test_empty(self):
+        """An empty histogram has no percentiles"""
+        histogram = httpcheck.Histogram()
+        self.assertEquals(len(histogram), 0)
+        self.assertIsNone(histogram.percentile(99))
+        self.assertFalse(histogram.exceeds(99, 0))
+
+    def test_percentile(self):
+        """Percentiles are the upper bound of their bucket"""
+        histogram = httpcheck.Histogram()
+        for dummy in range(98):
+            histogram.add(0.01)
+        histogram.add(0.5)
+        histogram.add(1000)
+        self.assertEquals(len(histogram), 100)
+        median = histogram.percentile(50)
+        self.assertLessEqual(0.01, median)
+        self.assertLess(median, 0.01 * 1.2)
+        p99 = histogram.percentile(99)
+        self.assertLessEqual(0.5, p99)
+        self.assertLess(p99, 0.5 * 1.2)
+        self.assertEquals(histogram.percentile(100), float('inf'))
+        self.assertEquals(histogram.percentile(0), median)
+
+    def test_exceeds(self):
+        """A percentile exceeds a threshold only if its whole bucket is over it"""
+        histogram = httpcheck.Histogram()
+        for dummy in range(20):
+            histogram.add(0.45)
+        self.assertGreater(histogram.percentile(99), 0.5)
+        self.assertFalse(histogram.exceeds(99, 0.5))
+        self.assertFalse(histogram.exceeds(99, 0.45))
+        self.assertTrue(histogram.exceeds(99, 0.35))
+        histogram = httpcheck.Histogram()
+        histogram.add(0)
+        self.assertFalse(histogram.exceeds(99, 0))
+
+    def test_window(self):
+        """Only the last few times are kept"""
+        histogram = httpcheck.Histogram(window=3)
+        for seconds in [10, 10, 0.001, 0.001, 0.001]:
+            histogram.add(seconds)
+        self.assertEquals(len(histogram), 3)
+        self.assertEquals(histogram.percentile(100), 0.001)
+        self.assertEquals(sum(histogram.counts), 3)
+
+
+class TestSlow(BaseTestHTTPChecker):
+
+    """Test slow responses counting as unsuccessful"""
+
+    def setUp(self):
+        BaseTestHTTPChecker.setUp(self)
+        self.params['ncolony.httpcheck'].update(period=10, timeout=5, maxBad=1,
+                                                slowThreshold=1, slowPercentile=50,
+                                                slowWindow=4)
+        self.settings = httpcheck.Settings(reactor=self.reactor, agent=self.agent,
+                                           random=lambda: 0)
+        self.index = httpcheck.Index(self.filepath, self.settings)
+        self.index.add('foo', helper.dumps2utf8(self.params))
+        self.url = self.params['ncolony.httpcheck']['url']
+        self.reactor.advance(1)
+
+    def _probe(self, seconds):
+        self.reactor.advance(10)
+        ret = self.index.check()
+        if ret:
+            return ret
+        self.reactor.advance(seconds)
+        d = self.agent.pending[self.url].pop()
+        d.callback(client.Response(('HTTP', 1, 1), 200, 'OK', None, None))
+        self.reactor.advance(10 - seconds)
+        return self.index.check()
+
+    def test_slow(self):
+        """A service which answers slowly enough is restarted"""
+        card = self.index.states['foo'].card
+        self.assertEquals(card.slow, httpcheck.Slow(threshold=1, percentile=50))
+        self.assertEquals(card.histogram.recent.maxlen, 4)
+        for seconds in [0.1, 3, 0.1, 3]:
+            self.assertFalse(self._probe(seconds))
+        self.assertEquals(card.bad, 0)
+        self.assertFalse(self._probe(3))
+        self.assertEquals(card.bad, 1)
+        self.assertFalse(self._probe(3))
+        self.assertEquals(card.bad, 2)
+        self.reactor.advance(1)
+        self.assertEquals(self.index.check(), ['foo'])
+
+    def test_under_threshold(self):
+        """A service which answers just under the threshold is not slow"""
+        card = httpcheck._ScoreCard(slow=httpcheck.Slow(threshold=0.5, percentile=99))
+        for dummy in range(20):
+            card.markTime(0.45)
+            card.markGood(None)
+        self.assertEquals(card.bad, 0)
+        self.assertFalse(card.isBad())
+
+    def test_default_slow(self):
+        """By default, slow responses are only recorded"""
+        params = {'ncolony.httpcheck': dict(url=self.url, period=10, grace=1, maxBad=0,
+                                            timeout=5)}
+        self.index.add('foo', helper.dumps2utf8(params))
+        self.reactor.advance(1)
+        card = self.index.states['foo'].card
+        self.assertIsNone(card.slow)
+        self.assertEquals(card.histogram.recent.maxlen, 100)
+        self.assertFalse(self._probe(4))
+        self.assertEquals(card.bad, 0)
+        self.assertEquals(len(card.histogram), 1)
+
+
+class TestLimiter(unittest.TestCase):
+
+    """Test the limiter"""
+
+    def setUp(self):
+        self.calls = []
+
+    def _call(self, name):
+        d = defer.Deferred()
+        self.calls.append((name, d))
+        return d
+
+    def test_unlimited(self):
+        """Without limits, everything is called right away"""
+        limiter = httpcheck.Limiter()
+        for name in ['a', 'b', 'c']:
+            limiter.run('host', self._call, name)
+        self.assertEquals([name for name, dummy in self.calls], ['a', 'b', 'c'])
+
+    def test_limits(self):
+        """Calls wait for room, both overall and for their host"""
+        limiter = httpcheck.Limiter(maxInFlight=2, maxPerHost=1)
+        results = []
+        for host, name in [('x', 'a'), ('x', 'b'), ('y', 'c'), ('z', 'd')]:
+            limiter.run(host, self._call, name).addCallback(results.append)
+        self.assertEquals([name for name, dummy in self.calls], ['a', 'c'])
+        self.calls[0][1].callback('A')
+        self.assertEquals(results, ['A'])
+        self.assertEquals([name for name, dummy in self.calls], ['a', 'c', 'd'])
+        self.calls[1][1].callback('C')
+        self.assertEquals([name for name, dummy in self.calls], ['a', 'c', 'd', 'b'])
+        self.assertEquals(sorted(limiter.hosts), ['x', 'z'])
+        for dummy, d in self.calls[2:]:
+            d.callback(None)
+        self.assertEquals(limiter.hosts, {})
+
+    def test_cancel_waiting(self):
+        """Calls which are cancelled while waiting are never made"""
+        limiter = httpcheck.Limiter(maxInFlight=1)
+        limiter.run('x', self._call, 'a')
+        waiting = limiter.run('x', self._call, 'b')
+        waiting.cancel()
+        self.failureResultOf(waiting, defer.CancelledError)
+        self.calls[0][1].callback(None)
+        self.assertEquals(len(self.calls), 1)
+
+
+class TestScheduling(BaseTestHTTPChecker):
+
+    """Test spreading and limiting checks"""
+
+    def setUp(self):
+        BaseTestHTTPChecker.setUp(self)
+        self.settings = httpcheck.Settings(reactor=self.reactor, agent=self.agent,
+                                           limiter=httpcheck.Limiter(maxPerHost=1),
+                                           random=lambda: 0.5)
+        self.params['ncolony.httpcheck'].update(period=10, timeout=2)
+        self.index = httpcheck.Index(self.filepath, self.settings)
+
+    def test_phase(self):
+        """The first check is at a random point of the first period"""
+        self.index.add('foo', helper.dumps2utf8(self.params))
+        self.assertEquals(self.index.states['foo'].nextCheck, 15)
+
+    def test_limited(self):
+        """Checks wait for their turn, and time out only once sent"""
+        for name in ['foo', 'bar']:
+            self.index.add(name, helper.dumps2utf8(self.params))
+        self.reactor.advance(16)
+        self.assertFalse(self.index.check())
+        self.assertEquals(len(self.agent.calls), 1)
+        self.reactor.advance(1.5)
+        url = self.params['ncolony.httpcheck']['url']
+        self.agent.pending[url][0].callback(client.Response(('HTTP', 1, 1), 200, 'OK',
+                                                            None, None))
+        self.assertEquals(len(self.agent.calls), 2)
+        self.reactor.advance(1.5)
+        self.assertEquals(len(self.agent.calls), 2)
+        self.assertFalse(self.agent.pending[url][1].called)
+        self.reactor.advance(0.5)
+        self.assertTrue(self.agent.pending[url][1].called)
+        err, = self.flushLoggedErrors()
+        err.trap(defer.CancelledError)
+
+    def test_outstanding(self):
+        """A check which is still waiting is not started again"""
+        waiting = []
+        def _run(host, func):
+            waiting.append((host, func))
+            return defer.Deferred()
+        limiter = self.settings.limiter
+        limiter.run = _run
+        self.index.add('foo', helper.dumps2utf8(self.params))
+        self.reactor.advance(16)
+        self.index.check()
+        self.reactor.advance(11)
+        self.assertFalse(self.index.check())
+        self.assertEquals(waiting, [('example.com', self.index.states['foo']._request)])
+
+
+class TestIndex(BaseTestHTTPChecker):
+
+    """Test the index"""
+
+    def setUp(self):
+        BaseTestHTTPChecker.setUp(self)
+        self.index = httpcheck.Index(self.filepath, self.settings)
+
+    def test_slots(self):
+        """States and score cards are compact"""
+        state = httpcheck.State(self.filepath.child('foo'), self.settings)
+        for thing in [state, httpcheck._ScoreCard()]:
+            with self.assertRaises(AttributeError):
+                thing.lalala = 5
+
+    def test_index(self):
+        """Only configurations with an HTTP check are kept, and are not read"""
+        self.index.begin()
+        self.index.add('foo', helper.dumps2utf8(self.params))
+        self.index.add('bar', helper.dumps2utf8({}))
+        self.index.commit()
+        self.assertEquals(list(self.index.states), ['foo'])
+        state = self.index.states['foo']
+        self.assertEquals(state.location, self.filepath.child('foo'))
+        self.assertFalse(self.index.check())
+        self.reactor.advance(3)
+        self.assertFalse(self.index.check())
+        self.reactor.advance(3)
+        self.assertEquals(self.index.check(), ['foo'])
+        err, = self.flushLoggedErrors()
+        err.trap(defer.CancelledError)
+        self.assertFalse(state.closed)
+        self.index.add('foo', helper.dumps2utf8(self.params))
+        self.assertIs(self.index.states['foo'], state)
+        self.index.add('foo', helper.dumps2utf8({}))
+        self.assertTrue(state.closed)
+        self.assertEquals(self.index.states, {})
+        self.index.add('foo', helper.dumps2utf8(self.params))
+        state = self.index.states['foo']
+        self.index.remove('foo')
+        self.index.remove('foo')
+        self.assertTrue(state.closed)
+        self.assertEquals(self.index.states, {})
+
+    def test_index_bad(self):
+        """Configurations which cannot be parsed are skipped"""
+        section = dict(self.params['ncolony.httpcheck'])
+        del section['period']
+        self.filepath.child('a').setContent(helper.dumps2utf8({'ncolony.httpcheck': section}))
+        self.filepath.child('b').setContent(helper.dumps2utf8(self.params))
+        self.filepath.child('c').setContent(helper.dumps2utf8({'ncolony.httpcheck': ['url']}))
+        self.filepath.child('d').setContent(b'{')
+        directory_monitor.checker(self.path, self.index)()
+        self.assertEquals(list(self.index.states), ['b'])
+        state = self.index.states['b']
+        self.index.add('b', b'{')
+        self.assertTrue(state.closed)
+        self.assertEquals(self.index.states, {})
+
 
 
 class TestCheck(BaseTestHTTPChecker):
@@ -212,7 +490,7 @@ class TestCheck(BaseTestHTTPChecker):
         self.location.child('child').setContent(helper.dumps2utf8(self.params))
         ret = httpcheck.check(self.settings, self.states, self.location)
         self.assertEquals(ret, [])
-        (name, state), = six.iteritems(self.states)
+        (name, state), = self.states.items()
         self.assertEquals(name, 'child')
         httpcheck.check(self.settings, self.states, self.location)
         self.assertEquals(ret, [])
@@ -240,9 +518,7 @@ class TestCheck(BaseTestHTTPChecker):
 
     def test_make_service(self):
         """Test makeService"""
-        opt = dict(config='config',
-                   messages='messages',
-                   freq=5)
+        opt = {'config': 'config', 'messages': 'messages', 'freq': 5, 'config-freq': 7}
         masterService = httpcheck.makeService(opt)
         service = masterService.getServiceNamed("httpcheck")
         self.assertIsInstance(service, tainternet.TimerService)
@@ -255,17 +531,78 @@ class TestCheck(BaseTestHTTPChecker):
         self.assertFalse(restarter.keywords)
         places, = restarter.args
         self.assertEquals(places, ctllib.Places(config='config', messages='messages'))
-        self.assertIs(checker.func, httpcheck.check)
-        self.assertFalse(checker.keywords)
-        settings, states, location = checker.args
-        self.assertEquals(location, filepath.FilePath(opt['config']))
-        self.assertEquals(states, {})
+        index = checker.__self__
+        self.assertIsInstance(index, httpcheck.Index)
+        self.assertEquals(index.path, filepath.FilePath(opt['config']))
+        self.assertEquals(index.states, {})
+        settings = index.settings
         self.assertIs(settings.reactor, reactor)
         agent = settings.agent
         self.assertIsInstance(agent, client.Agent)
         ## pylint: disable=protected-access
         self.assertTrue(agent._pool.persistent)
         ## pylint: enable=protected-access
+        self.assertIsNone(settings.limiter)
+        configService = masterService.getServiceNamed("httpcheck-config")
+        self.assertEquals(configService.step, 7)
+
+    def test_make_service_limits(self):
+        """Test makeService with limits and pool settings"""
+        opt = {'config': 'config', 'messages': 'messages', 'freq': 5, 'config-freq': 7,
+               'max-in-flight': 10, 'max-per-host': 2, 'pool-size': 4, 'no-persistent': True}
+        masterService = httpcheck.makeService(opt)
+        service = masterService.getServiceNamed("httpcheck")
+        settings = service.call[1][1].__self__.settings
+        self.assertEquals(settings.limiter.overall.limit, 10)
+        self.assertEquals(settings.limiter.maxPerHost, 2)
+        ## pylint: disable=protected-access
+        pool = settings.agent._pool
+        ## pylint: enable=protected-access
+        self.assertFalse(pool.persistent)
+        self.assertEquals(pool.maxPersistentPerHost, 4)
+
+    def test_make_service_settings(self):
+        """Test makeService checking with given settings"""
+        clock = task.Clock()
+        agent = object()
+        settings = httpcheck.Settings(reactor=clock, agent=agent)
+        opt = {'config': 'config', 'messages': 'messages', 'freq': 5, 'config-freq': 7,
+               'max-in-flight': 10}
+        masterService = httpcheck.makeService(opt, settings=settings)
+        service = masterService.getServiceNamed("httpcheck")
+        self.assertIs(service.clock, clock)
+        self.assertIs(masterService.getServiceNamed("httpcheck-config").clock, clock)
+        indexSettings = service.call[1][1].__self__.settings
+        self.assertIs(indexSettings.reactor, clock)
+        self.assertIs(indexSettings.agent, agent)
+        self.assertEquals(indexSettings.limiter.overall.limit, 10)
+
+    def test_options(self):
+        """Test httpcheck options"""
+        opt = httpcheck.Options()
+        opt.parseOptions(['--messages', 'm', '--config', 'c', '--max-in-flight', '10',
+                          '--pool-size', '3', '--no-persistent'])
+        self.assertEquals(opt['max-in-flight'], 10)
+        self.assertIsNone(opt['max-per-host'])
+        self.assertEquals(opt['pool-size'], 3)
+        self.assertTrue(opt['no-persistent'])
+        self.assertEquals(opt['config-freq'], 10)
+        self.assertNotIn('socket', opt)
+        with self.assertRaises(usage.UsageError):
+            httpcheck.Options().parseOptions(['--messages', 'm', '--config', 'c',
+                                              '--table', 't'])
+
+    def test_make_service_metrics(self):
+        """Test makeService serving metrics"""
+        opt = {'config': 'config', 'messages': 'messages', 'freq': 5, 'config-freq': 7,
+               'metrics': 'tcp:0'}
+        masterService = httpcheck.makeService(opt)
+        callableThing, _, _ = masterService.getServiceNamed("httpcheck").call
+        self.assertEquals(callableThing.args[1:], ('httpcheck', time.time, httpcheck.run))
+        registry = masterService.getServiceNamed("metrics").factory.resource.registry
+        self.assertEquals([metric.name for metric in registry.metrics],
+                          ['ncolony_reactor_lag_seconds', 'ncolony_callback_seconds',
+                           'ncolony_stalls_total', 'httpcheck_restarts_total'])
 
     def test_make_service_with_health(self):
         """Test httpcheck with heart beater"""
@@ -0,0 +1,317 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Tests for ncolony.instrument"""
+
+import sys
+import threading
+import time
+import unittest
+
+from zope.interface import verify
+
+from twisted.internet import defer, task
+from twisted.python import log
+
+from ncolony import instrument, interfaces, metrics
+
+class EventRecorder(object):
+
+    """Record instrumentation events"""
+
+    def __init__(self):
+        self.events = []
+
+    def tick(self, lag):
+        """Record a tick"""
+        self.events.append(('tick', lag))
+
+    def started(self, name):
+        """Record a callback starting"""
+        self.events.append(('started', name))
+
+    def timed(self, name, seconds):
+        """Record a callback finishing"""
+        self.events.append(('timed', name, seconds))
+
+    def stalled(self, name, seconds, stack):
+        """Record a stall"""
+        self.events.append(('stalled', name, seconds, stack))
+
+class TestInstrumentations(unittest.TestCase):
+
+    """Tests for the instrumentations"""
+
+    def setUp(self):
+        """Capture log messages"""
+        self.logMessages = []
+        def _observer(event):
+            self.logMessages.append(''.join(event['message']))
+        log.addObserver(_observer)
+        self.addCleanup(log.removeObserver, _observer)
+
+    def test_interface(self):
+        """All instrumentations implement IInstrumentation"""
+        for instrumentation in [instrument.LogInstrumentation(1),
+                                instrument.MetricsInstrumentation(metrics.Registry()),
+                                instrument.Fanout([]),
+                                instrument.Watchdog(None, 1, deliver=None)]:
+            verify.verifyObject(interfaces.IInstrumentation, instrumentation)
+
+    def test_log(self):
+        """Only slow things are logged"""
+        instrumentation = instrument.LogInstrumentation(2)
+        instrumentation.tick(1)
+        instrumentation.tick(3)
+        instrumentation.started('scan')
+        instrumentation.timed('scan', 1)
+        instrumentation.timed('scan', 2)
+        instrumentation.stalled('scan', 5, ['  File "a"\n', '  File "b"\n'])
+        self.assertEquals(self.logMessages, [
+            'Reactor ran late: 3.000 seconds',
+            'Slow callback: scan took 2.000 seconds',
+            'Reactor stalled: scan running for 5.000 seconds\n  File "a"\n  File "b"\n',
+        ])
+
+    def test_metrics(self):
+        """Lag, callback times and stalls are exported"""
+        registry = metrics.Registry()
+        instrumentation = instrument.MetricsInstrumentation(registry)
+        instrumentation.tick(0.5)
+        instrumentation.started('scan')
+        instrumentation.timed('scan', 0.2)
+        instrumentation.stalled('scan', 5, [])
+        text = registry.render().decode('utf-8').splitlines()
+        self.assertIn('ncolony_reactor_lag_seconds 0.5', text)
+        self.assertIn('ncolony_callback_seconds_count{name="scan"} 1.0', text)
+        self.assertIn('ncolony_stalls_total{name="scan"} 1.0', text)
+
+    def test_fanout(self):
+        """Every instrumentation gets every event"""
+        recorders = [EventRecorder(), EventRecorder()]
+        fanout = instrument.Fanout(recorders)
+        fanout.tick(1)
+        fanout.started('scan')
+        fanout.timed('scan', 2)
+        fanout.stalled('scan', 3, [])
+        for recorder in recorders:
+            self.assertEquals(recorder.events, [('tick', 1), ('started', 'scan'),
+                                                ('timed', 'scan', 2),
+                                                ('stalled', 'scan', 3, [])])
+
+class TestTimed(unittest.TestCase):
+
+    """Tests for timing calls"""
+
+    def setUp(self):
+        """Set up the test"""
+        self.recorder = EventRecorder()
+        self.now = 10
+        self.timer = lambda: self.now
+
+    def test_timed(self):
+        """The time a call took is reported"""
+        def _slow(value, add):
+            self.now += 3
+            return value + add
+        result = instrument.timed(self.recorder, 'add', self.timer, _slow, 1, add=2)
+        self.assertEquals(result, 3)
+        self.assertEquals(self.recorder.events, [('started', 'add'), ('timed', 'add', 3)])
+
+    def test_timed_raises(self):
+        """The time a call took is reported even if it raises"""
+        def _broken():
+            self.now += 2
+            raise ValueError('broken')
+        with self.assertRaises(ValueError):
+            instrument.timed(self.recorder, 'broken', self.timer, _broken)
+        self.assertEquals(self.recorder.events, [('started', 'broken'), ('timed', 'broken', 2)])
+
+    def test_timed_deferred(self):
+        """Only the time until a Deferred is returned is reported, not until it fires"""
+        d = defer.Deferred()
+        def _start():
+            self.now += 1
+            return d
+        result = instrument.timed(self.recorder, 'run', self.timer, _start)
+        self.assertIs(result, d)
+        self.now += 7
+        d.callback(5)
+        self.assertEquals(self.recorder.events, [('started', 'run'), ('timed', 'run', 1)])
+
+    def test_wrap(self):
+        """Functions are only wrapped if there is instrumentation"""
+        function = object()
+        self.assertIs(instrument.wrap(None, 'foo', function), function)
+        wrapped = instrument.wrap(self.recorder, 'foo', function)
+        self.assertIs(wrapped.func, instrument.timed)
+        self.assertEquals(wrapped.args, (self.recorder, 'foo', time.time, function))
+
+class TestLagMeter(unittest.TestCase):
+
+    """Tests for measuring the reactor's lag"""
+
+    def test_meter(self):
+        """The lag is how much later than expected the call came"""
+        recorder = EventRecorder()
+        clock = task.Clock()
+        meter = instrument.LagMeter(recorder, 1, clock.seconds)
+        meter.tick()
+        self.assertEquals(recorder.events, [])
+        clock.advance(1.5)
+        meter.tick()
+        clock.advance(0.5)
+        meter.tick()
+        self.assertEquals(recorder.events, [('tick', 0.5), ('tick', 0)])
+
+class TestWatchdog(unittest.TestCase):
+
+    """Tests for noticing stalls"""
+
+    def setUp(self):
+        """Set up the test"""
+        self.recorder = EventRecorder()
+        self.now = 10
+        self.frame = sys._getframe() # pylint: disable=protected-access
+        self.watchdog = instrument.Watchdog(self.recorder, 5, timer=lambda: self.now,
+                                            frames=lambda: {17: self.frame},
+                                            deliver=lambda f, *args: f(*args))
+        self.watchdog.threadID = 17
+
+    def test_quiet(self):
+        """Nothing is reported while the reactor keeps running"""
+        for _ in range(3):
+            self.now += 4
+            self.watchdog.tick(0)
+            self.watchdog.check()
+        self.assertEquals(self.recorder.events, [])
+
+    def test_stall(self):
+        """A stall is reported once, with the callback and a stack sample"""
+        self.watchdog.started('scan')
+        self.now += 6
+        self.watchdog.check()
+        self.now += 6
+        self.watchdog.check()
+        (tp, name, seconds, stack), = self.recorder.events
+        self.assertEquals((tp, name, seconds), ('stalled', 'scan', 6))
+        self.assertIn('test_instrument.py', stack[-1])
+        self.assertLessEqual(len(stack), instrument.STACK_LIMIT)
+        self.watchdog.timed('scan', 12)
+        self.now += 6
+        self.watchdog.check()
+        (tp, name, seconds, stack) = self.recorder.events[-1]
+        self.assertEquals((tp, name, seconds), ('stalled', 'reactor', 6))
+
+    def test_unknown_thread(self):
+        """A stall of a thread which cannot be found has no stack"""
+        self.watchdog.threadID = 18
+        self.now += 6
+        self.watchdog.check()
+        self.assertEquals(self.recorder.events, [('stalled', 'reactor', 6, [])])
+        self.watchdog.stalled('reactor', 6, [])
+
+    def test_default_deliver(self):
+        """By default, stalls are delivered in the reactor thread"""
+        from twisted.internet import reactor
+        watchdog = instrument.Watchdog(self.recorder, 5)
+        self.assertEquals(watchdog.deliver, reactor.callFromThread)
+
+    def test_service(self):
+        """The service checks in a thread, watching the thread which started it"""
+        stalls = []
+        done = threading.Event()
+        def _deliver(dummyFunction, name, dummySeconds, stack):
+            stalls.append((name, stack))
+            done.set()
+        watchdog = instrument.Watchdog(EventRecorder(), 0, deliver=_deliver)
+        service = instrument.WatchdogService(watchdog, 0.001)
+        service.startService()
+        self.assertTrue(done.wait(10))
+        service.stopService()
+        self.assertFalse(service.thread.is_alive())
+        self.assertEquals(watchdog.threadID, threading.current_thread().ident)
+        (name, stack), = stalls
+        self.assertEquals(name, 'reactor')
+        self.assertIn('test_service', ''.join(stack))
+
+class TestMakeInstrumentation(unittest.TestCase):
+
+    """Tests for putting the instrumentation together"""
+
+    def test_nothing(self):
+        """Without metrics or a threshold, there is no instrumentation"""
+        self.assertEquals(instrument.makeInstrumentation(), (None, []))
+
+    def test_metrics(self):
+        """With metrics, lag is measured every second on the reactor"""
+        registry = metrics.Registry()
+        clock = task.Clock()
+        instrumentation, (lag,) = instrument.makeInstrumentation(registry, reactor=clock)
+        metricsInstrumentation, = instrumentation.instrumentations
+        self.assertIsInstance(metricsInstrumentation, instrument.MetricsInstrumentation)
+        self.assertEquals((lag.name, lag.step), ('lag', 1))
+        self.assertIs(lag.clock, clock)
+        lag.startService()
+        clock.advance(1)
+        lag.stopService()
+        self.assertEquals(metricsInstrumentation.lag.values, {(): 0})
+
+    def test_slow(self):
+        """With a threshold, stalls are watched for and logged"""
+        registry = metrics.Registry()
+        clock = task.Clock()
+        instrumentation, (watcher, lag) = instrument.makeInstrumentation(registry, 1,
+                                                                         reactor=clock)
+        metricsInstrumentation, logInstrumentation, watchdog = instrumentation.instrumentations
+        self.assertIsInstance(metricsInstrumentation, instrument.MetricsInstrumentation)
+        self.assertEquals(logInstrumentation.threshold, 1)
+        self.assertIs(watchdog, watcher.watchdog)
+        self.assertEquals(watchdog.instrumentation.instrumentations,
+                          [metricsInstrumentation, logInstrumentation])
+        self.assertEquals((watcher.name, watcher.interval), ('watchdog', 0.5))
+        self.assertEquals(lag.step, 0.5)
+        self.assertEquals(lag.call[0].__self__.timer, clock.seconds)
+
+    def test_slow_default_reactor(self):
+        """Without a reactor, the global one is used"""
+        dummyInstrumentation, (dummyWatcher, lag) = instrument.makeInstrumentation(
+            slowThreshold=4)
+        self.assertIsNone(lag.clock)
+        self.assertEquals(lag.step, 1)
+        self.assertIs(lag.call[0].__self__.timer, time.time)
+
+class TestOptions(unittest.TestCase):
+
+    """Tests for instrumenting services from options"""
+
+    def test_nothing(self):
+        """Without the options, nothing is changed"""
+        restarter = object()
+        runner = object()
+        self.assertEquals(instrument.instrumentCheck({}, 'foo', restarter, runner),
+                          (restarter, runner, [], None))
+
+    def test_metrics(self):
+        """With the metrics option, restarts and checks are measured"""
+        names = []
+        def _run(restarter, name):
+            restarter(name)
+            return 'done'
+        restarter, runner, services, instrumentation = instrument.instrumentCheck(
+            dict(metrics='tcp:0'), 'foo', names.append, _run)
+        self.assertEquals(runner(restarter, 'bar'), 'done')
+        self.assertEquals(names, ['bar'])
+        self.assertEquals([service.name for service in services], ['metrics', 'lag'])
+        self.assertIsInstance(instrumentation, instrument.Fanout)
+        registry = services[0].factory.resource.registry
+        text = registry.render().decode('utf-8')
+        self.assertIn('foo_restarts_total{name="bar"} 1.0', text)
+        self.assertIn('ncolony_callback_seconds_count{name="foo"} 1.0', text)
+
+    def test_slow(self):
+        """With the slow threshold option, there is no registry"""
+        registry, instrumentation, services = instrument.fromOptions({'slow-threshold': 3})
+        self.assertIsNone(registry)
+        self.assertIsInstance(instrumentation.instrumentations[0], instrument.LogInstrumentation)
+        self.assertEquals([service.name for service in services], ['watchdog', 'lag'])
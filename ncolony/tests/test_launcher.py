@@ -0,0 +1,136 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Tests for ncolony.launcher"""
+
+import json
+import os
+import resource
+import shutil
+import sys
+import unittest
+
+from ncolony import launcher
+
+def _directory(case, name):
+    path = os.path.abspath(name)
+    if os.path.exists(path):
+        shutil.rmtree(path)
+    os.makedirs(path)
+    case.addCleanup(shutil.rmtree, path)
+    return path
+
+class TestCPUs(unittest.TestCase):
+
+    """Test choosing CPUs"""
+
+    def test_parse(self):
+        """CPU lists have ranges and single CPUs"""
+        self.assertEquals(launcher.parseCPUList('0-3,8,10-11\n'), [0, 1, 2, 3, 8, 10, 11])
+        self.assertEquals(launcher.parseCPUList('\n'), [])
+
+    def test_nodes(self):
+        """NUMA nodes are read from sysfs, in order"""
+        location = _directory(self, 'dummy-nodes')
+        for number, cpulist in [(10, '4-5'), (2, '0-3')]:
+            os.makedirs(os.path.join(location, 'node%d' % number))
+            with open(os.path.join(location, 'node%d' % number, 'cpulist'), 'w') as fp:
+                fp.write(cpulist + '\n')
+        os.makedirs(os.path.join(location, 'power'))
+        self.assertEquals(launcher.numaNodes(location), [[0, 1, 2, 3], [4, 5]])
+        self.assertEquals(launcher.numaNodes(os.path.join(location, 'nothing')), [])
+
+    def test_cpus(self):
+        """Processes are spread over CPUs or NUMA nodes"""
+        available = [0, 1, 2, 3]
+        nodes = [[0, 1], [2, 3, 4]]
+        self.assertEquals(launcher.cpus([1, 2], 5, available, nodes), [1, 2])
+        self.assertEquals(launcher.cpus('spread', 5, available, nodes), [1])
+        self.assertEquals(launcher.cpus('spread-numa', 5, available, nodes), [2, 3])
+        self.assertEquals(launcher.cpus('spread-numa', 5, available, []), available)
+        self.assertEquals(launcher.cpus('spread-numa', 1, [0, 1], nodes), [0, 1])
+
+class TestPrepare(unittest.TestCase):
+
+    """Test applying settings"""
+
+    def test_cgroup(self):
+        """Processes are moved into a cgroup, which gets its limits"""
+        root = _directory(self, 'dummy-cgroup')
+        cgroup = dict(path='/ncolony/worker', limits={'memory.max': '1G', 'cpu.weight': 50})
+        launcher.joinCgroup(cgroup, 1234, root=root)
+        group = os.path.join(root, 'ncolony', 'worker')
+        for name, content in [('cgroup.procs', '1234'), ('memory.max', '1G'),
+                              ('cpu.weight', '50')]:
+            with open(os.path.join(group, name)) as fp:
+                self.assertEquals(fp.read(), content)
+        launcher.joinCgroup(dict(path='ncolony/worker'), 5678, root=root)
+        with open(os.path.join(group, 'cgroup.procs')) as fp:
+            self.assertEquals(fp.read(), '5678')
+
+    def test_prepare(self):
+        """Settings are applied to the current process"""
+        root = _directory(self, 'dummy-cgroup')
+        available = sorted(os.sched_getaffinity(0))
+        self.addCleanup(os.sched_setaffinity, 0, available)
+        nofile = resource.getrlimit(resource.RLIMIT_NOFILE)
+        spec = dict(affinity='spread', nice=os.getpriority(os.PRIO_PROCESS, 0),
+                    rlimits=dict(nofile=list(nofile)), cgroup=dict(path='worker'))
+        launcher.prepare(spec, cgroupRoot=root)
+        self.assertEquals(os.sched_getaffinity(0), set(available[:1]))
+        spec = dict(affinity='spread', placement=len(available) + 1)
+        launcher.prepare(spec, cgroupRoot=root)
+        self.assertEquals(os.sched_getaffinity(0), set(available[1 % len(available):][:1]))
+        self.assertEquals(resource.getrlimit(resource.RLIMIT_NOFILE), nofile)
+        with open(os.path.join(root, 'worker', 'cgroup.procs')) as fp:
+            self.assertEquals(fp.read(), str(os.getpid()))
+
+    def test_switch_user(self):
+        """The launcher switches to the uid and gid, defaulting to the current ones"""
+        switched = []
+        def _switchUID(uid, gid):
+            switched.append((uid, gid))
+        launcher.switchUser({}, _switchUID)
+        launcher.switchUser(dict(uid=5, gid=6), _switchUID)
+        launcher.switchUser(dict(uid=5), _switchUID)
+        launcher.switchUser(dict(gid=6), _switchUID)
+        self.assertEquals(switched, [(5, 6), (5, os.getegid()), (os.geteuid(), 6)])
+
+    def test_command(self):
+        """I/O priority is set by running through ionice"""
+        args = ['/bin/worker', '--fast']
+        self.assertEquals(launcher.command({}, args), args)
+        self.assertEquals(launcher.command(dict(ionice={'class': 3}), args),
+                          ['ionice', '-c', '3'] + args)
+        self.assertEquals(launcher.command(dict(ionice={'class': 2, 'level': 7}), args),
+                          ['ionice', '-c', '2', '-n', '7'] + args)
+
+    def test_wrap(self):
+        """Command lines are wrapped to run through the launcher"""
+        args, spec = launcher.wrap(['/bin/worker'], dict(nice=5), '/bin/python')
+        self.assertEquals(args, ['/bin/python', '-m', 'ncolony', 'launch', '/bin/worker'])
+        self.assertEquals(json.loads(spec), dict(nice=5))
+
+    def test_main(self):
+        """The launcher applies the settings and executes the command line"""
+        environ = dict(NCOLONY_LAUNCH=json.dumps(dict(ionice={'class': 3}, uid=5)),
+                       NCOLONY_INSTANCE='2')
+        executed = []
+        launcher.main(['launch', '/bin/worker'], environ=environ,
+                      execvp=lambda *args: executed.append(args),
+                      switchUID=lambda *args: executed.append(args))
+        self.assertEquals(executed, [(5, os.getegid()),
+                                     ('ionice', ['ionice', '-c', '3', '/bin/worker'])])
+        self.assertEquals(environ, dict(NCOLONY_INSTANCE='2'))
+
+    def test_main_defaults(self):
+        """Without settings, the command line is executed as is"""
+        executed = []
+        oldEnviron = os.environ
+        def _cleanup():
+            os.environ = oldEnviron
+        self.addCleanup(_cleanup)
+        os.environ = dict(oldEnviron)
+        os.environ.pop('NCOLONY_LAUNCH', None)
+        launcher.main(['launch', sys.executable], execvp=lambda *args: executed.append(args))
+        self.assertEquals(executed, [(sys.executable, [sys.executable])])
@@ -0,0 +1,125 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Tests for ncolony.metrics"""
+
+import unittest
+
+from twisted.internet import task
+from twisted.web import server
+from twisted.web.test import requesthelper
+
+from ncolony import metrics
+
+class TestRender(unittest.TestCase):
+
+    """Tests for rendering metrics"""
+
+    def setUp(self):
+        """Set up the test"""
+        self.registry = metrics.Registry()
+
+    def _lines(self):
+        return self.registry.render().decode('utf-8').splitlines()
+
+    def test_counter(self):
+        """Counters are rendered with their labels"""
+        counter = self.registry.counter('things_total', 'Things seen')
+        counter.inc()
+        counter.inc(2, name='foo')
+        counter.inc(name='foo')
+        self.assertEquals(self._lines(), [
+            '# HELP things_total Things seen',
+            '# TYPE things_total counter',
+            'things_total 1.0',
+            'things_total{name="foo"} 3.0',
+        ])
+
+    def test_gauge(self):
+        """Gauges are set"""
+        gauge = self.registry.gauge('temperature', 'How hot it is')
+        gauge.set(5, place='outside')
+        gauge.set(3, place='outside')
+        gauge.set(float('inf'), place='sun')
+        gauge.set(float('-inf'), place='space')
+        self.assertEquals(self._lines()[2:], [
+            'temperature{place="outside"} 3.0',
+            'temperature{place="space"} -Inf',
+            'temperature{place="sun"} +Inf',
+        ])
+
+    def test_escape(self):
+        """Label values are escaped"""
+        self.registry.gauge('weird', 'Weird labels').set(1, name='a"b\\c\nd')
+        self.assertEquals(self._lines()[2], 'weird{name="a\\"b\\\\c\\nd"} 1.0')
+
+    def test_histogram(self):
+        """Histograms have cumulative buckets, a sum and a count"""
+        histogram = self.registry.histogram('latency_seconds', 'Latency', buckets=(1, 2))
+        for value in [0.5, 1.5, 1.5, 3]:
+            histogram.observe(value)
+        self.assertEquals(self._lines(), [
+            '# HELP latency_seconds Latency',
+            '# TYPE latency_seconds histogram',
+            'latency_seconds_bucket{le="1.0"} 1.0',
+            'latency_seconds_bucket{le="2.0"} 3.0',
+            'latency_seconds_bucket{le="+Inf"} 4.0',
+            'latency_seconds_sum 6.5',
+            'latency_seconds_count 4.0',
+        ])
+
+    def test_collected(self):
+        """Collected metrics are computed when rendered"""
+        values = {}
+        self.registry.collect('queued', 'Things queued', 'gauge',
+                              lambda: [(dict(name=name), value)
+                                       for name, value in values.items()])
+        self.assertEquals(self._lines()[1:], ['# TYPE queued gauge'])
+        values.update(b=2, a=1)
+        self.assertEquals(self._lines()[2:], ['queued{name="a"} 1.0', 'queued{name="b"} 2.0'])
+
+    def test_abstract(self):
+        """Metrics need to say what their samples are"""
+        with self.assertRaises(NotImplementedError):
+            # pylint: disable=protected-access
+            metrics._Metric('foo', 'Foo').samples()
+
+class TestCounted(unittest.TestCase):
+
+    """Tests for counting calls"""
+
+    def test_counted(self):
+        """Calls are counted by name"""
+        counter = metrics.Counter('restarts_total', 'Restarts')
+        names = []
+        metrics.counted(counter, names.append, 'foo')
+        metrics.counted(counter, names.append, 'foo')
+        self.assertEquals(names, ['foo', 'foo'])
+        self.assertEquals(counter.values, {(('name', 'foo'),): 2})
+
+class TestServe(unittest.TestCase):
+
+    """Tests for serving the metrics"""
+
+    def test_resource(self):
+        """GET requests are answered with the metrics"""
+        registry = metrics.Registry()
+        registry.counter('things_total', 'Things').inc()
+        request = requesthelper.DummyRequest([b''])
+        body = metrics.MetricsResource(registry).render_GET(request)
+        self.assertEquals(body, registry.render())
+        self.assertEquals(request.responseHeaders.getRawHeaders(b'content-type'),
+                          [metrics.CONTENT_TYPE])
+
+    def test_serve(self):
+        """The metrics are served on the endpoint"""
+        clock = task.Clock()
+        registry = metrics.Registry()
+        serverService = metrics.serve(registry, 'unix:metrics.sock', reactor=clock)
+        self.assertEquals(serverService.name, 'metrics')
+        ## pylint: disable=protected-access
+        self.assertIs(serverService.endpoint._reactor, clock)
+        ## pylint: enable=protected-access
+        factory = serverService.factory
+        self.assertIsInstance(factory, server.Site)
+        self.assertIs(factory.resource.registry, registry)
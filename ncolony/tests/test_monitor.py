@@ -0,0 +1,268 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Tests for ncolony.monitor"""
+
+import json
+import os
+import shutil
+import signal
+import unittest
+
+from twisted.runner import procmon as procmonlib
+from twisted.trial import unittest as trialunittest
+from twisted.runner.test import test_procmon
+
+from ncolony import adopt, monitor
+from ncolony.tests import test_adopt
+
+class TestProcessMonitor(unittest.TestCase):
+
+    """Tests for the ProcessMonitor additions"""
+
+    def setUp(self):
+        """Set up the test"""
+        self.reactor = test_procmon.DummyProcessReactor()
+        self.pm = monitor.ProcessMonitor(self.reactor)
+        self.pm.startService()
+        self.addCleanup(self.pm.stopService)
+
+    def test_update(self):
+        """Updated parameters are used on the next start, without a restart"""
+        self.pm.addProcess('foo', ['/bin/foo'], env=dict(A='1'))
+        process, = self.reactor.spawnedProcesses
+        self.pm.updateProcess('foo', ['/bin/bar'], uid=5, gid=6)
+        self.assertEquals(len(self.reactor.spawnedProcesses), 1)
+        self.assertTrue(process.pid)
+        self.pm.stopProcess('foo')
+        self.reactor.advance(self.pm.threshold + 1)
+        _, newProcess = self.reactor.spawnedProcesses
+        self.assertEquals(newProcess._args, ['/bin/bar'])
+        self.assertEquals((newProcess._uid, newProcess._gid, newProcess._environment), (5, 6, {}))
+
+    def test_exits(self):
+        """Exits are counted until the process is removed"""
+        self.pm.addProcess('foo', ['/bin/foo'])
+        self.reactor.spawnedProcesses[-1].processEnded(1)
+        self.reactor.advance(self.pm.minRestartDelay)
+        self.reactor.spawnedProcesses[-1].processEnded(1)
+        self.assertEquals(self.pm.exits, {'foo': 2})
+        self.pm.removeProcess('foo')
+        self.assertEquals(self.pm.exits, {})
+
+    def test_update_missing(self):
+        """Updating a process which is not there fails"""
+        with self.assertRaises(KeyError):
+            self.pm.updateProcess('foo', ['/bin/foo'])
+
+class TestRestartPolicy(unittest.TestCase):
+
+    """Tests for per-process restart policies"""
+
+    def setUp(self):
+        """Set up a monitor with a process"""
+        self.reactor = test_procmon.DummyProcessReactor()
+        self.pm = monitor.ProcessMonitor(self.reactor)
+        self.pm.startService()
+        self.addCleanup(self.pm.stopService)
+        self.pm.addProcess('foo', ['/bin/foo'])
+
+    def _crash(self):
+        self.reactor.spawnedProcesses[-1].processEnded(1)
+
+    def _starts(self):
+        return len(self.reactor.spawnedProcesses)
+
+    def test_backoff(self):
+        """Processes which die quickly are restarted after growing delays"""
+        policy = monitor.RestartPolicy(threshold=10, minRestartDelay=2, maxRestartDelay=20,
+                                       factor=3, maxFailures=None, window=60)
+        self.pm.setPolicy('foo', policy)
+        for delay in [2, 6, 18, 20]:
+            self._crash()
+            self.reactor.advance(delay - 0.5)
+            starts = self._starts()
+            self.reactor.advance(0.5)
+            self.assertEquals(self._starts(), starts + 1)
+        self.reactor.advance(10)
+        self._crash()
+        self.reactor.advance(0)
+        self.assertEquals(self._starts(), 6)
+        self.assertEquals(self.pm.delay['foo'], 2)
+
+    def test_crash_loop(self):
+        """Processes which fail too often are parked until they get a new policy"""
+        policy = monitor.RestartPolicy(threshold=1, minRestartDelay=0, maxRestartDelay=0,
+                                       factor=2, maxFailures=3, window=60)
+        self.pm.setPolicy('foo', policy)
+        self.pm.stopProcess('foo')
+        self.reactor.advance(1)
+        for dummy in range(2):
+            self._crash()
+            self.reactor.advance(0)
+        self.assertEquals(self._starts(), 4)
+        self.reactor.advance(60)
+        self._crash()
+        self.reactor.advance(0)
+        self._crash()
+        self.reactor.advance(0)
+        self.assertEquals(self.pm.parked, set())
+        self._crash()
+        self.reactor.advance(100)
+        self.assertEquals(self.pm.parked, set(['foo']))
+        self.assertEquals(self._starts(), 6)
+        self.pm.setPolicy('foo', policy)
+        self.assertEquals(self._starts(), 7)
+        self.assertEquals(self.pm.parked, set())
+        self.pm.setPolicy('foo', None)
+        self.assertEquals(self.pm.policies, {})
+
+    def test_remove_parked(self):
+        """Removing a parked process forgets about it"""
+        policy = monitor.RestartPolicy(threshold=1, minRestartDelay=0, maxRestartDelay=0,
+                                       factor=2, maxFailures=1, window=60)
+        self.pm.setPolicy('foo', policy)
+        self._crash()
+        self.reactor.advance(0)
+        self.assertEquals(self.pm.parked, set(['foo']))
+        self.pm.removeProcess('foo')
+        self.assertEquals((self.pm.parked, self.pm.policies, self.pm.failures),
+                          (set(), {}, {}))
+
+    def test_stopped_parked(self):
+        """Parked processes are started again only once the monitor runs"""
+        policy = monitor.RestartPolicy(threshold=1, minRestartDelay=0, maxRestartDelay=0,
+                                       factor=2, maxFailures=1, window=60)
+        self.pm.setPolicy('foo', policy)
+        self._crash()
+        self.reactor.advance(0)
+        self.pm.stopService()
+        self.pm.setPolicy('foo', policy)
+        self.assertEquals(self._starts(), 1)
+
+    def test_no_policy(self):
+        """Processes without a policy use the monitor's parameters"""
+        self._crash()
+        self.reactor.advance(self.pm.minRestartDelay)
+        self.assertEquals(self._starts(), 2)
+
+    def test_stopped(self):
+        """Processes with a policy are not restarted once the monitor stops"""
+        policy = monitor.RestartPolicy(threshold=1, minRestartDelay=0, maxRestartDelay=0,
+                                       factor=2, maxFailures=1, window=60)
+        self.pm.setPolicy('foo', policy)
+        self.pm.stopService()
+        self.reactor.advance(self.pm.killTime)
+        self.assertEquals((self._starts(), self.pm.parked), (1, set()))
+
+class TestAdoption(trialunittest.TestCase):
+
+    """Tests for keeping processes across monitors"""
+
+    def setUp(self):
+        """Set up a monitor with a table"""
+        self.directory = os.path.abspath('dummy-pids')
+        def _cleanup():
+            if os.path.exists(self.directory):
+                shutil.rmtree(self.directory)
+        _cleanup()
+        self.addCleanup(_cleanup)
+        self.reactor = test_procmon.DummyProcessReactor()
+        self.pm = monitor.ProcessMonitor(self.reactor)
+        self.pm.table = adopt.ProcessTable(self.directory)
+        self.addCleanup(self.pm.stopService)
+
+    def _record(self, name, pid, args):
+        process = procmonlib._Process(args, None, None, {}, None)
+        self.pm.table.record(name, pid, adopt.specHash(process), 5)
+
+    def _details(self, name):
+        with open(os.path.join(self.pm.table.records, name)) as fp:
+            return json.loads(fp.read())
+
+    def test_start(self):
+        """Started processes are recorded, get ncolony's output, and are left running"""
+        self.pm.addProcess('foo', ['/bin/foo'])
+        self.pm.startService()
+        process, = self.reactor.spawnedProcesses
+        self.assertEquals(process._childFDs, adopt.CHILD_FDS)
+        self.assertEquals(self._details('foo')['pid'], process.pid)
+        self.pm.stopService()
+        self.reactor.advance(self.pm.killTime)
+        self.assertEquals(process.pid, 1)
+        self.assertEquals(os.listdir(self.pm.table.records), ['foo'])
+
+    def test_adopt(self):
+        """A process left running is adopted, and forgotten when it exits"""
+        child = test_adopt.startChild(self)
+        self._record('foo', child.pid, ['/bin/foo'])
+        self.pm.addProcess('foo', ['/bin/foo'])
+        self.pm.startService()
+        self.assertEquals(self.reactor.spawnedProcesses, [])
+        transport = self.pm.protocols['foo'].transport
+        self.assertEquals((transport.pid, self.pm.timeStarted['foo']), (child.pid, 5))
+        self.pm.stopProcess('foo')
+        self.assertEquals(child.wait(), -signal.SIGTERM)
+        transport.doRead()
+        self.assertEquals(os.listdir(self.pm.table.records), [])
+        self.reactor.advance(self.pm.minRestartDelay)
+        process, = self.reactor.spawnedProcesses
+        self.assertEquals(self._details('foo')['pid'], process.pid)
+
+    def test_changed(self):
+        """A process left running with other parameters is started again once it exits"""
+        child = test_adopt.startChild(self)
+        self._record('foo', child.pid, ['/bin/foo'])
+        self.pm.addProcess('foo', ['/bin/bar'])
+        self.pm.startService()
+        self.assertEquals(child.wait(), -signal.SIGTERM)
+        self.assertEquals(self.reactor.spawnedProcesses, [])
+        self.pm.protocols['foo'].transport.doRead()
+        self.assertEquals(self.reactor.spawnedProcesses, [])
+        self.reactor.advance(self.pm.minRestartDelay)
+        process, = self.reactor.spawnedProcesses
+        self.assertEquals(process._args, ['/bin/bar'])
+
+    def test_clean(self):
+        """Processes left running which are not monitored are stopped once settled"""
+        child = test_adopt.startChild(self)
+        self._record('bar', child.pid, ['/bin/bar'])
+        self.pm.addProcess('foo', ['/bin/foo'])
+        self.pm.startService()
+        self.assertIsNone(child.poll())
+        self.pm.settled()
+        self.assertEquals(child.wait(), -signal.SIGTERM)
+        self.assertEquals(sorted(os.listdir(self.pm.table.records)), ['foo'])
+
+    def test_clean_once(self):
+        """Processes are only cleaned up the first time the monitor settles"""
+        self.pm.addProcess('foo', ['/bin/foo'])
+        self.pm.startService()
+        self.pm.settled()
+        self.pm.removeProcess('foo')
+        self.pm.settled()
+        self.assertEquals(os.listdir(self.pm.table.records), ['foo'])
+
+    def test_update(self):
+        """A running process is recorded with its new configuration"""
+        self.pm.addProcess('foo', ['/bin/foo'])
+        self.pm.updateProcess('foo', ['/bin/bar'])
+        self.assertEquals(os.listdir(self.pm.table.records), [])
+        self.pm.startService()
+        self.pm.updateProcess('foo', ['/bin/bar'], env=dict(NCOLONY_CONFIG='{}'))
+        process = procmonlib._Process(['/bin/bar'], None, None, dict(NCOLONY_CONFIG='{}'), None)
+        self.assertEquals(self._details('foo')['spec'], adopt.specHash(process))
+        self.pm.updateProcess('foo', ['/bin/baz'], env=dict(NCOLONY_CONFIG='{}'))
+        self.assertEquals(self._details('foo')['spec'], adopt.specHash(process))
+
+    def test_spawn_failure(self):
+        """A process which cannot be started is not recorded"""
+        self.reactor.spawnProcessException = OSError()
+        self.pm.addProcess('foo', ['/bin/foo'])
+        self.pm.startService()
+        self.assertEquals((self.pm.exits['foo'], os.listdir(self.pm.table.records)),
+                          (1, []))
+        self.assertTrue(self.pm.restart['foo'].active())
+        self.flushLoggedErrors(OSError)
+        self.pm.stopService()
+        self.assertFalse(self.pm.restart['foo'].active())
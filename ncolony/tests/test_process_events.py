@@ -1,13 +1,16 @@
 # Copyright (c) Moshe Zadka
 # See LICENSE for details.
 """Test event processing"""
+import json
 import unittest
 
 from zope.interface import verify
 
+from twisted.internet import reactor, task
 from twisted.python import log
+from twisted.runner.test import test_procmon
 
-from ncolony import process_events
+from ncolony import monitor, process_events
 from ncolony import interfaces
 
 from ncolony.tests import helper
@@ -31,6 +34,17 @@ class DummyProcessMonitor(object):
         self.events.append(('ADD', name, args, uid, gid, env))
     # pylint: enable=too-many-arguments
 
+    # pylint: disable=too-many-arguments
+    def updateProcess(self, name, args, uid=None, gid=None, env=None):
+        """Update a process
+
+        TODO: document arguments
+        """
+        if env is None:
+            env = {}
+        self.events.append(('UPDATE', name, args, uid, gid, env))
+    # pylint: enable=too-many-arguments
+
     def removeProcess(self, name):
         """Remove a process
 
@@ -50,6 +64,10 @@ class DummyProcessMonitor(object):
         """
         self.events.append(('RESTART-ALL',))
 
+    def settled(self):
+        """All configured processes were added
+        """
+
 class TestReceiver(unittest.TestCase):
 
     """Test the event receiver"""
@@ -89,6 +107,7 @@ class TestReceiver(unittest.TestCase):
         env.pop('NCOLONY_NAME')
         self.assertEquals(env, {})
         self.assertEquals(self.logMessages, ['Added monitored process: hello'])
+        self.assertEquals(self.receiver.processes['hello']['args'], ['/bin/echo', 'hello'])
 
     def test_add_complicated(self):
         """Test a process addition with all the optional arguments"""
@@ -152,9 +171,29 @@ class TestReceiver(unittest.TestCase):
         self.assertEquals(env, sent_environment)
         self.assertEquals(self.logMessages, ['Added monitored process: hello'])
 
+    def test_bad_config(self):
+        """Test that a configuration which cannot be applied is logged and skipped"""
+        self.receiver.begin()
+        self.receiver.add('bad', b'not json')
+        self.receiver.add('hello', helper.dumps2utf8(dict(args=['/bin/echo', 'hello'])))
+        self.receiver.commit()
+        self.assertEquals([event[:2] for event in self.monitor.events], [('ADD', 'hello')])
+        self.assertEquals(len(self.logMessages), 2)
+        self.assertTrue(self.logMessages[0].startswith('Could not apply configuration: bad'))
+
+    def test_commit_without_begin(self):
+        """Test that committing without beginning a batch does nothing"""
+        self.receiver.commit()
+        self.assertFalse(self.monitor.events)
+
     def test_remove(self):
         """Test a process removal"""
+        message = helper.dumps2utf8(dict(args=['/bin/echo', 'hello']))
+        self.receiver.add('hello', message)
+        self.monitor.events.pop()
+        self.logMessages.pop()
         self.receiver.remove('hello')
+        self.assertEquals(self.receiver.processes, {})
         self.assertEquals(self.monitor.events,
                           [('REMOVE', 'hello')])
         self.assertEquals(self.logMessages, ['Removed monitored process: hello'])
@@ -180,3 +219,365 @@ class TestReceiver(unittest.TestCase):
         self.assertEquals(self.monitor.events,
                           [('RESTART-ALL',)])
         self.assertEquals(self.logMessages, ['Restarting all monitored processes'])
+
+    def test_message_counts(self):
+        """Messages carried out are counted by type"""
+        for message in [dict(type='RESTART', name='hello'), dict(type='RESTART-ALL'),
+                        dict(type='RESTART', name='goodbye'), dict(type='LALALA')]:
+            try:
+                self.receiver.message(helper.dumps2utf8(message))
+            except ValueError:
+                pass
+        self.assertEquals(self.receiver.messageCounts, {'RESTART': 2, 'RESTART-ALL': 1})
+
+
+class TestBatches(unittest.TestCase):
+
+    """Test batches of events"""
+
+    def setUp(self):
+        """Initialize the test"""
+        self.monitor = DummyProcessMonitor()
+        self.clock = task.Clock()
+        self.receiver = process_events.Receiver(self.monitor, reactor=self.clock)
+        self.hello = helper.dumps2utf8(dict(args=['/bin/echo', 'hello'], uid=5))
+
+    def _names(self):
+        return [event[:2] for event in self.monitor.events]
+
+    def test_default_reactor(self):
+        """Test that the default reactor is the global reactor"""
+        self.assertIs(process_events.Receiver(self.monitor).reactor, reactor)
+
+    def test_same_config(self):
+        """Test that removing and adding back the same configuration does nothing"""
+        self.receiver.add('hello', self.hello)
+        self.receiver.begin()
+        self.receiver.remove('hello')
+        self.receiver.add('hello', b'{"uid": 5,\n "args": ["/bin/echo", "hello"]}')
+        self.receiver.commit()
+        self.assertEquals(self._names(), [('ADD', 'hello')])
+
+    def test_changed_config(self):
+        """Test that changing the configuration replaces the process"""
+        self.receiver.add('hello', self.hello)
+        self.receiver.begin()
+        self.receiver.remove('hello')
+        self.receiver.add('hello', helper.dumps2utf8(dict(args=['/bin/echo', 'goodbye'])))
+        self.receiver.commit()
+        self.assertEquals(self._names(), [('ADD', 'hello'), ('REMOVE', 'hello'), ('ADD', 'hello')])
+        self.assertEquals(self.monitor.events[-1][2], ['/bin/echo', 'goodbye'])
+
+    def test_added_and_removed(self):
+        """Test that a process added and removed in one batch is never started"""
+        self.receiver.begin()
+        self.receiver.add('hello', self.hello)
+        self.receiver.remove('hello')
+        self.receiver.remove('goodbye')
+        self.receiver.commit()
+        self.assertEquals(self.monitor.events, [])
+
+    def test_batch_size(self):
+        """Test that changes are applied a batch at a time"""
+        self.receiver.batchSize = 2
+        self.receiver.add('a', self.hello)
+        self.receiver.begin()
+        for name in ['e', 'd', 'c', 'b', 'a']:
+            self.receiver.add(name, self.hello)
+        self.receiver.commit()
+        self.assertEquals(self._names(), [('ADD', 'a'), ('ADD', 'b'), ('ADD', 'c')])
+        self.receiver.remove('d')
+        self.receiver.remove('c')
+        self.assertEquals(len(self.monitor.events), 3)
+        self.clock.advance(1)
+        self.assertEquals(self._names()[3:], [('ADD', 'e'), ('REMOVE', 'c')])
+        self.clock.advance(1)
+        self.assertEquals(self._names()[5:], [])
+        self.assertFalse(self.clock.getDelayedCalls())
+        self.assertEquals(sorted(self.receiver.processes), ['a', 'b', 'e'])
+
+
+class TestSemantic(unittest.TestCase):
+
+    """Test semantic mode"""
+
+    def setUp(self):
+        """Initialize the test"""
+        self.monitor = DummyProcessMonitor()
+        self.receiver = process_events.Receiver(self.monitor, semantic=True,
+                                                environ=dict(PATH='/bin'))
+        self.config = dict(args=['/bin/echo', 'hello'], env=dict(A='1'), env_inherit=['PATH'],
+                           uid=5)
+        self.receiver.add('hello', helper.dumps2utf8(self.config))
+
+    def _change(self, **kwargs):
+        config = dict(self.config)
+        config.update(kwargs)
+        self.receiver.begin()
+        self.receiver.remove('hello')
+        self.receiver.add('hello', helper.dumps2utf8(config))
+        self.receiver.commit()
+        return [event[:2] for event in self.monitor.events[1:]]
+
+    def test_monitoring_change(self):
+        """Test changing only monitoring parameters updates the process"""
+        events = self._change(**{'ncolony.beatcheck': dict(period=1, grace=1, status='/')})
+        self.assertEquals(events, [('UPDATE', 'hello')])
+        env = self.monitor.events[-1][-1]
+        self.assertIn(b'ncolony.beatcheck', env['NCOLONY_CONFIG'])
+        self.assertIn('ncolony.beatcheck', self.receiver.configs['hello'])
+
+    def test_same_effective_environment(self):
+        """Test that spelling out inherited variables is not a change"""
+        events = self._change(env=dict(A='1', PATH='/bin'), env_inherit=[])
+        self.assertEquals(events, [('UPDATE', 'hello')])
+
+    def test_spec_change(self):
+        """Test changing the spec restarts the process"""
+        for kwargs in [dict(args=['/bin/echo']), dict(uid=6), dict(gid=6), dict(env={})]:
+            self.monitor.events[1:] = []
+            events = self._change(**kwargs)
+            self.assertEquals(events, [('REMOVE', 'hello'), ('ADD', 'hello')])
+
+
+class TestHeartSlots(unittest.TestCase):
+
+    """Test heartbeat table slots"""
+
+    def setUp(self):
+        """Initialize the test"""
+        self.monitor = DummyProcessMonitor()
+        self.receiver = process_events.Receiver(self.monitor, semantic=True)
+        self.table = {'ncolony.beatcheck': dict(period=1, grace=1, transport='mmap',
+                                                table='beats')}
+
+    def _add(self, name, **kwargs):
+        config = dict(args=['/bin/echo', name])
+        config.update(kwargs)
+        self.receiver.add(name, helper.dumps2utf8(config))
+        return self.monitor.events[-1][-1].get('NCOLONY_HEART_SLOT')
+
+    def test_slots(self):
+        """Test that slots are handed out lowest first, and reused"""
+        for name in ['a', 'b', 'c']:
+            self._add(name, **self.table)
+        self.assertIsNone(self._add('d'))
+        self.assertEquals(self.receiver.slots, dict(a=0, b=1, c=2))
+        self.receiver.remove('b')
+        self.receiver.remove('a')
+        self.assertEquals(self._add('e', **self.table), '0')
+        self.assertEquals(self._add('f', **self.table), '1')
+        self.assertEquals(self._add('g', **self.table), '3')
+
+    def test_keep_slot(self):
+        """Test that a process keeps its slot when its configuration changes"""
+        self._add('a', **self.table)
+        self._add('b', **self.table)
+        self.receiver.remove('a')
+        self.assertEquals(self._add('b', uid=5, **self.table), '1')
+        self.assertEquals(self.monitor.events[-2], ('REMOVE', 'b'))
+        table = {'ncolony.beatcheck': dict(self.table['ncolony.beatcheck'], period=2)}
+        self.assertEquals(self._add('b', uid=5, **table), '1')
+        self.assertEquals(self.monitor.events[-1][0], 'UPDATE')
+
+    def test_other_transport(self):
+        """Test that a process which stops using the table gives up its slot"""
+        self._add('a', **self.table)
+        self.assertIsNone(self._add('a'))
+        self.assertEquals(self.receiver.slots, {})
+        self.assertEquals(self._add('b', **self.table), '0')
+
+
+class TestRestartPolicy(unittest.TestCase):
+
+    """Test per-process restart policies"""
+
+    def setUp(self):
+        """Initialize the test"""
+        self.monitor = monitor.ProcessMonitor(test_procmon.DummyProcessReactor())
+        self.receiver = process_events.Receiver(self.monitor, semantic=True)
+        self.config = {'args': ['/bin/echo', 'hello'],
+                       'ncolony.restart': dict(maxDelay=30, maxFailures=3, lalala=5)}
+
+    def test_policy(self):
+        """Test the restart section is turned into a policy"""
+        self.receiver.add('hello', helper.dumps2utf8(self.config))
+        policy = self.monitor.policies['hello']
+        self.assertEquals(policy, monitor.RestartPolicy(threshold=self.monitor.threshold,
+                                                        minRestartDelay=1,
+                                                        maxRestartDelay=30,
+                                                        factor=2,
+                                                        maxFailures=3,
+                                                        window=60))
+
+    def test_update(self):
+        """Test changing the configuration sets the policy again"""
+        self.receiver.add('hello', helper.dumps2utf8(self.config))
+        self.monitor.parked.add('hello')
+        self.config['ncolony.restart']['factor'] = 3
+        self.receiver.add('hello', helper.dumps2utf8(self.config))
+        self.assertEquals(self.monitor.policies['hello'].factor, 3)
+        self.assertEquals(self.monitor.parked, set())
+        del self.config['ncolony.restart']
+        self.receiver.add('hello', helper.dumps2utf8(self.config))
+        self.assertEquals(self.monitor.policies, {})
+        self.config['ncolony.beatcheck'] = dict(period=1, grace=1, status='/')
+        self.receiver.add('hello', helper.dumps2utf8(self.config))
+        self.assertEquals(self.monitor.policies, {})
+
+
+class TestReplicas(unittest.TestCase):
+
+    """Test running several processes from one configuration"""
+
+    def setUp(self):
+        """Initialize the test"""
+        self.reactor = test_procmon.DummyProcessReactor()
+        self.monitor = monitor.ProcessMonitor(self.reactor)
+        self.monitor.startService()
+        self.addCleanup(self.monitor.stopService)
+        self.receiver = process_events.Receiver(self.monitor, reactor=self.reactor)
+        self.config = dict(args=['/bin/worker'], replicas=3)
+        self._add()
+
+    def _add(self, **kwargs):
+        self.config.update(kwargs)
+        self.receiver.add('worker', helper.dumps2utf8(self.config))
+
+    def test_replicas(self):
+        """Test each replica is a process, with its index in the environment"""
+        self.assertEquals(sorted(self.monitor._processes),
+                          ['worker.0', 'worker.1', 'worker.2'])
+        self.assertEquals(self.receiver.instances['worker'],
+                          ['worker.0', 'worker.1', 'worker.2'])
+        for index, process in enumerate(self.reactor.spawnedProcesses):
+            env = process._environment
+            self.assertEquals((env['NCOLONY_NAME'], env['NCOLONY_INSTANCE']),
+                              ('worker.%d' % index, str(index)))
+        self._add()
+        self.assertEquals(len(self.reactor.spawnedProcesses), 3)
+
+    def test_scale(self):
+        """Test changing the number of replicas only adds or removes processes"""
+        self._add(replicas=5)
+        self.assertEquals(len(self.reactor.spawnedProcesses), 5)
+        self.assertEquals(len(self.monitor._processes), 5)
+        self._add(replicas=2)
+        self.assertEquals(sorted(self.monitor._processes), ['worker.0', 'worker.1'])
+        self.reactor.advance(10)
+        self.assertEquals(len(self.reactor.spawnedProcesses), 5)
+        self.assertEquals(self.receiver.rolls, {})
+
+    def test_roll(self):
+        """Test changing the command restarts the replicas one at a time"""
+        self.reactor.advance(10)
+        self._add(args=['/bin/worker', '--new'])
+        self.assertEquals([process.args for process in self.monitor._processes.values()],
+                          [['/bin/worker', '--new']] * 3)
+        roll = self.receiver.rolls['worker']
+        self.assertEquals(list(roll.inFlight), ['worker.0'])
+        self.reactor.advance(1)
+        self.assertEquals(len(self.reactor.spawnedProcesses), 4)
+        self.assertEquals(self.reactor.spawnedProcesses[-1]._args, ['/bin/worker', '--new'])
+        self._add(args=['/bin/worker', '--newer'])
+        self.assertTrue(roll.done)
+        self.assertIsNot(self.receiver.rolls['worker'], roll)
+
+    def test_semantic(self):
+        """Test monitoring changes in semantic mode do not restart replicas"""
+        self.receiver.semantic = True
+        self._add(**{'ncolony.beatcheck': dict(period=1, grace=1, status='/')})
+        self.assertEquals(self.receiver.rolls, {})
+
+    def test_restart(self):
+        """Test restarting the configuration restarts all replicas"""
+        self.reactor.advance(10)
+        self.receiver.message(helper.dumps2utf8(dict(type='RESTART', name='worker')))
+        self.reactor.advance(2)
+        self.assertEquals(len(self.reactor.spawnedProcesses), 6)
+
+    def test_remove(self):
+        """Test removing the configuration removes all replicas"""
+        self._add(args=['/bin/worker', '--new'])
+        self.receiver.remove('worker')
+        self.assertEquals(self.monitor._processes, {})
+        self.assertEquals((self.receiver.instances, self.receiver.rolls), ({}, {}))
+
+    def test_slots(self):
+        """Test each replica beating into a table has its own slot"""
+        self._add(**{'ncolony.beatcheck': dict(period=1, grace=1, transport='mmap',
+                                               table='table')})
+        self.assertEquals(self.receiver.slots, {'worker.0': 0, 'worker.1': 1, 'worker.2': 2})
+        self._add(replicas=1)
+        self.assertEquals(self.receiver.slots, {'worker.0': 0})
+        self.receiver.remove('worker')
+        self.assertEquals(self.receiver.slots, {})
+
+    def test_taken(self):
+        """Test configurations whose processes have the same names are not applied"""
+        single = helper.dumps2utf8(dict(args=['/bin/single']))
+        self.receiver.add('worker.1', single)
+        self.receiver.remove('worker.1')
+        self.assertEquals(self.monitor._processes['worker.1'].args, ['/bin/worker'])
+        self.receiver.add('other.1', single)
+        self.receiver.add('other', helper.dumps2utf8(dict(args=['/bin/other'], replicas=2)))
+        self.assertEquals(sorted(self.monitor._processes),
+                          ['other.1', 'worker.0', 'worker.1', 'worker.2'])
+        self.assertEquals(self.monitor._processes['other.1'].args, ['/bin/single'])
+        self.assertNotIn('other', self.receiver.instances)
+
+    def test_single(self):
+        """Test switching between one process and replicas"""
+        del self.config['replicas']
+        self._add()
+        self.assertEquals(sorted(self.monitor._processes), ['worker'])
+        self.assertEquals(self.receiver.instances, {})
+        self._add(replicas=1)
+        self.assertEquals(sorted(self.monitor._processes), ['worker.0'])
+
+
+class TestLaunch(unittest.TestCase):
+
+    """Test starting processes through the launcher"""
+
+    def test_launch(self):
+        """Test processes with launch settings are wrapped"""
+        dummyMonitor = DummyProcessMonitor()
+        receiver = process_events.Receiver(dummyMonitor)
+        receiver.executable = '/bin/python'
+        receiver.add('hello', helper.dumps2utf8(dict(args=['/bin/echo', 'hello'], nice=5,
+                                                     affinity='spread')))
+        receiver.add('plain', helper.dumps2utf8(dict(args=['/bin/echo', 'plain'])))
+        (dummyTp, dummyName, args, dummyUid, dummyGid, env), plain = dummyMonitor.events
+        self.assertEquals(args, ['/bin/python', '-m', 'ncolony', 'launch',
+                                 '/bin/echo', 'hello'])
+        self.assertEquals(json.loads(env['NCOLONY_LAUNCH']),
+                          dict(nice=5, affinity='spread', placement=0))
+        self.assertEquals(plain[2], ['/bin/echo', 'plain'])
+        self.assertNotIn('NCOLONY_LAUNCH', plain[-1])
+
+    def test_launch_user(self):
+        """Test the launcher switches user, instead of the monitor"""
+        dummyMonitor = DummyProcessMonitor()
+        receiver = process_events.Receiver(dummyMonitor)
+        receiver.add('hello', helper.dumps2utf8(dict(args=['/bin/echo'], nice=-5,
+                                                     uid=5, gid=6)))
+        (dummyTp, dummyName, dummyArgs, uid, gid, env), = dummyMonitor.events
+        self.assertEquals((uid, gid), (None, None))
+        self.assertEquals(json.loads(env['NCOLONY_LAUNCH']), dict(nice=-5, uid=5, gid=6))
+
+    def test_placements(self):
+        """Test processes spreading over CPUs are numbered across configurations"""
+        dummyMonitor = DummyProcessMonitor()
+        receiver = process_events.Receiver(dummyMonitor)
+        spread = dict(args=['/bin/echo'], affinity='spread')
+        receiver.add('one', helper.dumps2utf8(spread))
+        receiver.add('two', helper.dumps2utf8(dict(spread, replicas=2)))
+        receiver.add('three', helper.dumps2utf8(dict(spread, affinity='spread-numa')))
+        self.assertEquals([json.loads(event[-1]['NCOLONY_LAUNCH'])['placement']
+                           for event in dummyMonitor.events], [0, 1, 2, 3])
+        receiver.remove('one')
+        receiver.add('three', helper.dumps2utf8(dict(spread, affinity=[0])))
+        self.assertEquals(receiver.placements, {'two.0': 1, 'two.1': 2})
+        receiver.add('four', helper.dumps2utf8(spread))
+        self.assertEquals(receiver.placements['four'], 0)
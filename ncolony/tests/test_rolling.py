@@ -0,0 +1,292 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Tests for ncolony.rolling"""
+
+import os
+import shutil
+import struct
+import time
+import unittest
+
+from twisted.internet import defer
+from twisted.python import failure, log
+from twisted.runner.test import test_procmon
+from twisted.web import client
+
+from ncolony import monitor, process_events, rolling
+from ncolony.client import heart
+from ncolony.tests import helper
+
+## pylint: disable=too-few-public-methods
+
+class DummyResponse(object):
+
+    """Something that looks like an HTTP response"""
+
+    def __init__(self, code):
+        self.code = code
+        self.phrase = b'OK'
+        self.delivered = False
+
+    def deliverBody(self, protocol):
+        """Deliver an empty body"""
+        self.delivered = True
+        protocol.connectionLost(failure.Failure(client.ResponseDone()))
+
+
+class DummyAgent(object):
+
+    """Something that looks like an HTTP agent"""
+
+    def __init__(self):
+        self.requests = []
+
+    def request(self, method, url):
+        """Record a request, and return a Deferred for its response"""
+        d = defer.Deferred()
+        self.requests.append((method, url, d))
+        return d
+
+## pylint: enable=too-few-public-methods
+
+class TestRollingRestart(unittest.TestCase):
+
+    """Tests for RollingRestart"""
+
+    def setUp(self):
+        """Set up a monitor with a few long-running processes"""
+        self.reactor = test_procmon.DummyProcessReactor()
+        self.monitor = monitor.ProcessMonitor(self.reactor)
+        self.monitor.startService()
+        self.addCleanup(self.monitor.stopService)
+        self.configs = {}
+        for name in ['a', 'b', 'c', 'd']:
+            self.monitor.addProcess(name, ['/bin/' + name])
+            self.configs[name] = dict(args=['/bin/' + name])
+        self.reactor.advance(10)
+
+    def _rolling(self, **kwargs):
+        ret = rolling.RollingRestart(self.monitor, sorted(self.configs), self.configs,
+                                     self.reactor, **kwargs)
+        self.addCleanup(ret.stop)
+        return ret
+
+    def _restarted(self):
+        return [process._args[0][len('/bin/'):]
+                for process in self.reactor.spawnedProcesses[4:]]
+
+    def test_one_at_a_time(self):
+        """By default, a process is restarted only once the previous one is back"""
+        restart = self._rolling()
+        restart.start()
+        self.assertEquals(list(restart.inFlight), ['a'])
+        self.reactor.advance(1)
+        self.assertEquals(self._restarted(), ['a'])
+        self.assertEquals(list(restart.inFlight), ['a'])
+        for expected in [['a'], ['a', 'b'], ['a', 'b'], ['a', 'b', 'c']]:
+            self.reactor.advance(1)
+            self.assertEquals(self._restarted(), expected)
+        self.assertFalse(restart.done)
+        for dummy in range(3):
+            self.reactor.advance(1)
+        self.assertEquals(self._restarted(), ['a', 'b', 'c', 'd'])
+        self.assertTrue(restart.done)
+        self.assertIsNone(restart.call)
+
+    def test_percent(self):
+        """The batch size can be given as a percentage"""
+        restart = self._rolling(percent=50)
+        restart.start()
+        self.assertEquals(sorted(restart.inFlight), ['a', 'b'])
+        self.reactor.advance(1)
+        self.assertEquals(self._restarted(), ['a', 'b'])
+        self.reactor.advance(1)
+        self.assertEquals(sorted(restart.inFlight), ['c', 'd'])
+
+    def test_max_in_flight(self):
+        """No more than maxInFlight processes are restarting at once"""
+        restart = self._rolling(batch=1, maxInFlight=2, interval=0.5)
+        restart.start()
+        self.assertEquals(sorted(restart.inFlight), ['a'])
+        self.reactor.advance(0.5)
+        self.assertEquals(sorted(restart.inFlight), ['a', 'b'])
+        self.reactor.advance(0.5)
+        self.assertEquals(sorted(restart.inFlight), ['a', 'b'])
+
+    def test_removed(self):
+        """Processes removed during the rolling restart are skipped"""
+        restart = self._rolling()
+        restart.start()
+        del self.configs['a']
+        del self.configs['b']
+        self.reactor.advance(1)
+        self.assertEquals(list(restart.inFlight), ['c'])
+
+    def test_timeout(self):
+        """Processes which do not come back are eventually given up on"""
+        self.monitor.killTime = 100
+        self.monitor.protocols['a'].transport._terminationDelay = 100
+        restart = self._rolling(timeout=5)
+        restart.start()
+        for dummy in range(5):
+            self.reactor.advance(1)
+            self.assertEquals(list(restart.inFlight), ['a'])
+        self.reactor.advance(1)
+        self.assertEquals(list(restart.inFlight), ['b'])
+
+    def test_stop(self):
+        """Stopping leaves the rest of the processes alone"""
+        restart = self._rolling()
+        restart.start()
+        restart.stop()
+        self.assertTrue(restart.done)
+        self.assertIsNone(restart.call)
+        restart.stop()
+
+    def test_gate_beatcheck(self):
+        """With gating, processes with a heart need to beat after starting"""
+        status = os.path.abspath('dummy-status')
+        def _cleanup():
+            if os.path.exists(status):
+                shutil.rmtree(status)
+        _cleanup()
+        self.addCleanup(_cleanup)
+        os.makedirs(status)
+        self.configs['a']['ncolony.beatcheck'] = dict(status=status)
+        self.configs['b']['ncolony.beatcheck'] = dict(status=os.path.join(status, 'b'))
+        self.configs['c']['ncolony.beatcheck'] = dict(transport='datagram', socket='beats')
+        restart = self._rolling(gate=True)
+        restart.start()
+        for dummy in range(3):
+            self.reactor.advance(1)
+        self.assertEquals(list(restart.inFlight), ['a'])
+        fname = os.path.join(status, 'a')
+        with open(fname, 'w') as fp:
+            fp.write('beat')
+        os.utime(fname, (0, 10))
+        self.reactor.advance(1)
+        self.assertEquals(list(restart.inFlight), ['a'])
+        os.utime(fname, (0, 12))
+        self.reactor.advance(1)
+        self.assertEquals(list(restart.inFlight), ['b'])
+
+    def test_gate_mmap(self):
+        """With gating, processes beating into a table need to beat in their slot"""
+        table = os.path.abspath('dummy-table')
+        def _cleanup():
+            if os.path.exists(table):
+                os.remove(table)
+        _cleanup()
+        self.addCleanup(_cleanup)
+        messages = []
+        def _observer(msg):
+            messages.append(''.join(msg['message']))
+        self.addCleanup(log.removeObserver, _observer)
+        log.addObserver(_observer)
+        self.configs['a']['ncolony.beatcheck'] = dict(transport='mmap', table=table)
+        self.configs['b']['ncolony.beatcheck'] = dict(transport='datagram', socket='beats')
+        restart = self._rolling(gate=True, slots=dict(a=1))
+        restart.start()
+        def _write(*slots):
+            with open(table, 'wb') as fp:
+                for timestamp, name in slots:
+                    fp.write(struct.pack(heart.SLOT_FORMAT, timestamp, name))
+        for slots in [None, None, None,
+                      [(0, b'')],
+                      [(0, b''), (0, b'a')],
+                      [(0, b''), (time.monotonic(), b'b')],
+                      [(0, b''), (time.monotonic() - 100, b'a')]]:
+            if slots is not None:
+                _write(*slots)
+            self.reactor.advance(1)
+            self.assertEquals(list(restart.inFlight), ['a'])
+        _write((0, b''), (time.monotonic(), b'a'))
+        self.reactor.advance(1)
+        self.assertEquals(list(restart.inFlight), ['b'])
+        self.assertIn('Rolling restart cannot see datagram beats of: b', messages)
+        for dummy in range(3):
+            self.reactor.advance(1)
+        self.assertEquals(list(restart.inFlight), ['b'])
+
+    def test_gate_httpcheck(self):
+        """With gating, processes with an HTTP check need to answer it"""
+        self.configs['a']['ncolony.httpcheck'] = dict(url=u'http://localhost/a')
+        agent = DummyAgent()
+        restart = self._rolling(gate=True, agent=agent)
+        restart.start()
+        self.reactor.advance(1)
+        self.assertEquals(agent.requests, [])
+        self.reactor.advance(1)
+        self.reactor.advance(1)
+        (method, url, d), = agent.requests
+        self.assertEquals((method, url), (b'GET', b'http://localhost/a'))
+        d.callback(DummyResponse(500))
+        self.reactor.advance(1)
+        self.assertEquals(len(agent.requests), 2)
+        agent.requests[-1][-1].errback(ValueError('no'))
+        self.reactor.advance(1)
+        self.assertEquals(len(agent.requests), 3)
+        response = DummyResponse(200)
+        agent.requests[-1][-1].callback(response)
+        self.assertTrue(response.delivered)
+        self.assertEquals(list(restart.inFlight), ['a'])
+        self.reactor.advance(1)
+        self.assertEquals(list(restart.inFlight), ['b'])
+
+    def test_gate_httpcheck_timeout(self):
+        """With gating, HTTP checks which do not answer in time are given up on"""
+        self.configs['a']['ncolony.httpcheck'] = dict(url=u'http://localhost/a', timeout=2)
+        agent = DummyAgent()
+        restart = self._rolling(gate=True, agent=agent)
+        restart.start()
+        for dummy in range(2):
+            self.reactor.advance(1)
+        (dummyMethod, dummyURL, d), = agent.requests
+        self.reactor.advance(1)
+        self.assertFalse(d.called)
+        self.assertEquals(len(agent.requests), 1)
+        self.reactor.advance(1)
+        self.assertTrue(d.called)
+        self.assertEquals(len(agent.requests), 2)
+        self.assertEquals(list(restart.inFlight), ['a'])
+
+    def test_default_agent(self):
+        """Without an agent, one is made on the reactor"""
+        self.configs['a']['ncolony.httpcheck'] = dict(url=b'http://localhost/a')
+        restart = self._rolling(gate=True)
+        restart.start()
+        for dummy in range(3):
+            self.reactor.advance(1)
+        self.assertIsNotNone(restart.agent)
+        self.assertEquals(len(restart.probes), 1)
+        restart.stop()
+        self.assertEquals(restart.probes, {})
+
+
+class TestReceiverRolling(unittest.TestCase):
+
+    """Tests for rolling restart messages"""
+
+    def setUp(self):
+        """Set up a receiver for a monitor with a few processes"""
+        self.reactor = test_procmon.DummyProcessReactor()
+        self.monitor = monitor.ProcessMonitor(self.reactor)
+        self.receiver = process_events.Receiver(self.monitor, reactor=self.reactor)
+        for name in ['a', 'b', 'c']:
+            self.receiver.add(name, helper.dumps2utf8(dict(args=['/bin/' + name])))
+
+    def test_message(self):
+        """Rolling restart messages start a rolling restart, replacing the previous one"""
+        self.receiver.message(helper.dumps2utf8(dict(type='RESTART-ROLLING', batch=2,
+                                                     max_in_flight=3, lalala=5)))
+        first = self.receiver.rolling
+        self.addCleanup(first.stop)
+        self.assertIs(first.slots, self.receiver.slots)
+        self.assertEquals((first.batch, first.maxInFlight), (2, 3))
+        self.assertEquals(sorted(first.inFlight), ['a', 'b'])
+        self.receiver.message(helper.dumps2utf8(dict(type='RESTART-ROLLING')))
+        second = self.receiver.rolling
+        self.addCleanup(second.stop)
+        self.assertTrue(first.done)
+        self.assertEquals(sorted(second.inFlight), ['a'])
@@ -0,0 +1,163 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Tests for ncolony.sampler"""
+
+import os
+import shutil
+import unittest
+
+from ncolony import sampler
+from ncolony.tests import test_control, test_process_events
+
+STATUS = """\
+Name:\tsleep
+State:\tS (sleeping)
+voluntary_ctxt_switches:\t10
+nonvoluntary_ctxt_switches:\t3
+"""
+
+def writeProcess(proc, pid, utime, stime, rss, threads=1, fds=2):
+    """Write a fake /proc/<pid>
+
+    :params proc: string, the fake procfs
+    :params pid: integer, the process id
+    :params utime: integer, user time in clock ticks
+    :params stime: integer, system time in clock ticks
+    :params rss: integer, resident pages
+    :params threads: integer, number of threads
+    :params fds: integer, number of open file descriptors
+    """
+    base = os.path.join(proc, str(pid))
+    fd = os.path.join(base, 'fd')
+    if os.path.exists(base):
+        shutil.rmtree(base)
+    os.makedirs(fd)
+    for num in range(fds):
+        with open(os.path.join(fd, str(num)), 'w'):
+            pass
+    fields = ['S'] + ['0'] * 10 + [str(utime), str(stime)] + ['0'] * 4 + [str(threads)]
+    with open(os.path.join(base, 'stat'), 'w') as fp:
+        fp.write('%d (a (weird) name) %s 0 0\n' % (pid, ' '.join(fields)))
+    with open(os.path.join(base, 'statm'), 'w') as fp:
+        fp.write('100 %d 5 1 0 20 0\n' % rss)
+    with open(os.path.join(base, 'status'), 'w') as fp:
+        fp.write(STATUS)
+
+class BaseSamplerTest(unittest.TestCase):
+
+    """Set up a fake procfs"""
+
+    def setUp(self):
+        """Set up the test"""
+        self.proc = os.path.abspath('dummy-proc')
+        def _cleanup():
+            if os.path.exists(self.proc):
+                shutil.rmtree(self.proc)
+        _cleanup()
+        self.addCleanup(_cleanup)
+        os.makedirs(self.proc)
+
+class TestReadSample(BaseSamplerTest):
+
+    """Tests for readSample"""
+
+    def test_read(self):
+        """The sample has the process's resource use"""
+        writeProcess(self.proc, 17, utime=3 * sampler.TICKS, stime=sampler.TICKS,
+                     rss=4, threads=6, fds=3)
+        sample = sampler.readSample(17, 5, self.proc)
+        self.assertEquals(sample, sampler.Sample(time=5, pid=17, cpu=4, rss=4 * sampler.PAGE_SIZE,
+                                                 threads=6, fds=3, ctxSwitches=13))
+
+    def test_gone(self):
+        """A process which is gone has no sample"""
+        self.assertIsNone(sampler.readSample(17, 5, self.proc))
+
+    def test_real(self):
+        """The current process can be sampled from the real procfs"""
+        if not os.path.isdir('/proc/self'):
+            raise unittest.SkipTest("no procfs")
+        sample = sampler.readSample(os.getpid(), 5)
+        self.assertEquals(sample.pid, os.getpid())
+        self.assertGreater(sample.rss, 0)
+        self.assertGreater(sample.threads, 0)
+        self.assertGreater(sample.fds, 0)
+
+class TestSampler(BaseSamplerTest):
+
+    """Tests for Sampler"""
+
+    def setUp(self):
+        """Set up the test"""
+        super(TestSampler, self).setUp()
+        self.monitor = test_process_events.DummyProcessMonitor()
+        self.monitor.protocols = {}
+        ## pylint: disable=protected-access
+        self.monitor._processes = {}
+        ## pylint: enable=protected-access
+        self.now = 10
+        self.sampler = sampler.Sampler(self.monitor, size=2, proc=self.proc,
+                                       timer=lambda: self.now)
+
+    def _run(self, name, pid):
+        ## pylint: disable=protected-access
+        self.monitor._processes[name] = None
+        ## pylint: enable=protected-access
+        self.monitor.protocols[name] = test_control.DummyProtocol(
+            test_control.DummyTransport(pid=pid))
+
+    def test_sample(self):
+        """Running processes are sampled, keeping only the latest samples"""
+        self._run('hello', 17)
+        self._run('goodbye', 18)
+        writeProcess(self.proc, 17, utime=0, stime=0, rss=1)
+        for utime in [1, 2, 4]:
+            writeProcess(self.proc, 17, utime=utime * sampler.TICKS, stime=0, rss=1)
+            self.sampler.sample()
+            self.now += 2
+        self.assertEquals(list(self.sampler.samples), ['hello'])
+        self.assertEquals([sample['cpu'] for sample in self.sampler.recent('hello')], [2, 4])
+        summary = self.sampler.summary('hello')
+        self.assertEquals(summary['cpu'], 4)
+        self.assertEquals(summary['cpuRate'], 1)
+        self.assertIsNone(self.sampler.summary('goodbye'))
+        self.assertEquals(self.sampler.recent('goodbye'), [])
+
+    def test_not_running(self):
+        """Processes without a transport are not sampled"""
+        self._run('hello', 17)
+        self.monitor.protocols['hello'] = test_control.DummyProtocol(None)
+        writeProcess(self.proc, 17, utime=0, stime=0, rss=1)
+        self.sampler.sample()
+        self.assertEquals(self.sampler.samples, {})
+
+    def test_restarted(self):
+        """The CPU rate is not computed across a restart"""
+        self._run('hello', 17)
+        writeProcess(self.proc, 17, utime=5, stime=0, rss=1)
+        writeProcess(self.proc, 18, utime=0, stime=0, rss=1)
+        self.sampler.sample()
+        summary = self.sampler.summary('hello')
+        self.assertIsNone(summary['cpuRate'])
+        self._run('hello', 18)
+        self.now += 1
+        self.sampler.sample()
+        summary = self.sampler.summary('hello')
+        self.assertEquals(summary['pid'], 18)
+        self.assertIsNone(summary['cpuRate'])
+
+    def test_removed(self):
+        """Samples of removed processes are dropped"""
+        self._run('hello', 17)
+        writeProcess(self.proc, 17, utime=0, stime=0, rss=1)
+        self.sampler.sample()
+        self.assertEquals(len(self.sampler.recent('hello')), 1)
+        del self.monitor.protocols['hello']
+        self.sampler.sample()
+        self.assertEquals(len(self.sampler.recent('hello')), 1)
+        ## pylint: disable=protected-access
+        del self.monitor._processes['hello']
+        ## pylint: enable=protected-access
+        self.sampler.sample()
+        self.assertEquals(self.sampler.samples, {})
@@ -3,14 +3,11 @@
 
 """Test ncolony.schedulelib"""
 
-from __future__ import division
-
+import io
 import os
 import unittest
 import sys
 
-import six
-
 from zope.interface import verify
 
 from twisted.python import failure
@@ -23,7 +20,7 @@ from twisted.application import internet as tainternet
 
 from twisted.runner.test import test_procmon
 
-from ncolony import schedulelib
+from ncolony import instrument, schedulelib
 
 from ncolony.client.tests import test_heart
 
@@ -32,7 +29,7 @@ class TestProcessProtocol(unittest.TestCase):
     """Test schedulelib.ProcessProtocol"""
 
     def setUp(self):
-        out = six.StringIO()
+        out = io.StringIO()
         oldstdout = sys.stdout
         def _cleanup():
             sys.stdout = oldstdout
@@ -80,7 +77,7 @@ class TestRunProcess(unittest.TestCase):
 
     def setUp(self):
         self.reactor = test_procmon.DummyProcessReactor()
-        out = six.StringIO()
+        out = io.StringIO()
         oldstdout = sys.stdout
         def _cleanup():
             sys.stdout = oldstdout
@@ -204,7 +201,7 @@ class TestService(unittest.TestCase):
     def getArgs(self):
         """Get the arguments as a list of strings"""
         return ' '.join(' '.join('--%s %s' % (key, vpart) for vpart in value.split())
-                        for key, value in six.iteritems(self.args)).split()
+                        for key, value in self.args.items()).split()
 
     def test_normal(self):
         """Test correct parsing of a command line"""
@@ -253,6 +250,19 @@ class TestService(unittest.TestCase):
         self.assertEquals(args, (opts['args'], opts['timeout'], opts['grace'], reactor))
         self.assertEquals(service.step, opts['frequency'])
 
+    def test_make_service_metrics(self):
+        """Test the make service function serving metrics"""
+        opts = dict(args=['/bin/echo', 'hello'], timeout=10, grace=2, frequency=30,
+                    metrics='tcp:0')
+        masterService = schedulelib.makeService(opts)
+        func, _, _ = masterService.getServiceNamed('scheduler').call
+        self.assertIs(func.func, instrument.timed)
+        instrumentation, name, dummyTimer, runner = func.args
+        self.assertEquals((name, runner), ('scheduler', schedulelib.runProcess))
+        registry = masterService.getServiceNamed('metrics').factory.resource.registry
+        self.assertIs(registry.metrics[1], instrumentation.instrumentations[0].callbacks)
+        masterService.getServiceNamed('lag')
+
     def test_make_service_with_health(self):
         """Test schedulelib with heart beater"""
         opts = dict(timeout=10, grace=2, frequency=30)
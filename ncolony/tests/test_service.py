@@ -7,6 +7,8 @@ import collections
 import json
 import os
 import shutil
+import signal
+import time
 import unittest
 
 from zope.interface import verify
@@ -17,7 +19,8 @@ from twisted.application import service as taservice, internet
 from twisted.runner import procmon
 from twisted.runner.test import test_procmon
 
-from ncolony import service
+from ncolony import adopt as nadopt, directory_monitor, service
+from ncolony.tests import test_adopt
 
 class DummyFile(object):
 
@@ -106,11 +109,216 @@ class TestService(unittest.TestCase):
         self.assertIsInstance(protocols, service.TransportDirectoryDict)
         self.assertIs(protocols.output, pidDir)
 
+    def test_adopt(self):
+        """Test service keeping processes in the pid directory"""
+        pidDir = os.path.join(os.getcwd(), 'pid-dir')
+        self.addCleanup(shutil.rmtree, pidDir)
+        self.service = service.get(self.testDirs['config'], self.testDirs['messages'],
+                                   5, pidDir=pidDir, reactor=self.my_reactor, adopt=True)
+        self._finishSetUp()
+        self.assertEquals(self.pm.table.directory, pidDir)
+        self.assertNotIsInstance(self.pm.protocols, service.TransportDirectoryDict)
+
+    def test_adopt_configured(self):
+        """Test service recording processes started from configuration files"""
+        pidDir = os.path.join(os.getcwd(), 'pid-dir')
+        self.addCleanup(shutil.rmtree, pidDir)
+        with open(os.path.join(self.testDirs['config'], 'foo'), 'w') as fp:
+            fp.write(json.dumps(dict(args=['/bin/foo'])))
+        self.service = service.get(self.testDirs['config'], self.testDirs['messages'],
+                                   5, pidDir=pidDir, reactor=self.my_reactor, adopt=True)
+        self._finishSetUp()
+        self.functions[0]()
+        process, = self.my_reactor.spawnedProcesses
+        self.assertEquals(process._args, ['/bin/foo'])
+        with open(os.path.join(pidDir, '.table', 'foo')) as fp:
+            details = json.loads(fp.read())
+        self.assertEquals(details['spec'], nadopt.specHash(self.pm._processes['foo']))
+
+    def test_adopt_batches(self):
+        """Test service only stopping unconfigured processes once all batches are applied"""
+        pidDir = os.path.join(os.getcwd(), 'pid-dir')
+        self.addCleanup(shutil.rmtree, pidDir)
+        table = nadopt.ProcessTable(pidDir)
+        children = {}
+        for name in ['a', 'b', 'c']:
+            contents = json.dumps(dict(args=['/bin/' + name])).encode('utf-8')
+            if name != 'c':
+                with open(os.path.join(self.testDirs['config'], name), 'wb') as fp:
+                    fp.write(contents)
+            children[name] = test_adopt.startChild(self)
+            env = dict(NCOLONY_CONFIG=contents, NCOLONY_NAME=name)
+            process = procmon._Process(['/bin/' + name], None, None, env, None)
+            table.record(name, children[name].pid, nadopt.specHash(process), 5)
+        self.service = service.get(self.testDirs['config'], self.testDirs['messages'],
+                                   5, pidDir=pidDir, reactor=self.my_reactor, adopt=True,
+                                   batchSize=1)
+        self._finishSetUp()
+        self.addCleanup(self.pm.stopService)
+        self.functions[0]()
+        self.assertEquals(sorted(self.pm._processes), ['a'])
+        self.assertEquals([children[name].poll() for name in 'abc'], [None, None, None])
+        self.my_reactor.advance(1)
+        self.assertEquals(self.my_reactor.spawnedProcesses, [])
+        self.assertEquals([children[name].poll() for name in 'ab'], [None, None])
+        self.assertEquals(children['c'].wait(), -signal.SIGTERM)
+        self.assertEquals(sorted(os.listdir(table.records)), ['a', 'b'])
+
+    def test_inotify(self):
+        """Test service with an inotify watcher"""
+        myserv = service.get(self.testDirs['config'], self.testDirs['messages'],
+                             5, reactor=self.my_reactor, inotify=True)
+        watcher = myserv.getServiceNamed('confwatch')
+        self.assertIsInstance(watcher, directory_monitor.Watcher)
+        self.assertEquals(watcher.location, self.testDirs['config'])
+        self.assertIs(watcher.reactor, self.my_reactor)
+        checkers = [s.call[0] for s in myserv if isinstance(s, internet.TimerService)]
+        self.assertIn(watcher.check, checkers)
+        messageWatcher = myserv.getServiceNamed('messagewatch')
+        self.assertEquals(messageWatcher.location, self.testDirs['messages'])
+        self.assertEquals(messageWatcher.mask, directory_monitor.MESSAGES_MASK)
+        self.assertIn(messageWatcher.check, checkers)
+        self.assertNotEquals(messageWatcher.check, watcher.check)
+
+    def test_stat(self):
+        """Test service in stat mode notices changes with new metadata"""
+        self.service = service.get(self.testDirs['config'], self.testDirs['messages'],
+                                   5, reactor=self.my_reactor, stat=True)
+        self._finishSetUp()
+        content = json.dumps(dict(args=['/bin/echo', 'hello']))
+        self._write('config', 'one', content)
+        self._check()
+        process, = self.my_reactor.spawnedProcesses
+        self.assertEquals(process._args, ['/bin/echo', 'hello'])
+
+    def test_control(self):
+        """Test service with a control socket"""
+        myserv = service.get(self.testDirs['config'], self.testDirs['messages'],
+                             5, reactor=self.my_reactor, control='control.sock')
+        controlserv = myserv.getServiceNamed('control')
+        self.assertIsInstance(controlserv, internet.UNIXServer)
+        self.assertIs(controlserv.reactor, self.my_reactor)
+        address, factory = controlserv.args
+        self.assertEquals(address, 'control.sock')
+        self.assertEquals(controlserv.kwargs, dict(mode=0o600, wantPID=True))
+        controller = factory.controller
+        self.assertIs(controller.monitor, myserv.getServiceNamed('procmon'))
+        self.assertEquals(controller.config.path, self.testDirs['config'])
+        self.assertEquals(controller.messages.path, self.testDirs['messages'])
+
+    def test_sampler(self):
+        """Test service samples resource use, and reports it through control"""
+        myserv = service.get(self.testDirs['config'], self.testDirs['messages'],
+                             5, reactor=self.my_reactor, control='control.sock',
+                             sampleFreq=3, sampleSize=7)
+        sampleserv = myserv.getServiceNamed('sampler')
+        self.assertEquals(sampleserv.step, 3)
+        resources = sampleserv.call[0].__self__
+        self.assertIs(resources.monitor, myserv.getServiceNamed('procmon'))
+        self.assertEquals(resources.size, 7)
+        self.assertEquals(resources.timer, self.my_reactor.seconds)
+        _, factory = myserv.getServiceNamed('control').args
+        self.assertIs(factory.controller.sampler, resources)
+
+    def test_metrics(self):
+        """Test service measures scans and exports the monitor's state"""
+        self.service = service.get(self.testDirs['config'], self.testDirs['messages'],
+                                   5, reactor=self.my_reactor, metrics='tcp:0',
+                                   sampleFreq=1)
+        server = self.service.getServiceNamed('metrics')
+        self.assertIs(server.endpoint._reactor, self.my_reactor)
+        lag = self.service.getServiceNamed('lag')
+        self.assertIs(lag.clock, self.my_reactor)
+        sampleserv = self.service.getServiceNamed('sampler')
+        self.assertEquals(sampleserv.call[0].args[1], 'sampler')
+        registry = server.factory.resource.registry
+        for name in ['metrics', 'lag', 'sampler']:
+            self.service.removeService(self.service.getServiceNamed(name))
+        self._finishSetUp()
+        self._write('config', 'one', json.dumps(dict(args=['/bin/echo', 'hello'])))
+        self._write('config', 'two', json.dumps(dict(args=['/bin/echo', 'goodbye'])))
+        self._check()
+        self._write('messages', '00Message', json.dumps(dict(type='RESTART', name='one')))
+        self._check()
+        self.my_reactor.spawnedProcesses[1].processEnded(1)
+        self.pm.parked.add('two')
+        text = registry.render().decode('utf-8').splitlines()
+        for line in ['ncolony_callback_seconds_count{name="config"} 2.0',
+                     'ncolony_callback_seconds_count{name="messages"} 2.0',
+                     'ncolony_processes 2.0',
+                     'ncolony_process_running{name="one"} 1.0',
+                     'ncolony_process_running{name="two"} 0.0',
+                     'ncolony_process_exits_total{name="two"} 1.0',
+                     'ncolony_restart_delay_seconds{name="two"} 2.0',
+                     'ncolony_process_parked{name="two"} 1.0',
+                     'ncolony_messages_total{type="RESTART"} 1.0']:
+            self.assertIn(line, text)
+
+    def test_slow_threshold(self):
+        """Test service watching for stalls without metrics"""
+        myserv = service.get(self.testDirs['config'], self.testDirs['messages'],
+                             5, reactor=self.my_reactor, slowThreshold=3)
+        watcher = myserv.getServiceNamed('watchdog')
+        self.assertEquals(watcher.watchdog.threshold, 3)
+        with self.assertRaises(KeyError):
+            myserv.getServiceNamed('metrics')
+
+    def test_batch(self):
+        """Test service applies configuration changes in batches"""
+        self.service = service.get(self.testDirs['config'], self.testDirs['messages'],
+                                   5, reactor=self.my_reactor, batchSize=1, batchDelay=2)
+        self._finishSetUp()
+        for name in ['one', 'two']:
+            self._write('config', name, json.dumps(dict(args=['/bin/echo', name])))
+        self._check()
+        process, = self.my_reactor.spawnedProcesses
+        self.assertEquals(process._args, ['/bin/echo', 'one'])
+        self.my_reactor.advance(2)
+        _, process = self.my_reactor.spawnedProcesses
+        self.assertEquals(process._args, ['/bin/echo', 'two'])
+
+    def test_semantic(self):
+        """Test service in semantic mode does not restart on monitoring changes"""
+        self.service = service.get(self.testDirs['config'], self.testDirs['messages'],
+                                   5, reactor=self.my_reactor, semantic=True)
+        self._finishSetUp()
+        config = dict(args=['/bin/echo', 'hello'])
+        self._write('config', 'one', json.dumps(config))
+        self._check()
+        config['ncolony.httpcheck'] = dict(url='http://localhost/')
+        self._write('config', 'one', json.dumps(config))
+        self._check()
+        process, = self.my_reactor.spawnedProcesses
+        self.assertTrue(process.pid)
+        self.assertNotIn(b'ncolony.httpcheck', process._environment['NCOLONY_CONFIG'])
+        self.pm.stopProcess('one')
+        self.my_reactor.advance(60)
+        _, newProcess = self.my_reactor.spawnedProcesses
+        self.assertIn(b'ncolony.httpcheck', newProcess._environment['NCOLONY_CONFIG'])
+
+    def test_restart_cooldown(self):
+        """Test service ignores restarts of recently restarted processes"""
+        self.service = service.get(self.testDirs['config'], self.testDirs['messages'],
+                                   5, reactor=self.my_reactor, restartCooldown=30)
+        self._finishSetUp()
+        self._write('config', 'one', json.dumps(dict(args=['/bin/echo', 'hello'])))
+        self._check()
+        restart = json.dumps(dict(type='RESTART', name='one'))
+        self._write('messages', '00Message', restart)
+        self._check()
+        self.my_reactor.advance(10)
+        self._write('messages', '00Message', restart)
+        self._check()
+        self.my_reactor.advance(10)
+        self.assertEquals(len(self.my_reactor.spawnedProcesses), 2)
+
     def test_regular_reactor(self):
         """Test that the default reactor is the default reactor"""
-        myserv = service.get('', '', 5)
+        myserv = service.get('', '', 5, sampleFreq=1)
         pm = myserv.getServiceNamed('procmon')
         self.assertEquals(pm._reactor, reactor)
+        resources = myserv.getServiceNamed('sampler').call[0].__self__
+        self.assertIs(resources.timer, time.time)
 
     def _check(self):
         for f in self.functions:
@@ -138,6 +346,7 @@ class TestService(unittest.TestCase):
         for subservice in self.subservices:
             self.assertIsInstance(subservice, internet.TimerService)
             self.assertEquals(subservice.step, 5)
+            self.assertIs(subservice.clock, self.my_reactor)
             _, args, kwargs = subservice.call
             self.assertFalse(args)
             self.assertFalse(kwargs)
@@ -187,12 +396,95 @@ class TestOptions(unittest.TestCase):
         self.assertEqual(self.opt['maxrestartdelay'], 3600)
         self.assertEqual(self.opt['frequency'], 10)
         self.assertEqual(self.opt['pid'], None)
+        self.assertFalse(self.opt['inotify'])
+        self.assertFalse(self.opt['stat'])
+        self.assertEqual(self.opt['control'], None)
+        self.assertEqual(self.opt['batch-size'], None)
+        self.assertEqual(self.opt['batch-delay'], 1)
+        self.assertFalse(self.opt['semantic'])
+        self.assertEqual(self.opt['restart-cooldown'], 0)
+        self.assertEqual(self.opt['sample-frequency'], None)
+        self.assertEqual(self.opt['sample-size'], 60)
+        self.assertEqual(self.opt['metrics'], None)
+        self.assertEqual(self.opt['slow-threshold'], None)
+
+    def test_semantic(self):
+        """Test explicit semantic"""
+        self.opt.parseOptions(self.basic+['--semantic'])
+        self.assertTrue(self.opt['semantic'])
+        service.makeService(self.opt)
+
+    def test_batch(self):
+        """Test explicit batch size and delay"""
+        self.opt.parseOptions(self.basic+['--batch-size', '10', '--batch-delay', '0.5'])
+        self.assertEqual(self.opt['batch-size'], 10)
+        self.assertEqual(self.opt['batch-delay'], 0.5)
+        service.makeService(self.opt)
+
+    def test_restart_cooldown(self):
+        """Test explicit restart cooldown"""
+        self.opt.parseOptions(self.basic+['--restart-cooldown', '30'])
+        self.assertEqual(self.opt['restart-cooldown'], 30)
+        service.makeService(self.opt)
+
+    def test_sampler(self):
+        """Test explicit sampling"""
+        self.opt.parseOptions(self.basic+['--sample-frequency', '2', '--sample-size', '5'])
+        self.assertEqual(self.opt['sample-frequency'], 2)
+        self.assertEqual(self.opt['sample-size'], 5)
+        s = service.makeService(self.opt)
+        self.assertEqual(s.getServiceNamed('sampler').step, 2)
+
+    def test_metrics(self):
+        """Test explicit metrics endpoint and slow threshold"""
+        self.opt.parseOptions(self.basic+['--metrics', 'tcp:9100', '--slow-threshold', '2'])
+        self.assertEqual(self.opt['metrics'], 'tcp:9100')
+        self.assertEqual(self.opt['slow-threshold'], 2)
+        s = service.makeService(self.opt)
+        s.getServiceNamed('metrics')
+        s.getServiceNamed('watchdog')
+
+    def test_control(self):
+        """Test explicit control socket"""
+        self.opt.parseOptions(self.basic+['--control', 'control.sock'])
+        self.assertEqual(self.opt['control'], 'control.sock')
+        s = service.makeService(self.opt)
+        address, _ = s.getServiceNamed('control').args
+        self.assertEquals(address, 'control.sock')
+
+    def test_stat(self):
+        """Test explicit stat"""
+        self.opt.parseOptions(self.basic+['--stat'])
+        self.assertTrue(self.opt['stat'])
+
+    def test_inotify(self):
+        """Test explicit inotify"""
+        self.opt.parseOptions(self.basic+['--inotify'])
+        self.assertTrue(self.opt['inotify'])
+
+    def test_inotify_unavailable(self):
+        """Test inotify is refused when the platform does not support it"""
+        oldInotify = directory_monitor.inotify
+        def _cleanup():
+            directory_monitor.inotify = oldInotify
+        self.addCleanup(_cleanup)
+        directory_monitor.inotify = None
+        with self.assertRaises(usage.UsageError):
+            self.opt.parseOptions(self.basic+['--inotify'])
 
     def test_pid(self):
         """Test explicit pid"""
         self.opt.parseOptions(self.basic+['--pid', 'pid-dir'])
         self.assertEqual(self.opt['pid'], 'pid-dir')
 
+    def test_adopt(self):
+        """Test adopting processes, which needs a pid directory"""
+        self.assertFalse(self.opt['adopt'])
+        with self.assertRaises(usage.UsageError):
+            self.opt.parseOptions(self.basic+['--adopt'])
+        self.opt.parseOptions(self.basic+['--adopt', '--pid', 'pid-dir'])
+        self.assertTrue(self.opt['adopt'])
+
     def test_threshold(self):
         """Test explicit threshold"""
         self.opt.parseOptions(self.basic+['--threshold', '7.5'])
@@ -219,6 +511,15 @@ class TestOptions(unittest.TestCase):
         self.opt.parseOptions(self.basic+['--frequency', '7.5'])
         self.assertEqual(self.opt['frequency'], 7.5)
 
+    def test_makeservice_adopt(self):
+        """Test makeService keeping processes in the pid directory"""
+        pidDir = os.path.join(os.getcwd(), 'pid-dir')
+        self.addCleanup(shutil.rmtree, pidDir)
+        self.opt.parseOptions(self.basic+['--adopt', '--pid', pidDir])
+        s = service.makeService(self.opt)
+        pm = s.getServiceNamed('procmon')
+        self.assertEquals(os.listdir(pm.table.directory), ['.table'])
+
     def test_makeservice(self):
         """Test makeService"""
         self.opt.parseOptions(self.basic+
@@ -229,6 +530,12 @@ class TestOptions(unittest.TestCase):
                               ['--frequency', '4.5']+
                               ['--pid', 'pid-dir'])
         s = service.makeService(self.opt)
+        with self.assertRaises(KeyError):
+            s.getServiceNamed('confwatch')
+        with self.assertRaises(KeyError):
+            s.getServiceNamed('control')
+        with self.assertRaises(KeyError):
+            s.getServiceNamed('sampler')
         pm = s.getServiceNamed('procmon')
         self.assertIsInstance(pm, procmon.ProcessMonitor)
         subservices = list(s)
@@ -241,6 +548,7 @@ class TestOptions(unittest.TestCase):
         protocols = pm.protocols
         self.assertIsInstance(protocols, service.TransportDirectoryDict)
         self.assertIs(protocols.output, 'pid-dir')
+        self.assertIsNone(pm.table)
         self.assertEquals(subservices[0].step, 4.5)
         self.assertEquals(pm.threshold, 0.5)
         self.assertEquals(pm.killTime, 1.5)
@@ -0,0 +1,316 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Tests for ncolony.simulate"""
+
+import json
+import os
+import shutil
+
+from twisted.application import internet as tainternet, service as taservice
+from twisted.internet import error, protocol
+from twisted.trial import unittest
+
+from ncolony import simulate
+
+class RecordingProtocol(protocol.ProcessProtocol):
+
+    """Record how a process ended"""
+
+    def __init__(self, name):
+        self.name = name
+        self.reasons = []
+
+    def processEnded(self, reason):
+        """Record the reason"""
+        self.reasons.append(reason)
+
+class TestSimulatedReactor(unittest.TestCase):
+
+    """Tests for the simulated process table"""
+
+    def setUp(self):
+        """Set up the test"""
+        self.behaviours = dict(crash=simulate.Behaviour(lifetime=5),
+                               stubborn=simulate.Behaviour(stubborn=True))
+        self.reactor = simulate.SimulatedReactor(
+            lambda name: self.behaviours.get(name, simulate.Behaviour()))
+
+    def _spawn(self, name):
+        proto = RecordingProtocol(name)
+        process = self.reactor.spawnProcess(proto, '/bin/simulated', ['/bin/simulated'])
+        return proto, process
+
+    def test_spawn(self):
+        """Processes are in the table until they exit by themselves"""
+        proto, process = self._spawn('crash')
+        self.assertIs(proto.transport, process)
+        self.assertEquals(process.pid, simulate.FIRST_PID)
+        self.assertEquals(self.reactor.processes, {process.pid: process})
+        self.assertEquals(self.reactor.running, dict(crash=process))
+        self.reactor.advance(4)
+        self.assertEquals(proto.reasons, [])
+        self.reactor.advance(1)
+        reason, = proto.reasons
+        self.assertEquals(reason.value.exitCode, 1)
+        self.assertEquals((self.reactor.processes, self.reactor.running), ({}, {}))
+        self.assertEquals(process.ended, 5)
+        _, again = self._spawn('crash')
+        self.assertEquals(again.pid, simulate.FIRST_PID + 1)
+        self.assertEquals(self.reactor.spawned, dict(crash=2))
+
+    def test_signal(self):
+        """Signals end processes on the next iteration"""
+        proto, process = self._spawn('crash')
+        process.signalProcess('TERM')
+        with self.assertRaises(error.ProcessExitedAlready):
+            process.signalProcess('KILL')
+        self.assertEquals(proto.reasons, [])
+        self.reactor.advance(0)
+        reason, = proto.reasons
+        self.assertEquals(reason.value.signal, 'TERM')
+        self.reactor.advance(10)
+        self.assertEquals(len(proto.reasons), 1)
+        with self.assertRaises(error.ProcessExitedAlready):
+            process.signalProcess('TERM')
+
+    def test_signal_at_exit(self):
+        """A process signalled as it exits by itself only ends once"""
+        self.reactor.callLater(5, lambda: process.signalProcess('TERM'))
+        proto, process = self._spawn('crash')
+        self.reactor.advance(5)
+        reason, = proto.reasons
+        self.assertEquals(reason.value.exitCode, 1)
+
+    def test_stubborn(self):
+        """Stubborn processes need to be killed"""
+        proto, process = self._spawn('stubborn')
+        process.signalProcess('TERM')
+        self.reactor.advance(0)
+        self.assertEquals(proto.reasons, [])
+        process.signalProcess('KILL')
+        self.reactor.advance(0)
+        self.assertEquals(proto.reasons[0].value.signal, 'KILL')
+
+    def test_replaced(self):
+        """A process which ends after another one by the same name started stays running"""
+        _, old = self._spawn('other')
+        _, new = self._spawn('other')
+        old.signalProcess('KILL')
+        self.reactor.advance(0)
+        self.assertEquals(self.reactor.running, dict(other=new))
+
+    def test_calls(self):
+        """Calls run in order of time, and then of scheduling"""
+        called = []
+        for name, delay in [('c', 3), ('a', 1), ('b', 2), ('b2', 2), ('d', 4)]:
+            self.reactor.callLater(delay, called.append, name)
+        self.reactor.callLater(1.5, called.append, 'cancelled').cancel()
+        self.reactor.getDelayedCalls()[-1].delay(-3.5)
+        self.reactor.advance(2)
+        self.assertEquals(called, ['d', 'a', 'b', 'b2'])
+        self.reactor.advance(1)
+        self.assertEquals(called[-1], 'c')
+
+class TestBehaviour(unittest.TestCase):
+
+    """Tests for when processes beat and hang"""
+
+    def _process(self, behaviour):
+        reactor = simulate.SimulatedReactor(lambda name: behaviour)
+        reactor.advance(100)
+        return reactor.spawnProcess(RecordingProtocol('foo'), '/bin/simulated')
+
+    def test_beats(self):
+        """Beats are every period from the start"""
+        process = self._process(simulate.Behaviour(beat=5))
+        self.assertEquals([process.lastBeat(now) for now in (104, 105, 112, 1000)],
+                          [None, 105, 110, 1000])
+        self.assertFalse(process.hung(10000))
+        self.assertIsNone(self._process(simulate.Behaviour()).lastBeat(1000))
+
+    def test_hang(self):
+        """Beats stop when the process hangs"""
+        process = self._process(simulate.Behaviour(beat=5, hang=12))
+        self.assertEquals([process.lastBeat(now) for now in (111, 112, 1000)],
+                          [110, 110, 110])
+        self.assertEquals([process.hung(now) for now in (111, 112)], [False, True])
+
+class TestSimulatedAgent(unittest.TestCase):
+
+    """Tests for the simulated HTTP agent"""
+
+    def test_request(self):
+        """Healthy running processes answer"""
+        behaviours = dict(sick=simulate.Behaviour(healthy=False),
+                          hang=simulate.Behaviour(hang=5))
+        reactor = simulate.SimulatedReactor(
+            lambda name: behaviours.get(name, simulate.Behaviour()))
+        for name in ('sick', 'hang', 'good'):
+            reactor.spawnProcess(RecordingProtocol(name), '/bin/simulated')
+        agent = simulate.SimulatedAgent(reactor, {'http://%s/' % name: name
+                                                  for name in ('sick', 'hang', 'good', 'gone')})
+        def _result(url):
+            results = []
+            agent.request('GET', url).addBoth(results.append)
+            return results
+        self.assertEquals(_result('http://good/'), [None])
+        self.assertEquals(_result('http://hang/'), [None])
+        self.assertEquals(_result('http://sick/'), [])
+        reactor.advance(5)
+        self.assertEquals(_result('http://hang/'), [])
+        for url in ('http://gone/', 'http://unknown/'):
+            result, = _result(url)
+            self.assertTrue(result.check(error.ConnectionRefusedError))
+
+class TestSimulation(unittest.TestCase):
+
+    """Tests for simulating a colony"""
+
+    def setUp(self):
+        """Set up the test"""
+        self.location = os.path.abspath('dummy-simulation')
+        def _cleanup():
+            if os.path.exists(self.location):
+                shutil.rmtree(self.location)
+        _cleanup()
+        self.addCleanup(_cleanup)
+        self.behaviours = {}
+        self.sim = self._simulation('first')
+
+    def _simulation(self, name, **kwargs):
+        return simulate.Simulation(os.path.join(self.location, name),
+                                   lambda name: self.behaviours.get(name, simulate.Behaviour()),
+                                   **kwargs)
+
+    def _config(self, name):
+        path = os.path.join(self.sim.places.config, name)
+        with open(path) as fp:
+            return json.loads(fp.read()), os.path.getmtime(path)
+
+    def test_wiring(self):
+        """Every timer runs on the simulated reactor"""
+        sim = self._simulation('wiring', options=dict(sampleFreq=5))
+        timers = []
+        def _walk(parent):
+            for child in parent:
+                if isinstance(child, tainternet.TimerService):
+                    timers.append(child)
+                elif isinstance(child, taservice.MultiService):
+                    _walk(child)
+        _walk(sim.service)
+        self.assertEquals(len(timers), 7)
+        for timer in timers:
+            self.assertIs(timer.clock, sim.reactor)
+        self.assertIs(sim.monitor._reactor, sim.reactor) # pylint: disable=protected-access
+        self.assertEquals(sim.reactor.seconds(), simulate.START)
+
+    def test_default_behaviour(self):
+        """By default, processes run until they are stopped"""
+        sim = simulate.Simulation(os.path.join(self.location, 'default'))
+        sim.add('foo')
+        sim.start()
+        sim.run(100)
+        process, = sim.reactor.processes.values()
+        self.assertEquals(process.behaviour, simulate.Behaviour())
+
+    def test_add(self):
+        """Checks are pointed at the simulation, at simulated time"""
+        self.sim.reactor.advance(5)
+        self.sim.add('foo', {'ncolony.beatcheck': dict(period=10, grace=3),
+                             'ncolony.httpcheck': dict(period=10, grace=1, maxBad=3,
+                                                       timeout=5)})
+        config, mtime = self._config('foo')
+        self.assertEquals(config['args'], ['simulated', 'foo'])
+        self.assertEquals(config['ncolony.beatcheck']['status'], self.sim.status)
+        self.assertEquals(config['ncolony.httpcheck']['url'], 'http://foo/')
+        self.assertEquals(mtime, simulate.START + 5)
+        self.sim.add('bar', {'ncolony.httpcheck': dict(url='http://bar:8080/')})
+        self.assertEquals(self.sim.names, {'http://foo/': 'foo', 'http://bar:8080/': 'bar'})
+        self.sim.add('baz')
+        self.assertEquals(self._config('baz')[0], dict(args=['simulated', 'baz']))
+
+    def test_backoff(self):
+        """A crashing process is restarted with growing delays"""
+        self.behaviours['crash'] = simulate.Behaviour(lifetime=0.5)
+        self.sim.add('crash')
+        self.sim.start()
+        self.sim.run(60)
+        self.assertEquals(self.sim.reactor.spawned, dict(crash=6))
+        self.assertEquals(self.sim.monitor.delay['crash'], 64)
+
+    def test_beatcheck(self):
+        """A process which stops beating is restarted by the heart beat check"""
+        self.behaviours['hang'] = simulate.Behaviour(beat=5, hang=60)
+        self.behaviours['good'] = simulate.Behaviour(beat=5)
+        for name in ('hang', 'good'):
+            self.sim.add(name, {'ncolony.beatcheck': dict(period=10, grace=3)})
+        self.sim.start()
+        self.sim.run(60)
+        status = os.path.join(self.sim.status, 'hang')
+        self.assertEquals(os.path.getmtime(status), simulate.START + 60)
+        self.sim.run(40)
+        self.assertEquals(self.sim.reactor.spawned, dict(hang=2, good=1))
+        self.assertEquals(os.path.getmtime(status), simulate.START + 100)
+
+    def test_httpcheck(self):
+        """A process which does not answer is restarted by the HTTP check"""
+        self.behaviours['sick'] = simulate.Behaviour(healthy=False)
+        for name in ('sick', 'good'):
+            self.sim.add(name, {'ncolony.httpcheck': dict(period=10, grace=1, maxBad=3,
+                                                          timeout=5)})
+        self.sim.start()
+        self.sim.run(120)
+        self.assertGreater(self.sim.reactor.spawned['sick'], 1)
+        self.assertEquals(self.sim.reactor.spawned['good'], 1)
+        self.assertTrue(self.flushLoggedErrors())
+
+    def test_remove_stubborn(self):
+        """A removed process which ignores TERM is killed"""
+        self.behaviours['stubborn'] = simulate.Behaviour(stubborn=True)
+        self.sim.monitor.killTime = 5
+        self.sim.add('stubborn')
+        self.sim.start()
+        self.sim.run(1)
+        process, = self.sim.reactor.processes.values()
+        self.sim.remove('stubborn')
+        self.sim.run(13)
+        self.assertIsNone(process.ended)
+        self.sim.run(2)
+        self.assertEquals(process.ended, simulate.START + 15)
+        self.assertEquals(self.sim.reactor.spawned, dict(stubborn=1))
+
+    def test_stop(self):
+        """Stopping ends every process"""
+        self.behaviours['stubborn'] = simulate.Behaviour(stubborn=True)
+        for name in ('stubborn', 'good'):
+            self.sim.add(name)
+        self.sim.start()
+        self.sim.run(1)
+        self.sim.stop()
+        self.assertEquals(self.sim.reactor.processes, {})
+        other = self._simulation('other')
+        other.add('good')
+        other.start()
+        other.run(1)
+        other.stop()
+        self.assertEquals(other.reactor.seconds(), simulate.START + 1)
+
+    def test_deterministic(self):
+        """The same simulation runs the same way"""
+        def _run(name):
+            spawns = []
+            def _behaviour(processName):
+                spawns.append((processName, sim.reactor.seconds()))
+                return simulate.Behaviour(lifetime=25, healthy=processName.endswith('1'))
+            sim = simulate.Simulation(os.path.join(self.location, name), _behaviour)
+            for index in range(5):
+                sim.add('worker-%d' % index,
+                        {'ncolony.httpcheck': dict(period=10, grace=1, maxBad=1, timeout=3)})
+            sim.start()
+            sim.run(300)
+            return spawns
+        first = _run('one')
+        self.assertGreater(len(first), 5)
+        self.assertEquals(first, _run('two'))
+        self.assertTrue(self.flushLoggedErrors())
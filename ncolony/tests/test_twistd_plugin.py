@@ -8,9 +8,10 @@ See if the plugins are registered correctly.
 
 import unittest
 
-from ncolony import service, beatcheck, schedulelib
+from ncolony import service, beatcheck, health, schedulelib
 
-from twisted.plugins import ncolony_service, ncolony_beatcheck, ncolony_schedulelib
+from twisted.plugins import (ncolony_service, ncolony_beatcheck, ncolony_health,
+                             ncolony_schedulelib)
 
 class TestServices(unittest.TestCase):
 
@@ -38,6 +39,18 @@ class TestServices(unittest.TestCase):
         self.assertEquals(options['config'], 'bar')
         self.assertIs(beatcheck.makeService, sm.makeService)
 
+    def test_health_service(self):
+        """Options and makeService in health service are correct"""
+        sm = ncolony_health.serviceMaker
+        self.assertEquals(sm.tapname, 'ncolony-health')
+        self.assertNotEquals(sm.description, '')
+        options = sm.options()
+        options.parseOptions(['--messages', 'foo', '--config', 'bar', '--check', 'httpcheck'])
+        self.assertEquals(options['messages'], 'foo')
+        self.assertEquals(options['config'], 'bar')
+        self.assertEquals(options['checks'], ['httpcheck'])
+        self.assertIs(health.makeService, sm.makeService)
+
     def test_schedulelib_service(self):
         """Options and makeService in scheduler service are correct"""
         sm = ncolony_schedulelib.serviceMaker
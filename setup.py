@@ -18,12 +18,13 @@ setuptools.setup(
         'License :: OSI Approved :: MIT License',
         'Operating System :: POSIX',
         'Topic :: System',
-        'Programming Language :: Python :: 2',
-        'Programming Language :: Python :: 2.7',
+        'Programming Language :: Python :: 3',
+        'Programming Language :: Python :: 3 :: Only',
     ],
+    python_requires='>=3.6',
     keywords='process monitoring supervisor daemon',
     packages=setuptools.find_packages() + ['twisted.plugins'],
-    install_requires=['Twisted', 'gather', 'incremental', 'six'],
+    install_requires=['Twisted', 'gather', 'incremental'],
     setup_requires=['incremental'],
     use_incremental=True,
     entry_points={'gather': ["plugins=ncolony"]},
@@ -0,0 +1,13 @@
+# Copyright (c) Moshe Zadka
+# See LICENSE for details.
+
+"""Plugin for ncolony unified health twistd service"""
+
+from twisted.application.service import ServiceMaker
+
+serviceMaker = ServiceMaker(
+    "ncolony unified health monitor",
+    "ncolony.health",
+    "A health monitor running all kinds of checks for ncolony processes",
+    "ncolony-health",
+)